@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""Benchmarks parsing the Manifest and Hashes files.
+
+Synthetic files with a million lines each are generated, then parsed by
+the bulk parser and by a copy of the line by line parser used before it.
+Throughput is reported in lines per second along with the peak memory
+used while parsing beyond what the parsed files keep. Results are printed
+as a single JSON object, optionally appended as a line to an output file.
+"""
+import os
+import gc
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import tracemalloc
+from typing import Callable
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "uopatcher"))
+
+from uofile import UOFile  # noqa: E402
+from hashes import Hashes  # noqa: E402
+from manifest import Manifest  # noqa: E402
+from updatefile import UpdateFile, Version  # noqa: E402
+from bench_patcher import git_commit  # noqa: E402
+
+
+class LineParser:
+    """Reads and processes the file one line at a time, creating every
+    UOFile through pathlib, as the update files did before bulk parsing.
+    """
+
+    def load(self) -> bool:
+        with open(self.local_resource, 'r', encoding='utf-8-sig') as f:
+            for n, line in enumerate(f):
+                self._process(line.strip(), n + 1)
+        return True
+
+
+class LineManifest(LineParser, Manifest):
+    def _process(self, line_data: str, line_number: int):
+        if line_number == 1:
+            self.version = Version(Version.parse(line_data))
+            return
+
+        uofile = UOFile(line_data)
+        if not uofile.name or len(uofile.name) == 0:
+            return
+
+        self.add_uofile(uofile)
+        self.data[uofile.id] = uofile.action
+
+
+class LineHashes(LineParser, Hashes):
+    def _process(self, line_data: str, _: int):
+        data = line_data.split('\t')
+        if len(data) < 3:
+            return
+
+        uofile = UOFile(data[0])
+        if not uofile.name or len(uofile.name) == 0:
+            return
+
+        size: int = -1
+        try:
+            if len(data) >= 4:
+                size = int(data[3])
+        except BaseException:
+            size = -1
+
+        try:
+            if len(data) >= 5 and int(data[4]) > 0:
+                self.compressed_sizes[uofile.id] = int(data[4])
+        except BaseException:
+            pass
+
+        self.add_hashes(uofile, (data[1].lower(), data[2].lower()))
+        self.sizes[uofile.id] = size
+
+
+def generate(root: str, lines: int) -> None:
+    """Writes a Manifest and Hashes with the amount of file lines."""
+    with open(os.path.join(root, "Manifest"), 'w', encoding='utf-8') as f:
+        f.write("[1.0.0.1]\n")
+        for n in range(lines):
+            action = "+" if n % 50 == 0 else ""
+            f.write(f"\\d{n // 1000:04d}\\{action}f{n:07d}.mul\n")
+
+    with open(os.path.join(root, "Hashes"), 'w', encoding='utf-8') as f:
+        for n in range(lines):
+            md5 = f"{n * 2654435761 % (1 << 128):032X}"
+            f.write(f"\\d{n // 1000:04d}\\f{n:07d}.mul\t{md5}\t{md5}\t"
+                    f"{n % 65536}\n")
+
+
+def measure(func: Callable, lines: int) -> dict:
+    """Runs the parse twice, once for its throughput and once traced for
+    its memory use since tracing slows it down.
+    """
+    UpdateFile.FILES.clear()
+    gc.collect()
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+
+    UpdateFile.FILES.clear()
+    gc.collect()
+    tracemalloc.start()
+    update_file = func()
+    kept, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del update_file
+    UpdateFile.FILES.clear()
+    return {'seconds': round(elapsed, 6),
+            'lines_per_second': round(lines / max(elapsed, 1e-9)),
+            'kept_bytes': kept,
+            'transient_bytes': peak - kept}
+
+
+def parse(cls, uri: str, root: str):
+    """Creates the update file and parses the local copy."""
+    def run():
+        update_file = cls(uri, root)
+        update_file.load()
+        return update_file
+    return run
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the parsers.")
+    parser.add_argument("--lines", type=int, default=1000000,
+                        help="Amount of file lines in each file.")
+    parser.add_argument("--output",
+                        help="Appends the result as a JSON line to a file.")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    uri = "http://127.0.0.1:8080"
+    with tempfile.TemporaryDirectory(prefix="uopatcher-bench-") as root:
+        generate(root, args.lines)
+        runs = {}
+        for name, cls in (('manifest_lines', LineManifest),
+                          ('manifest_bulk', Manifest),
+                          ('hashes_lines', LineHashes),
+                          ('hashes_bulk', Hashes)):
+            runs[name] = measure(parse(cls, uri, root), args.lines)
+
+    result = {
+        'commit': git_commit(),
+        'timestamp': int(time.time()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': {'lines': args.lines,
+                   'block_size': UpdateFile.BLOCK_SIZE},
+        'runs': runs,
+        'speedup': {
+            'manifest': round(runs['manifest_bulk']['lines_per_second']
+                              / runs['manifest_lines']['lines_per_second'],
+                              2),
+            'hashes': round(runs['hashes_bulk']['lines_per_second']
+                            / runs['hashes_lines']['lines_per_second'], 2),
+        },
+    }
+
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""Benchmarks the patcher against a local stand-in patch host.
+
+A synthetic client is generated along with its Manifest and Hashes, then
+each phase of a patch is timed for a cold run (empty local_root), a warm
+run (everything up-to-date) and a warm run that ignores the hash cache.
+Results are printed as a single JSON object so they can be tracked across
+commits, optionally appended as a line to an output file.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import platform
+import tempfile
+import subprocess
+from typing import Callable
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "uopatcher"))
+
+from log import Log  # noqa: E402
+from hashes import Hashes  # noqa: E402
+from uofile import UOFile  # noqa: E402
+from manifest import Manifest  # noqa: E402
+from updatefile import UpdateFile  # noqa: E402
+from connpool import ConnectionPool  # noqa: E402
+from planner import build_plan  # noqa: E402
+from localindex import LocalIndex  # noqa: E402
+from core import pull_updates  # noqa: E402
+from aioengine import AsyncDownloadEngine  # noqa: E402
+from patchserver import PatchServer  # noqa: E402
+
+PRESETS: dict[str, dict] = {
+    'small': {'files': 50000, 'min_size': 512, 'max_size': 16 * 1024,
+              'large_files': 0, 'large_size': 0},
+    'large': {'files': 0, 'min_size': 0, 'max_size': 0,
+              'large_files': 3, 'large_size': 2 * 1024 ** 3},
+    'mixed': {'files': 2000, 'min_size': 1024, 'max_size': 256 * 1024,
+              'large_files': 2, 'large_size': 256 * 1024 ** 2},
+    'quick': {'files': 500, 'min_size': 512, 'max_size': 64 * 1024,
+              'large_files': 1, 'large_size': 32 * 1024 ** 2},
+}
+
+
+def write_file(path: str, size: int, rng: random.Random) -> str:
+    """Writes a file of random content, returning its md5."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    hash_md5 = hashlib.md5()
+    block = rng.randbytes(min(size, 1024 * 1024))
+    with open(path, 'wb') as f:
+        written = 0
+        while written < size:
+            # Vary each block slightly so the content does not repeat.
+            chunk = written.to_bytes(8, 'little') + block[8:]
+            chunk = chunk[:size - written]
+            f.write(chunk)
+            hash_md5.update(chunk)
+            written += len(chunk)
+    return hash_md5.hexdigest().upper()
+
+
+def generate(root: str, files: int, min_size: int, max_size: int,
+             large_files: int, large_size: int, seed: int) -> dict:
+    """Generates the remote client along with the Manifest and Hashes."""
+    rng = random.Random(seed)
+    entries: list[tuple[str, str, int]] = []
+    for n in range(files):
+        name = f"d{n // 1000:03d}/f{n:06d}.mul"
+        size = rng.randint(min_size, max_size)
+        entries.append((name, write_file(os.path.join(root, name), size,
+                                         rng), size))
+    for n in range(large_files):
+        name = f"large{n:02d}.uop"
+        entries.append((name, write_file(os.path.join(root, name),
+                                         large_size, rng), large_size))
+
+    with open(os.path.join(root, "Manifest"), 'w', encoding='utf-8') as f:
+        f.write("[1.0.0.1]\n")
+        for name, _, _ in entries:
+            f.write("\\" + name.replace("/", "\\") + "\n")
+
+    with open(os.path.join(root, "Hashes"), 'w', encoding='utf-8') as f:
+        for name, md5, size in entries:
+            remote = "\\" + name.replace("/", "\\")
+            f.write(f"{remote}\t{md5}\t{md5}\t{size}\n")
+
+    return {'files': len(entries),
+            'bytes': sum(size for _, _, size in entries)}
+
+
+def timed(phases: dict[str, float], name: str, func: Callable):
+    """Runs the function, recording how long it took."""
+    start = time.perf_counter()
+    result = func()
+    phases[name] = round(time.perf_counter() - start, 6)
+    return result
+
+
+def run_patch(uri: str, local_root: str, args: argparse.Namespace,
+              rehash: bool = False) -> dict:
+    """Runs every phase of a patch, returning the timings."""
+    UpdateFile.FILES.clear()
+    ConnectionPool.configure(args.pool_size, 30.0)
+    UOFile.SEGMENTS = args.segments
+    UOFile.SEGMENT_THRESHOLD = args.segment_threshold * 1024 * 1024
+
+    aio = None
+    if args.engine == 'async':
+        aio = AsyncDownloadEngine(jobs=args.jobs, pool_size=args.pool_size,
+                                  disk_workers=args.hash_workers)
+
+    def fetch(update: UpdateFile) -> Callable:
+        if not aio:
+            return update.download
+        return lambda: aio.run(aio.download_file(update.remote_resource,
+                                                 update.local_resource))
+
+    phases: dict[str, float] = {}
+    start = time.perf_counter()
+    manifest = Manifest(uri, local_root)
+    timed(phases, 'manifest_fetch', fetch(manifest))
+    timed(phases, 'manifest_parse', manifest.load)
+    hashes = Hashes(uri, local_root)
+    timed(phases, 'hashes_fetch', fetch(hashes))
+    timed(phases, 'hashes_parse', hashes.load)
+    index = LocalIndex(local_root)
+    timed(phases, 'scan_local', index.scan)
+    UOFile.INDEX = index
+    timed(phases, 'local_hash', lambda: hashes.build_localhash(
+        workers=args.hash_workers, rehash=rehash))
+    plan = timed(phases, 'plan', lambda: build_plan(
+        manifest.FILES, hashes, str(manifest.version)))
+    if aio:
+        size, failed = timed(phases, 'download', lambda: aio.pull_updates(
+            plan, hashes))
+    else:
+        size, failed = timed(phases, 'download', lambda: pull_updates(
+            plan, hashes, False, jobs=args.jobs))
+    hashes.cache.save()
+    total = time.perf_counter() - start
+
+    pool = aio.pool if aio else ConnectionPool.shared()
+    if aio:
+        aio.close()
+    return {
+        'phases': phases,
+        'total': round(total, 6),
+        'downloaded': size,
+        'created': len(plan.create),
+        'failed': failed,
+        'rate_mb_s': round(size / 1024 / 1024 / max(phases['download'],
+                                                     1e-9), 3),
+        'connections': pool.connections_opened,
+        'requests': pool.requests,
+    }
+
+
+def git_commit() -> str:
+    """Gets the commit being benchmarked if it is available."""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the patcher.")
+    parser.add_argument("--preset", choices=sorted(PRESETS), default='quick',
+                        help="Distribution of files to generate.")
+    parser.add_argument("--files", type=int,
+                        help="Amount of small files to generate.")
+    parser.add_argument("--min-size", type=int, dest="min_size",
+                        help="Minimum size of a small file in bytes.")
+    parser.add_argument("--max-size", type=int, dest="max_size",
+                        help="Maximum size of a small file in bytes.")
+    parser.add_argument("--large-files", type=int, dest="large_files",
+                        help="Amount of large files to generate.")
+    parser.add_argument("--large-size", type=int, dest="large_size",
+                        help="Size of each large file in bytes.")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="Seed for the generated content.")
+    parser.add_argument("--jobs", type=int, default=4)
+    parser.add_argument("--engine", choices=("sync", "async"),
+                        default='sync', help="Engine used to patch.")
+    parser.add_argument("--hash-workers", type=int, default=4,
+                        dest="hash_workers")
+    parser.add_argument("--pool-size", type=int, default=8, dest="pool_size")
+    parser.add_argument("--segments", type=int, default=4)
+    parser.add_argument("--segment-threshold", type=int, default=64,
+                        dest="segment_threshold",
+                        help="Size in megabytes to download in segments.")
+    parser.add_argument("--workdir",
+                        help="Directory to generate into, kept afterwards.")
+    parser.add_argument("--output",
+                        help="Appends the result as a JSON line to a file.")
+    args = parser.parse_args()
+
+    # Fill in anything not passed from the preset.
+    for key, value in PRESETS[args.preset].items():
+        if getattr(args, key) is None:
+            setattr(args, key, value)
+    return args
+
+
+def main() -> None:
+    args = parse_args()
+    Log.quiet_mode = True
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="uopatcher-bench-")
+    remote_root = os.path.join(workdir, "remote")
+    local_root = os.path.join(workdir, "local")
+    shutil.rmtree(local_root, ignore_errors=True)
+    os.makedirs(remote_root, exist_ok=True)
+
+    try:
+        dataset = generate(remote_root, args.files, args.min_size,
+                           args.max_size, args.large_files, args.large_size,
+                           args.seed)
+        with PatchServer(remote_root) as server:
+            uri = f"{server.url}:{server.port}"
+            runs = {
+                'cold': run_patch(uri, local_root, args),
+                'warm': run_patch(uri, local_root, args),
+                'warm_rehash': run_patch(uri, local_root, args, rehash=True),
+            }
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    result = {
+        'commit': git_commit(),
+        'timestamp': int(time.time()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'preset': args.preset,
+        'params': {key: getattr(args, key) for key in (
+            'files', 'min_size', 'max_size', 'large_files', 'large_size',
+            'seed', 'engine', 'jobs', 'hash_workers', 'pool_size', 'segments',
+            'segment_threshold')},
+        'dataset': dataset,
+        'runs': runs,
+    }
+
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""Benchmarks the memory and time used to represent a large manifest.
+
+A synthetic list of file names is turned into UOFiles the way the
+Manifest and Hashes do, then the properties used while planning are read
+for every file. The same is done for a copy of the UOFile that builds its
+paths on every access, the representation used before they were
+precomputed, and for the array backed FileTable. Results are printed as a
+single JSON object, optionally appended as a line to an output file.
+"""
+import os
+import gc
+import sys
+import json
+import time
+import pathlib
+import platform
+import argparse
+import tempfile
+import tracemalloc
+from typing import Callable, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "uopatcher"))
+
+from uofile import UOFile, FileAction  # noqa: E402
+from filetable import FileTable  # noqa: E402
+from bench_patcher import git_commit  # noqa: E402
+
+
+class PathUOFile:
+    """UOFile as it was before its strings were precomputed, every
+    property builds a new path and the local size is always a new stat.
+    """
+
+    def __init__(self, raw_filename: str) -> None:
+        cleaned = raw_filename.strip().lstrip('\\').replace('\\', '/')
+        as_path = pathlib.Path(cleaned)
+        self.raw_name = raw_filename
+        self.parent = str(as_path.parent)
+        self.name = as_path.name
+        self.remote_hashes: Optional[tuple[str, str]] = None
+        self.action = FileAction.NONE
+        if self.name[:1] == "-":
+            self.action = FileAction.DELETE
+        elif self.name[:1] == "+":
+            self.action = FileAction.CREATE
+        if self.action != FileAction.NONE:
+            self.name = self.name[1:]
+
+    @property
+    def id(self) -> str:
+        return str(self.path)
+
+    @property
+    def path(self) -> pathlib.Path:
+        return pathlib.Path(self.parent, self.name)
+
+    @property
+    def local_size(self) -> int:
+        if self.local_exists:
+            return os.stat(self.local_resource).st_size
+        return -1
+
+    @property
+    def remote_resource(self) -> str:
+        return f"{UOFile.REMOTE_ROOT}/{self.path}"
+
+    @property
+    def local_resource(self) -> str:
+        return str(pathlib.Path(UOFile.LOCAL_ROOT, self.parent, self.name))
+
+    @property
+    def local_exists(self) -> bool:
+        return pathlib.Path(self.local_resource).is_file()
+
+
+def generate(count: int) -> list[tuple[str, tuple[str, str], int]]:
+    """Generates the raw names, hashes and sizes of a manifest."""
+    entries = []
+    for n in range(count):
+        md5 = f"{n * 2654435761 % (1 << 128):032x}"
+        entries.append((f"\\d{n // 1000:04d}\\f{n:07d}.mul", (md5, md5),
+                        n % 65536))
+    return entries
+
+
+def measure(func: Callable) -> tuple[object, float, int]:
+    """Runs the function, returning its result, the seconds it took and
+    the bytes still allocated by it afterwards.
+    """
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, current
+
+
+def build_files(cls, entries) -> dict:
+    """Builds the tracked files the way the Manifest and Hashes do."""
+    files = {}
+    for raw_name, hashes, _ in entries:
+        uofile = cls(raw_name)
+        uofile.remote_hashes = hashes
+        files[uofile.id] = uofile
+    return files
+
+
+def access(files: dict, passes: int) -> int:
+    """Reads the properties the planner and engines use for every file."""
+    total = 0
+    for _ in range(passes):
+        for uofile in files.values():
+            total += len(uofile.id) + len(uofile.local_resource)
+            total += len(uofile.remote_resource)
+            total += uofile.local_size + uofile.local_exists
+    return total
+
+
+def run(cls, entries, passes: int) -> dict:
+    """Measures building and accessing the files for a class."""
+    files, build_time, memory = measure(lambda: build_files(cls, entries))
+    start = time.perf_counter()
+    access(files, passes)
+    access_time = time.perf_counter() - start
+    return {'build_seconds': round(build_time, 6),
+            'access_seconds': round(access_time, 6),
+            'bytes': memory,
+            'bytes_per_file': round(memory / max(1, len(files)), 1)}
+
+
+def run_table(entries) -> dict:
+    """Measures the array backed table of the same files."""
+    def build() -> FileTable:
+        table = FileTable()
+        for raw_name, hashes, size in entries:
+            table.add(raw_name.lstrip('\\').replace('\\', os.sep),
+                      FileAction.NONE, hashes, size)
+        return table
+
+    table, build_time, memory = measure(build)
+    start = time.perf_counter()
+    for row in range(len(table)):
+        table.size(row)
+        table.remote_hashes(row)
+    access_time = time.perf_counter() - start
+    return {'build_seconds': round(build_time, 6),
+            'access_seconds': round(access_time, 6),
+            'bytes': memory,
+            'bytes_per_file': round(memory / max(1, len(table)), 1),
+            'array_bytes': table.nbytes}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the UOFile representation.")
+    parser.add_argument("--files", type=int, default=200000,
+                        help="Amount of files in the manifest.")
+    parser.add_argument("--passes", type=int, default=3,
+                        help="Times the properties of every file are read.")
+    parser.add_argument("--output",
+                        help="Appends the result as a JSON line to a file.")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    entries = generate(args.files)
+    with tempfile.TemporaryDirectory(prefix="uopatcher-bench-") as root:
+        UOFile.REMOTE_ROOT = "http://127.0.0.1:8080"
+        UOFile.LOCAL_ROOT = root
+        runs = {
+            'path_properties': run(PathUOFile, entries, args.passes),
+            'precomputed': run(UOFile, entries, args.passes),
+            'file_table': run_table(entries),
+        }
+
+    before, after = runs['path_properties'], runs['precomputed']
+    result = {
+        'commit': git_commit(),
+        'timestamp': int(time.time()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': {'files': args.files, 'passes': args.passes},
+        'runs': runs,
+        'saved': {
+            'bytes': before['bytes'] - after['bytes'],
+            'access_seconds': round(before['access_seconds']
+                                    - after['access_seconds'], 6),
+            'table_bytes': after['bytes'] - runs['file_table']['bytes'],
+        },
+    }
+
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
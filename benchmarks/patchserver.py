@@ -0,0 +1,146 @@
+"""Stand-in patch host used by the benchmarks. Serves a directory over
+HTTP/1.1 with keep-alive, byte ranges and ETag validation so every code
+path of the patcher can be exercised locally, including bundles of small
+files.
+"""
+import os
+import re
+import sys
+import threading
+from http import HTTPStatus
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from typing import Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "uopatcher"))
+
+from bundle import Bundle, write_bundle  # noqa: E402
+
+
+class PatchRequestHandler(SimpleHTTPRequestHandler):
+    """Serves files with support for Range and If-None-Match, and small
+    files as bundles.
+    """
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    RANGE = re.compile(r"bytes=(\d+)-(\d*)$")
+
+    def log_message(self, *_) -> None:
+        """Silences the per-request logging."""
+
+    def do_GET(self) -> None:
+        """Serves the body of a file."""
+        self._serve(send_body=True)
+
+    def do_HEAD(self) -> None:
+        """Serves only the headers of a file."""
+        self._serve(send_body=False)
+
+    def do_POST(self) -> None:
+        """Serves the requested files as a bundle."""
+        length = int(self.headers.get("Content-Length", "0") or 0)
+        body = self.rfile.read(length)
+        if self.path.strip('/') != Bundle.PATH:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+
+        members = [(name, self.translate_path(f"/{name}"), None)
+                   for name in Bundle.parse_request(body)]
+        self.close_connection = True
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/x-tar")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        write_bundle(self.wfile, members)
+
+    def _serve(self, send_body: bool) -> None:
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+
+        stat = os.stat(path)
+        size = stat.st_size
+        etag = f'"{stat.st_mtime_ns:x}-{size:x}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        first, last = 0, size - 1
+        match = self.RANGE.match(self.headers.get("Range", ""))
+        if match:
+            first = int(match.group(1))
+            if match.group(2):
+                last = min(int(match.group(2)), size - 1)
+            if first >= size or first > last:
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(HTTPStatus.PARTIAL_CONTENT)
+            self.send_header("Content-Range", f"bytes {first}-{last}/{size}")
+        else:
+            self.send_response(HTTPStatus.OK)
+
+        length = max(0, last - first + 1)
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.end_headers()
+        if not send_body or length == 0:
+            return
+
+        with open(path, 'rb') as f:
+            f.seek(first)
+            remaining = length
+            while remaining > 0:
+                chunk = f.read(min(1024 * 1024, remaining))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+
+class PatchServer:
+    """Runs the stand-in patch host on a background thread. Another handler
+    can be passed to change how the files are served.
+    """
+
+    def __init__(self, root: str, host: str = "127.0.0.1",
+                 port: int = 0,
+                 handler_class: type = PatchRequestHandler) -> None:
+        def handler(*args, **kwargs):
+            return handler_class(*args, directory=root, **kwargs)
+
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        """Remote root to pass to the patcher."""
+        return f"http://{self.httpd.server_address[0]}"
+
+    @property
+    def port(self) -> int:
+        """Port the server is listening on."""
+        return self.httpd.server_address[1]
+
+    def start(self) -> 'PatchServer':
+        self._thread = threading.Thread(target=self.httpd.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self) -> 'PatchServer':
+        return self.start()
+
+    def __exit__(self, *_) -> None:
+        self.stop()
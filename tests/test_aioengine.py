@@ -0,0 +1,328 @@
+"""Tests the HTTP client and '.part' handling of the async engine against
+the stand-in patch host from the benchmarks.
+"""
+import os
+import sys
+import gzip
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "uopatcher"))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from log import Log  # noqa: E402
+from aioengine import AsyncDownloadEngine, PartFile  # noqa: E402
+from uofile import partial_resource  # noqa: E402
+from patchserver import PatchServer, PatchRequestHandler  # noqa: E402
+
+
+class EncodingHandler(PatchRequestHandler):
+    """Serves the files under '/chunked/' with a chunked body, under
+    '/gzip/' compressed if the client accepts it, under '/short/' with the
+    connection closed halfway through the body, under '/cut/' closed
+    within a chunk and under '/norange/' in full even if a range is
+    requested. Every request is recorded.
+    """
+    requests: list[tuple[str, dict[str, str]]] = []
+
+    def do_GET(self) -> None:
+        EncodingHandler.requests.append((self.path, dict(self.headers)))
+        kind, _, rest = self.path.lstrip('/').partition('/')
+        if kind not in ('chunked', 'gzip', 'short', 'cut', 'norange'):
+            super().do_GET()
+            return
+
+        with open(self.translate_path(f"/{rest}"), 'rb') as f:
+            data = f.read()
+        if kind == 'chunked':
+            self._send_chunked(data)
+        elif kind == 'gzip':
+            accepted = self.headers.get("Accept-Encoding", "")
+            body = gzip.compress(data) if 'gzip' in accepted else data
+            self.send_response(200)
+            if body is not data:
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif kind == 'norange':
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        elif kind == 'short':
+            self.close_connection = True
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data[:len(data) // 2])
+        else:
+            self.close_connection = True
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data[:10])
+
+    def _send_chunked(self, data: bytes) -> None:
+        """Sends the body in chunks of uneven sizes, with an extension on
+        the first chunk and a trailer after the last.
+        """
+        self.send_response(200)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        sizes = [1, 7, 4096]
+        first = True
+        while data:
+            size = sizes.pop(0) if sizes else 65536
+            chunk, data = data[:size], data[size:]
+            extension = ";name=value" if first else ""
+            first = False
+            self.wfile.write(f"{len(chunk):x}{extension}\r\n".encode()
+                             + chunk + b"\r\n")
+        self.wfile.write(b"0\r\nX-Trailer: done\r\n\r\n")
+
+
+class AsyncEngineTest(unittest.TestCase):
+    """Downloads through the async engine from a local patch host."""
+
+    def setUp(self) -> None:
+        Log.quiet_mode = True
+        self.root = tempfile.mkdtemp(prefix="uopatcher-test-")
+        self.remote = os.path.join(self.root, "remote")
+        self.local = os.path.join(self.root, "local", "file.mul")
+        os.makedirs(self.remote)
+        # Compressible but not uniform, so chunk boundaries matter.
+        self.data = b"".join(n.to_bytes(4, 'big') * 16
+                             for n in range(20000))
+        self.md5 = hashlib.md5(self.data).hexdigest().lower()
+        with open(os.path.join(self.remote, "file.mul"), 'wb') as f:
+            f.write(self.data)
+        with open(os.path.join(self.remote, "file.mul.gz"), 'wb') as f:
+            f.write(gzip.compress(self.data))
+
+        EncodingHandler.requests = []
+        self.server = PatchServer(self.remote,
+                                  handler_class=EncodingHandler).start()
+        self.engine = AsyncDownloadEngine()
+
+    def tearDown(self) -> None:
+        self.engine.close()
+        self.server.stop()
+        shutil.rmtree(self.root, ignore_errors=True)
+        Log.quiet_mode = False
+
+    def url(self, path: str) -> str:
+        return f"{self.server.url}:{self.server.port}/{path}"
+
+    def download(self, path: str, **kwargs):
+        kwargs.setdefault('expected_size', len(self.data))
+        kwargs.setdefault('expected_hashes', (self.md5,))
+        return self.engine.run(self.engine.download_file(
+            self.url(path), self.local, **kwargs))
+
+    def read_local(self) -> bytes:
+        with open(self.local, 'rb') as f:
+            return f.read()
+
+    def write_part(self, data: bytes) -> None:
+        os.makedirs(os.path.dirname(self.local), exist_ok=True)
+        with open(partial_resource(self.local), 'wb') as f:
+            f.write(data)
+
+    def test_sized_body(self) -> None:
+        stats = self.download("file.mul")
+        self.assertTrue(stats.complete)
+        self.assertEqual(stats.md5, self.md5)
+        self.assertEqual(self.read_local(), self.data)
+        self.assertFalse(os.path.exists(partial_resource(self.local)))
+
+    def test_chunked_body(self) -> None:
+        stats = self.download("chunked/file.mul")
+        self.assertTrue(stats.complete)
+        self.assertEqual(self.read_local(), self.data)
+
+    def test_chunked_keeps_connection(self) -> None:
+        self.download("chunked/file.mul")
+        os.remove(self.local)
+        stats = self.download("chunked/file.mul")
+        self.assertTrue(stats.complete)
+        # The trailers were consumed, so the connection was reused.
+        self.assertEqual(self.engine.pool.connections_opened, 1)
+        self.assertEqual(self.engine.pool.requests, 2)
+
+    def test_chunked_cut_short(self) -> None:
+        with self.assertRaises(ConnectionError):
+            self.download("cut/file.mul")
+        self.assertFalse(os.path.exists(self.local))
+
+    def test_gzip_encoding(self) -> None:
+        stats = self.download("gzip/file.mul", accept_gzip=True)
+        self.assertTrue(stats.complete)
+        self.assertEqual(self.read_local(), self.data)
+        self.assertLess(stats.transferred, len(self.data))
+        self.assertIn('gzip',
+                      EncodingHandler.requests[-1][1]["Accept-Encoding"])
+
+    def test_gzip_not_requested(self) -> None:
+        stats = self.download("gzip/file.mul")
+        self.assertTrue(stats.complete)
+        self.assertEqual(stats.transferred, len(self.data))
+        self.assertEqual(EncodingHandler.requests[-1][1]["Accept-Encoding"],
+                         "identity")
+
+    def test_gzipped_sibling(self) -> None:
+        stats = self.download("file.mul.gz", gzipped=True)
+        self.assertTrue(stats.complete)
+        self.assertEqual(self.read_local(), self.data)
+
+    def test_short_read_then_resume(self) -> None:
+        stats = self.download("short/file.mul")
+        self.assertFalse(stats.complete)
+        self.assertFalse(os.path.exists(self.local))
+        half = len(self.data) // 2
+        self.assertEqual(os.path.getsize(partial_resource(self.local)), half)
+
+        stats = self.download("file.mul")
+        self.assertTrue(stats.complete)
+        self.assertEqual(stats.downloaded, len(self.data) - half)
+        self.assertEqual(EncodingHandler.requests[-1][1].get("Range"),
+                         f"bytes={half}-")
+        self.assertEqual(self.read_local(), self.data)
+
+    def test_resume_mismatch_is_discarded(self) -> None:
+        self.write_part(b"\0" * 1000)
+        stats = self.download("file.mul")
+        self.assertFalse(stats.complete)
+        self.assertFalse(os.path.exists(self.local))
+        self.assertFalse(os.path.exists(partial_resource(self.local)))
+
+        stats = self.download("file.mul")
+        self.assertTrue(stats.complete)
+        self.assertEqual(self.read_local(), self.data)
+
+    def test_no_resume_without_hashes(self) -> None:
+        self.write_part(b"\0" * 1000)
+        stats = self.download("file.mul", expected_hashes=None)
+        self.assertTrue(stats.complete)
+        self.assertNotIn("Range", EncodingHandler.requests[-1][1])
+        self.assertEqual(self.read_local(), self.data)
+
+    def test_verify_rejects(self) -> None:
+        stats = self.download("file.mul", verify=lambda _: False)
+        self.assertFalse(stats.complete)
+        self.assertFalse(os.path.exists(self.local))
+        self.assertFalse(os.path.exists(partial_resource(self.local)))
+
+    def test_not_modified(self) -> None:
+        stats = self.download("file.mul")
+        etag = stats.validators["etag"]
+        stats = self.download("file.mul", headers={"If-None-Match": etag})
+        self.assertTrue(stats.complete)
+        self.assertFalse(stats.modified)
+        self.assertEqual(stats.size, len(self.data))
+
+    def segmented(self, path: str, segments: int = 4, **kwargs):
+        kwargs.setdefault('expected_hashes', (self.md5,))
+        return self.engine.run(self.engine.download_segmented(
+            self.url(path), self.local, len(self.data), segments,
+            chunk_size=1000, **kwargs))
+
+    def ranges(self) -> list[str]:
+        return [headers["Range"] for _, headers in EncodingHandler.requests
+                if "Range" in headers]
+
+    def test_segmented(self) -> None:
+        stats = self.segmented("file.mul")
+        self.assertTrue(stats.complete)
+        self.assertEqual(stats.md5, self.md5)
+        self.assertEqual(stats.downloaded, len(self.data))
+        self.assertEqual(self.read_local(), self.data)
+        size = len(self.data) // 4
+        self.assertEqual(sorted(self.ranges()),
+                         sorted(f"bytes={n * size}-{(n + 1) * size - 1}"
+                                for n in range(4)))
+
+    def test_segmented_resume(self) -> None:
+        self.write_part(self.data[:1000])
+        stats = self.segmented("file.mul", segments=3)
+        self.assertTrue(stats.complete)
+        self.assertEqual(stats.downloaded, len(self.data) - 1000)
+        self.assertEqual(len(self.ranges()), 3)
+        self.assertTrue(all(int(value[6:].split('-')[0]) >= 1000
+                            for value in self.ranges()))
+        self.assertEqual(self.read_local(), self.data)
+
+    def test_segmented_next_source(self) -> None:
+        calls: list[tuple[str, bool]] = []
+        stats = self.segmented(
+            "file.mul", sources=[self.url("missing.mul"),
+                                 self.url("file.mul")],
+            on_range=lambda source, *args: calls.append((source,
+                                                         args[-1])))
+        self.assertTrue(stats.complete)
+        self.assertEqual(self.read_local(), self.data)
+        # The ranges of the missing source were fetched from the next one.
+        self.assertEqual(sum(1 for _, success in calls if not success), 2)
+        self.assertEqual(sum(1 for _, success in calls if success), 4)
+
+    def test_segmented_ranges_ignored(self) -> None:
+        stats = self.segmented("norange/file.mul")
+        self.assertTrue(stats.complete)
+        self.assertEqual(self.read_local(), self.data)
+        self.assertFalse(os.path.exists(partial_resource(self.local)))
+
+    def test_segmented_mismatch(self) -> None:
+        stats = self.segmented("file.mul", expected_hashes=("0" * 32,))
+        self.assertFalse(stats.complete)
+        self.assertFalse(os.path.exists(self.local))
+        self.assertFalse(os.path.exists(partial_resource(self.local)))
+
+
+class PartFileTest(unittest.TestCase):
+    """Writes '.part' files directly."""
+
+    def setUp(self) -> None:
+        self.root = tempfile.mkdtemp(prefix="uopatcher-test-")
+        self.part = os.path.join(self.root, "sub", "file.mul.part")
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_resume_hashes_existing(self) -> None:
+        os.makedirs(os.path.dirname(self.part))
+        with open(self.part, 'wb') as f:
+            f.write(b"abcdefXXXX")
+        part = PartFile(self.part, 6, False)
+        part.open()
+        part.write(b"ghij")
+        part.close()
+        with open(self.part, 'rb') as f:
+            self.assertEqual(f.read(), b"abcdefghij")
+        self.assertEqual(part.size, 10)
+        self.assertEqual(part.hash_md5.hexdigest(),
+                         hashlib.md5(b"abcdefghij").hexdigest())
+
+    def test_gzip_stream(self) -> None:
+        body = gzip.compress(b"x" * 100000)
+        part = PartFile(self.part, 0, True)
+        part.open()
+        for n in range(0, len(body), 7):
+            part.write(body[n:n + 7])
+        self.assertTrue(part.stream_complete)
+        part.close()
+        self.assertEqual(os.path.getsize(self.part), 100000)
+
+    def test_gzip_truncated(self) -> None:
+        body = gzip.compress(os.urandom(10000))
+        part = PartFile(self.part, 0, True)
+        part.open()
+        part.write(body[:len(body) // 2])
+        self.assertFalse(part.stream_complete)
+        part.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
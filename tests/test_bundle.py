@@ -0,0 +1,281 @@
+"""Tests the tar reader behind bundles and the extraction of bundles from
+the stand-in patch host from the benchmarks.
+"""
+import io
+import os
+import sys
+import shutil
+import hashlib
+import tarfile
+import tempfile
+import unittest
+from http import HTTPStatus
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "uopatcher"))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from log import Log  # noqa: E402
+from uofile import UOFile, partial_resource  # noqa: E402
+from connpool import ConnectionPool  # noqa: E402
+from aioengine import AsyncDownloadEngine  # noqa: E402
+from bundle import TarStream, MEMBER, DATA, END, _number  # noqa: E402
+from bundle import (Bundle, BundleExtractor, download_bundle,  # noqa: E402
+                    write_bundle)
+from patchserver import PatchServer, PatchRequestHandler  # noqa: E402
+
+
+def archive(members: list[tuple[str, bytes]],
+            tar_format: int = tarfile.PAX_FORMAT) -> bytes:
+    """Creates a tar stream of regular files."""
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode='w', format=tar_format) as tar:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return out.getvalue()
+
+
+def read(stream: bytes, step: int) -> list[tuple[str, bytes]]:
+    """Feeds the stream in pieces of the step, collecting the members."""
+    tar = TarStream()
+    members: list[tuple[str, bytes]] = []
+    parts: list[bytes] = []
+    for n in range(0, len(stream), step):
+        for kind, value, size in tar.feed(stream[n:n + step]):
+            if kind == MEMBER:
+                parts = []
+            elif kind == DATA:
+                parts.append(value)
+            elif kind == END:
+                data = b"".join(parts)
+                if len(data) != size:
+                    raise AssertionError(f"'{value}' has the wrong size")
+                members.append((value, data))
+    if not tar.done:
+        raise AssertionError("end of the archive not reached")
+    return members
+
+
+class TarStreamTest(unittest.TestCase):
+    """Reads tar streams created by tarfile."""
+    MEMBERS = [("a.mul", b"a" * 1000),
+               ("empty.mul", b""),
+               ("d/" + "n" * 120 + ".mul", os.urandom(4097)),
+               ("exact.mul", b"e" * 512)]
+
+    def test_formats(self) -> None:
+        for tar_format in (tarfile.PAX_FORMAT, tarfile.GNU_FORMAT):
+            stream = archive(self.MEMBERS, tar_format)
+            for step in (1, 7, 511, 512, 513, len(stream)):
+                with self.subTest(format=tar_format, step=step):
+                    self.assertEqual(read(stream, step), self.MEMBERS)
+
+    def test_ustar_prefix(self) -> None:
+        name = "p" * 80 + "/" + "f" * 60 + ".mul"
+        stream = archive([(name, b"x")], tarfile.USTAR_FORMAT)
+        self.assertEqual(read(stream, 100), [(name, b"x")])
+
+    def test_skips_other_members(self) -> None:
+        out = io.BytesIO()
+        with tarfile.open(fileobj=out, mode='w',
+                          format=tarfile.PAX_FORMAT) as tar:
+            directory = tarfile.TarInfo("dir")
+            directory.type = tarfile.DIRTYPE
+            tar.addfile(directory)
+            link = tarfile.TarInfo("link")
+            link.type = tarfile.SYMTYPE
+            link.linkname = "/etc/passwd"
+            tar.addfile(link)
+            info = tarfile.TarInfo("file.mul")
+            info.size = 3
+            tar.addfile(info, io.BytesIO(b"abc"))
+        self.assertEqual(read(out.getvalue(), 64), [("file.mul", b"abc")])
+
+    def test_ignores_after_end(self) -> None:
+        stream = archive([("a.mul", b"a")])
+        tar = TarStream()
+        tar.feed(stream)
+        self.assertTrue(tar.done)
+        self.assertEqual(tar.feed(archive([("b.mul", b"b")])), [])
+
+    def test_bad_checksum(self) -> None:
+        stream = bytearray(archive([("a.mul", b"a")], tarfile.USTAR_FORMAT))
+        stream[0] ^= 0xff
+        with self.assertRaises(ValueError):
+            TarStream().feed(bytes(stream))
+
+    def test_numbers(self) -> None:
+        self.assertEqual(_number(b"0000644\0"), 0o644)
+        self.assertEqual(_number(b"\0" * 8), 0)
+        self.assertEqual(_number(b"\x80" + (2 ** 40).to_bytes(11, 'big')),
+                         2 ** 40)
+
+
+class BundleExtractorTest(unittest.TestCase):
+    """Extracts bundles into a local root."""
+
+    def setUp(self) -> None:
+        Log.quiet_mode = True
+        self.root = tempfile.mkdtemp(prefix="uopatcher-test-")
+        self.local = os.path.join(self.root, "local")
+        UOFile.LOCAL_ROOT = self.local
+        self.data = {"a.mul": b"a" * 1000, "d/b.mul": os.urandom(3000)}
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.root, ignore_errors=True)
+        Log.quiet_mode = False
+
+    def uofile(self, name: str, data: bytes) -> UOFile:
+        uofile = UOFile("\\" + name.replace("/", "\\"))
+        uofile.remote_hashes = (hashlib.md5(data).hexdigest().lower(),)
+        return uofile
+
+    def read_local(self, name: str) -> bytes:
+        with open(os.path.join(self.local, name), 'rb') as f:
+            return f.read()
+
+    def test_extracts_requested(self) -> None:
+        files = [(self.uofile(name, data), len(data))
+                 for name, data in self.data.items()]
+        stream = archive([("../evil.mul", b"evil"), ("other.mul", b"o")]
+                         + list(self.data.items()))
+        extractor = BundleExtractor(files)
+        for n in range(0, len(stream), 1000):
+            extractor.feed(stream[n:n + 1000])
+        extractor.close()
+
+        self.assertTrue(extractor.done)
+        self.assertEqual(set(extractor.completed),
+                         {os.path.normcase(uofile.id) for uofile, _ in files})
+        for name, data in self.data.items():
+            self.assertEqual(self.read_local(name), data)
+        self.assertFalse(os.path.exists(os.path.join(self.root, "evil.mul")))
+        self.assertFalse(os.path.exists(os.path.join(self.local,
+                                                     "other.mul")))
+
+    def test_rejects_mismatch(self) -> None:
+        uofile = self.uofile("a.mul", b"expected")
+        extractor = BundleExtractor([(uofile, -1)])
+        extractor.feed(archive([("a.mul", b"received")]))
+        self.assertEqual(extractor.completed, {})
+        self.assertFalse(os.path.exists(uofile.local_resource))
+        self.assertFalse(os.path.exists(partial_resource(
+            uofile.local_resource)))
+
+    def test_rejects_size(self) -> None:
+        uofile = self.uofile("a.mul", self.data["a.mul"])
+        extractor = BundleExtractor([(uofile, 999)])
+        extractor.feed(archive([("a.mul", self.data["a.mul"])]))
+        self.assertEqual(extractor.completed, {})
+        self.assertFalse(os.path.exists(uofile.local_resource))
+
+    def test_cut_short(self) -> None:
+        uofile = self.uofile("d/b.mul", self.data["d/b.mul"])
+        extractor = BundleExtractor([(uofile, 3000)])
+        stream = archive([("d/b.mul", self.data["d/b.mul"])])
+        extractor.feed(stream[:2000])
+        extractor.close()
+        self.assertFalse(extractor.done)
+        self.assertEqual(extractor.completed, {})
+        self.assertFalse(os.path.exists(uofile.local_resource))
+        # The part is kept so the file can be resumed.
+        self.assertTrue(os.path.exists(partial_resource(
+            uofile.local_resource)))
+
+    def test_write_bundle(self) -> None:
+        remote = os.path.join(self.root, "remote")
+        os.makedirs(remote)
+        paths = {}
+        for name in ("a.mul", "b.mul", "c.mul"):
+            paths[name] = os.path.join(remote, name)
+            with open(paths[name], 'wb') as f:
+                f.write(name.encode() * 10)
+        stat = os.stat(paths["b.mul"])
+        changed = (stat.st_size + 1, stat.st_mtime_ns, stat.st_ino)
+
+        out = io.BytesIO()
+        written = write_bundle(out, [("a.mul", paths["a.mul"], None),
+                                     ("b.mul", paths["b.mul"], changed),
+                                     ("gone.mul", paths["a.mul"] + "x",
+                                      None),
+                                     ("c.mul", paths["c.mul"], None)])
+        self.assertEqual(written, 2)
+        self.assertEqual(read(out.getvalue(), 300),
+                         [("a.mul", b"a.mul" * 10), ("c.mul", b"c.mul" * 10)])
+
+
+class NoBundleHandler(PatchRequestHandler):
+    """A host without bundles."""
+
+    def do_POST(self) -> None:
+        self.send_error(HTTPStatus.NOT_FOUND)
+
+
+class DownloadBundleTest(unittest.TestCase):
+    """Downloads bundles from a local patch host with both engines."""
+
+    def setUp(self) -> None:
+        Log.quiet_mode = True
+        self.root = tempfile.mkdtemp(prefix="uopatcher-test-")
+        self.remote = os.path.join(self.root, "remote")
+        self.local = os.path.join(self.root, "local")
+        UOFile.LOCAL_ROOT = self.local
+        self.files: list[tuple[UOFile, int]] = []
+        for n in range(20):
+            data = os.urandom(n * 100)
+            name = f"d{n % 3}/f{n}.mul"
+            path = os.path.join(self.remote, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+            uofile = UOFile("\\" + name.replace("/", "\\"))
+            uofile.remote_hashes = (hashlib.md5(data).hexdigest().lower(),)
+            self.files.append((uofile, len(data)))
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.root, ignore_errors=True)
+        Bundle.UNSUPPORTED.clear()
+        Log.quiet_mode = False
+
+    def check(self, completed: dict) -> None:
+        self.assertEqual(len(completed), len(self.files))
+        for uofile, size in self.files:
+            self.assertEqual(os.path.getsize(uofile.local_resource), size)
+            self.assertEqual(completed[os.path.normcase(uofile.id)].md5,
+                             uofile.remote_hashes[0])
+
+    def test_sync(self) -> None:
+        pool = ConnectionPool()
+        with PatchServer(self.remote) as server:
+            completed = download_bundle(f"{server.url}:{server.port}",
+                                        self.files, chunk_size=777,
+                                        pool=pool)
+        pool.close()
+        self.check(completed)
+
+    def test_async(self) -> None:
+        engine = AsyncDownloadEngine()
+        try:
+            with PatchServer(self.remote) as server:
+                completed = engine.run(engine.download_bundle(
+                    f"{server.url}:{server.port}", self.files,
+                    chunk_size=777))
+        finally:
+            engine.close()
+        self.check(completed)
+
+    def test_unsupported(self) -> None:
+        pool = ConnectionPool()
+        with PatchServer(self.remote,
+                         handler_class=NoBundleHandler) as server:
+            remote_root = f"{server.url}:{server.port}"
+            completed = download_bundle(remote_root, self.files, pool=pool)
+        pool.close()
+        self.assertEqual(completed, {})
+        self.assertFalse(Bundle.supported(remote_root))
+
+
+if __name__ == "__main__":
+    unittest.main()
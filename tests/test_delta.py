@@ -0,0 +1,231 @@
+"""Tests the block checksums and the delta updates of large files with
+both engines against the stand-in patch host from the benchmarks.
+"""
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "uopatcher"))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from log import Log  # noqa: E402
+from uofile import UOFile, download_delta  # noqa: E402
+from connpool import ConnectionPool  # noqa: E402
+from aioengine import AsyncDownloadEngine  # noqa: E402
+from delta import BLOCKS_SUFFIX, BlockList, DeltaPlan  # noqa: E402
+from patchserver import PatchServer, PatchRequestHandler  # noqa: E402
+
+BLOCK_SIZE = 1000
+
+
+def md5(data: bytes) -> str:
+    return hashlib.md5(data).hexdigest().lower()
+
+
+def blocks(data: bytes) -> BlockList:
+    """Creates the block checksums of the data."""
+    digests = [md5(data[n:n + BLOCK_SIZE])
+               for n in range(0, len(data), BLOCK_SIZE)]
+    return BlockList(BLOCK_SIZE, len(data), digests)
+
+
+class RecordingHandler(PatchRequestHandler):
+    """Records the path and range of every request."""
+    requests: list[tuple[str, str]] = []
+
+    def do_GET(self) -> None:
+        RecordingHandler.requests.append((self.path,
+                                          self.headers.get("Range", "")))
+        super().do_GET()
+
+
+class BlockListTest(unittest.TestCase):
+    """Parses sidecars and plans where the blocks come from."""
+
+    def test_round_trip(self) -> None:
+        data = os.urandom(2500)
+        parsed = BlockList.parse(blocks(data).to_text())
+        self.assertEqual(parsed.size, 2500)
+        self.assertEqual(parsed.digests, blocks(data).digests)
+        self.assertEqual(parsed.block_range(2), (2000, 2499))
+
+    def test_malformed(self) -> None:
+        self.assertIsNone(BlockList.parse(""))
+        self.assertIsNone(BlockList.parse("x\t10\n"))
+        # Three blocks are needed for 2500 bytes.
+        text = blocks(os.urandom(2500)).to_text()
+        self.assertIsNone(BlockList.parse(text.rsplit("\n", 2)[0]))
+
+    def test_moved_blocks(self) -> None:
+        local = os.urandom(3 * BLOCK_SIZE)
+        remote = local[BLOCK_SIZE:] + os.urandom(BLOCK_SIZE)
+        plan = DeltaPlan(blocks(remote), blocks(local).digests)
+        self.assertEqual(plan.sources, [BLOCK_SIZE, 2 * BLOCK_SIZE, None])
+        self.assertEqual(plan.fetch_size, BLOCK_SIZE)
+        self.assertEqual(plan.runs(), [(BLOCK_SIZE, 0, 1999),
+                                       (None, 2000, 2999)])
+
+
+class DownloadDeltaTest(unittest.TestCase):
+    """Updates local copies from the changed blocks of the remote file
+    with both engines, checking the rebuilt file against its md5.
+    """
+
+    def setUp(self) -> None:
+        Log.quiet_mode = True
+        self.root = tempfile.mkdtemp(prefix="uopatcher-test-")
+        self.remote = os.path.join(self.root, "remote")
+        self.local = os.path.join(self.root, "local")
+        os.makedirs(self.remote)
+        os.makedirs(self.local)
+        # Ten full blocks and a final partial one.
+        self.data = os.urandom(10 * BLOCK_SIZE + 500)
+        self.settings = (UOFile.LOCAL_ROOT, UOFile.DELTA_THRESHOLD,
+                         UOFile.DELTA_MAX_RATIO)
+
+        RecordingHandler.requests = []
+        self.server = PatchServer(self.remote,
+                                  handler_class=RecordingHandler).start()
+        self.pool = ConnectionPool()
+        self.engine = AsyncDownloadEngine()
+
+    def tearDown(self) -> None:
+        self.engine.close()
+        self.pool.close()
+        self.server.stop()
+        shutil.rmtree(self.root, ignore_errors=True)
+        (UOFile.LOCAL_ROOT, UOFile.DELTA_THRESHOLD,
+         UOFile.DELTA_MAX_RATIO) = self.settings
+        Log.quiet_mode = False
+
+    def publish(self, data: bytes, sidecar: bool = True) -> None:
+        """Writes the remote file and its block checksums."""
+        path = os.path.join(self.remote, "file.mul")
+        with open(path, 'wb') as f:
+            f.write(data)
+        if sidecar:
+            with open(path + BLOCKS_SUFFIX, 'w') as f:
+                f.write(blocks(data).to_text())
+
+    def write_local(self, data: bytes) -> str:
+        path = os.path.join(self.local, "file.mul")
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def read_local(self) -> bytes:
+        with open(os.path.join(self.local, "file.mul"), 'rb') as f:
+            return f.read()
+
+    def delta(self, engine: str, remote: bytes, max_ratio: float = 0.5):
+        """Runs a delta update of the local copy with the engine."""
+        url = f"{self.server.url}:{self.server.port}/file.mul"
+        local_resource = os.path.join(self.local, "file.mul")
+        if engine == 'sync':
+            return download_delta(url, local_resource, len(remote),
+                                  (md5(remote),), max_ratio,
+                                  chunk_size=300, pool=self.pool)
+        UOFile.DELTA_MAX_RATIO = max_ratio
+        return self.engine.run(self.engine.download_delta(
+            url, local_resource, len(remote), (md5(remote),),
+            chunk_size=300))
+
+    def check(self, remote: bytes, fetched: int) -> None:
+        """Updates the local copy with both engines, checking only the
+        amount of bytes expected was fetched.
+        """
+        self.publish(remote)
+        for engine in ('sync', 'async'):
+            with self.subTest(engine=engine):
+                self.write_local(self.data)
+                stats = self.delta(engine, remote)
+                self.assertIsNotNone(stats)
+                self.assertEqual(stats.downloaded, fetched)
+                self.assertEqual(stats.md5, md5(remote))
+                self.assertEqual(md5(self.read_local()), md5(remote))
+
+    def test_changed_middle_block(self) -> None:
+        remote = bytearray(self.data)
+        remote[5 * BLOCK_SIZE + 10] ^= 0xff
+        self.check(bytes(remote), BLOCK_SIZE)
+        self.assertIn(("/file.mul", "bytes=5000-5999"),
+                      RecordingHandler.requests)
+
+    def test_changed_final_partial_block(self) -> None:
+        remote = self.data[:-1] + bytes([self.data[-1] ^ 0xff])
+        self.check(remote, 500)
+        self.assertIn(("/file.mul", "bytes=10000-10499"),
+                      RecordingHandler.requests)
+
+    def test_grown_file(self) -> None:
+        # The old partial block is fetched again along with the new data.
+        self.check(self.data + os.urandom(1500), 2000)
+
+    def test_shrunk_file(self) -> None:
+        # The new partial block differs from the full local block.
+        self.check(self.data[:7 * BLOCK_SIZE + 200], 200)
+        self.assertIn(("/file.mul", "bytes=7000-7199"),
+                      RecordingHandler.requests)
+
+    def test_shrunk_to_block(self) -> None:
+        self.check(self.data[:7 * BLOCK_SIZE], 0)
+        self.assertNotIn("/file.mul", [path for path, _ in
+                                       RecordingHandler.requests])
+
+    def test_no_sidecar(self) -> None:
+        remote = self.data[:-1] + b"x"
+        self.publish(remote, sidecar=False)
+        self.write_local(self.data)
+        for engine in ('sync', 'async'):
+            with self.subTest(engine=engine):
+                self.assertIsNone(self.delta(engine, remote))
+                self.assertEqual(self.read_local(), self.data)
+
+    def test_above_max_ratio(self) -> None:
+        # Six of the eleven blocks change, more than half of the file.
+        remote = os.urandom(6 * BLOCK_SIZE) + self.data[6 * BLOCK_SIZE:]
+        self.publish(remote)
+        self.write_local(self.data)
+        for engine in ('sync', 'async'):
+            with self.subTest(engine=engine):
+                self.assertIsNone(self.delta(engine, remote))
+                self.assertEqual(self.read_local(), self.data)
+                self.assertIsNotNone(self.delta(engine, remote,
+                                                max_ratio=0.6))
+                self.assertEqual(md5(self.read_local()), md5(remote))
+                self.write_local(self.data)
+
+    def test_falls_back_to_full_download(self) -> None:
+        remote = os.urandom(6 * BLOCK_SIZE) + self.data[6 * BLOCK_SIZE:]
+        self.publish(remote)
+        UOFile.DELTA_THRESHOLD = 1
+        UOFile.LOCAL_ROOT = self.local
+        remote_root = f"{self.server.url}:{self.server.port}"
+        for engine in ('sync', 'async'):
+            with self.subTest(engine=engine):
+                self.write_local(self.data)
+                RecordingHandler.requests = []
+                uofile = UOFile("\\file.mul")
+                uofile.remote_hashes = (md5(remote),)
+                self.assertTrue(uofile.can_delta(len(remote)))
+                if engine == 'sync':
+                    stats = uofile._download_from(remote_root, False,
+                                                  len(remote), None, 0)
+                else:
+                    stats = self.engine.run(
+                        self.engine._download_resources(
+                            uofile, remote_root, len(remote), 0))
+                self.assertTrue(stats.complete)
+                self.assertEqual(stats.downloaded, len(remote))
+                self.assertEqual(md5(self.read_local()), md5(remote))
+                self.assertEqual(RecordingHandler.requests,
+                                 [("/file.mul" + BLOCKS_SUFFIX, ""),
+                                  ("/file.mul", "")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+"""Tests the array backed table of the tracked files."""
+import os
+import sys
+import unittest
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "uopatcher"))
+
+from uofile import UOFile, FileAction  # noqa: E402
+from filetable import FileTable  # noqa: E402
+
+MD5_A = "0123456789abcdef0123456789abcdef"
+MD5_B = "fedcba9876543210fedcba9876543210"
+
+
+class FileTableTest(unittest.TestCase):
+    """Builds tables and reads the rows back."""
+
+    def test_from_files(self) -> None:
+        files = {}
+        for raw_name in ("\\a.mul", "\\d\\+b.mul", "\\d\\-c.mul"):
+            uofile = UOFile(raw_name)
+            files[uofile.id] = uofile
+        files["a.mul"].remote_hashes = (MD5_A, MD5_B)
+
+        table = FileTable.from_files(files, {"a.mul": 10})
+        self.assertEqual(len(table), 3)
+        self.assertEqual(list(table), list(files))
+        row = table.rows["a.mul"]
+        self.assertEqual(table.size(row), 10)
+        self.assertEqual(table.remote_hashes(row), (MD5_A, MD5_B))
+        self.assertIsNone(table.remote_hashes(
+            table.rows[os.path.join("d", "b.mul")]))
+        self.assertEqual(table.nbytes, 3 * (1 + 8 + 1 + 32))
+
+        for file_id, uofile in files.items():
+            copy = table.uofile(table.rows[file_id])
+            self.assertEqual(copy.id, file_id)
+            self.assertEqual(copy.action, uofile.action)
+            self.assertEqual(copy.remote_hashes, uofile.remote_hashes)
+
+    def test_merge(self) -> None:
+        table = FileTable()
+        row = table.add("a.mul", FileAction.CREATE, size=5)
+        self.assertEqual(table.add("a.mul", FileAction.NONE,
+                                   (MD5_A, MD5_A)), row)
+        self.assertEqual(len(table), 1)
+        self.assertEqual(table.action(row), FileAction.CREATE)
+        self.assertEqual(table.size(row), 5)
+        self.assertEqual(table.remote_hashes(row), (MD5_A, MD5_A))
+
+    def test_other_hashes(self) -> None:
+        table = FileTable()
+        row = table.add("a.mul", hashes=("not", "md5"))
+        self.assertEqual(table.remote_hashes(row), ("not", "md5"))
+        table.add("a.mul", hashes=(MD5_B, MD5_A))
+        self.assertEqual(table.remote_hashes(row), (MD5_B, MD5_A))
+        self.assertNotIn(row, table.other_hashes)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+"""Tests replaying the journal of an interrupted patch and resuming it."""
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "uopatcher"))
+
+from log import Log  # noqa: E402
+from uofile import UOFile  # noqa: E402
+from hashes import Hashes  # noqa: E402
+from journal import Journal  # noqa: E402
+from planner import resume_plan  # noqa: E402
+
+FILES = {"Hashes": {"etag": '"1"'}, "Manifest": {"etag": '"2"'}}
+
+
+class JournalTest(unittest.TestCase):
+    """Replays journals left by a crash mid-patch."""
+
+    def setUp(self) -> None:
+        Log.quiet_mode = True
+        self.root = tempfile.mkdtemp(prefix="uopatcher-test-")
+        self.local_root = UOFile.LOCAL_ROOT
+        UOFile.LOCAL_ROOT = self.root
+        self.files = {}
+        for name in ("a.mul", "b.mul", "c.mul", "d.mul", "old.mul"):
+            uofile = UOFile(f"\\{name}")
+            self.files[uofile.id] = uofile
+
+    def tearDown(self) -> None:
+        UOFile.LOCAL_ROOT = self.local_root
+        shutil.rmtree(self.root, ignore_errors=True)
+        Log.quiet_mode = False
+
+    def write(self, file_id: str, data: bytes) -> str:
+        """Writes a local file, returning its md5."""
+        with open(self.files[file_id].local_resource, 'wb') as f:
+            f.write(data)
+        return hashlib.md5(data).hexdigest().lower()
+
+    def crash(self) -> dict[str, str]:
+        """Begins a plan, commits some of the files and leaves a torn
+        line behind as if the process died while writing it.
+        """
+        journal = Journal(self.root)
+        journal.begin("1.0.0.2", FILES, ["a.mul", "b.mul", "c.mul", "d.mul"],
+                      ["old.mul"])
+        md5s = {}
+        for file_id in ("a.mul", "b.mul", "c.mul"):
+            md5s[file_id] = self.write(file_id, file_id.encode() * 100)
+            journal.commit(file_id, self.files[file_id].local_resource,
+                           md5s[file_id])
+        journal.remove("old.mul")
+        journal.close()
+        with open(journal.file_path, 'a', encoding='utf-8') as f:
+            f.write('{"commit":"d.mul","stat":[1')
+        return md5s
+
+    def test_load(self) -> None:
+        md5s = self.crash()
+        journal = Journal(self.root)
+        self.assertTrue(journal.load())
+        self.assertTrue(journal.matches("1.0.0.2", FILES))
+        self.assertFalse(journal.matches("1.0.0.3", FILES))
+        self.assertEqual(journal.create, ["a.mul", "b.mul", "c.mul", "d.mul"])
+        self.assertEqual(set(journal.committed), {"a.mul", "b.mul", "c.mul"})
+        self.assertEqual(journal.committed["a.mul"][3], md5s["a.mul"])
+        self.assertEqual(journal.removed, {"old.mul"})
+
+    def test_resume_plan(self) -> None:
+        md5s = self.crash()
+        # Modified after the crash, so it cannot be trusted any more.
+        self.write("b.mul", b"changed")
+
+        journal = Journal(self.root)
+        self.assertTrue(journal.load())
+        hashes = Hashes("", self.root)
+        plan = resume_plan(self.files, hashes, journal, "1.0.0.2")
+
+        self.assertEqual([uofile.id for uofile in plan.create],
+                         ["b.mul", "d.mul"])
+        self.assertEqual(plan.delete, [])
+        self.assertEqual(hashes.local_hashes, {"a.mul": md5s["a.mul"],
+                                               "c.mul": md5s["c.mul"]})
+        key = self.files["a.mul"].stat_key()
+        self.assertEqual(hashes.cache.lookup("a.mul", key), md5s["a.mul"])
+
+    def test_finish(self) -> None:
+        self.crash()
+        journal = Journal(self.root)
+        journal.load()
+        journal.finish()
+        self.assertFalse(journal.file_path.exists())
+        self.assertFalse(Journal(self.root).load())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,1223 @@
+import os
+import ssl
+import sys
+import time
+import zlib
+import asyncio
+import hashlib
+import pathlib
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Optional
+
+from log import Log
+from hashes import Hashes
+from metrics import Metrics
+from planner import Plan
+from engine import DownloadEngine
+from ratelimit import TokenBucket
+from mirrors import MirrorSet
+from connpool import HTTPStatusError
+from updatefile import UpdateFile
+from validators import Validators
+from delta import BLOCKS_SUFFIX, BlockList, DeltaPlan, block_digests
+from bundle import Bundle, BundleExtractor
+from uofile import (UOFile, DownloadStats, RangeNotSupported,
+                    get_validators, partial_resource, progress_bar,
+                    md5_update, md5sum)
+
+
+async def wait_for(awaitable, timeout: float):
+    """Waits for the awaitable, raising a TimeoutError that describes the
+    failure if it takes longer than the timeout.
+    """
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutError(f"timed out after {timeout:0.0f}s")
+
+
+def allocate(part_resource: str, offset: int, size: int) -> None:
+    """Sizes the '.part' file for a segmented download, keeping the first
+    offset bytes that were already downloaded.
+    """
+    pathlib.Path(part_resource).parent.mkdir(parents=True, exist_ok=True)
+    with open(part_resource, 'r+b' if offset > 0 else 'wb') as f:
+        f.truncate(size)
+
+
+def truncate(part_resource: str, size: int) -> None:
+    """Cuts the '.part' file down to the bytes that can be resumed."""
+    with open(part_resource, 'r+b') as f:
+        f.truncate(size)
+
+
+class AsyncConnection:
+    """A persistent connection to a host along with its usage."""
+
+    def __init__(self, reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.requests: int = 0
+        self.last_used: float = time.monotonic()
+
+    @property
+    def is_open(self) -> bool:
+        """Checks if the underlying stream is still connected."""
+        return not self.writer.is_closing() and not self.reader.at_eof()
+
+    def close(self) -> None:
+        """Closes the underlying stream."""
+        self.writer.close()
+
+
+class AsyncResponse:
+    """Response read from a stream, the body is either sized by the
+    Content-Length, chunked, or sent until the connection closes. The
+    connection is returned to the pool once the body has been read.
+    """
+
+    def __init__(self, pool: 'AsyncConnectionPool', key: tuple[str, str, int],
+                 conn: AsyncConnection, version: str, status: int,
+                 reason: str, headers: dict[str, str], method: str) -> None:
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+
+        connection = headers.get("connection", "").lower()
+        self.will_close = (connection == "close"
+                           or (version == "HTTP/1.0"
+                               and connection != "keep-alive"))
+        self._chunked = "chunked" in headers.get("transfer-encoding",
+                                                 "").lower()
+        self._chunk_left: int = 0
+        self._remaining: Optional[int] = None
+        if method == 'HEAD' or status in (204, 304):
+            self._remaining = 0
+        elif not self._chunked and "content-length" in headers:
+            try:
+                self._remaining = max(0, int(headers["content-length"]))
+            except ValueError:
+                self.will_close = True
+        elif not self._chunked:
+            # Body ends when the host closes the connection.
+            self.will_close = True
+        self._done: bool = self._remaining == 0
+        self._released: bool = False
+
+    def getheader(self, name: str, default=None):
+        """Gets a header from the response."""
+        return self.headers.get(name.lower(), default)
+
+    async def read(self, amt: int = -1) -> bytes:
+        """Reads up to amt bytes of the body, the entire body if amt is
+        negative. Fewer bytes are only returned once the body has ended.
+        """
+        parts: list[bytes] = []
+        size: int = 0
+        while not self._done and (amt < 0 or size < amt):
+            data = await self._read_some(amt - size if amt >= 0
+                                         else 1024 * 1024)
+            if not data:
+                break
+            parts.append(data)
+            size += len(data)
+        return b"".join(parts)
+
+    def close(self) -> None:
+        """Closes the response, returning the connection to the pool if it
+        can be reused.
+        """
+        if self._released:
+            return
+        self._released = True
+        self.pool.release(self.key, self.conn,
+                          self._done and not self.will_close)
+
+    async def __aenter__(self) -> 'AsyncResponse':
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        self.close()
+
+    async def _read_some(self, amt: int) -> bytes:
+        """Reads whatever part of the body is available, up to amt."""
+        reader = self.conn.reader
+        if self._chunked:
+            if self._chunk_left == 0:
+                line = await self._wait(reader.readline())
+                try:
+                    self._chunk_left = int(line.split(b";", 1)[0], 16)
+                except ValueError:
+                    raise ConnectionError("Invalid chunk in response.")
+                if self._chunk_left == 0:
+                    # Skip the trailers that follow the last chunk.
+                    while (await self._wait(reader.readline())).strip():
+                        pass
+                    self._done = True
+                    return b""
+
+            data = await self._wait(reader.read(min(amt, self._chunk_left)))
+            if not data:
+                raise ConnectionError("Connection closed within a chunk.")
+            self._chunk_left -= len(data)
+            if self._chunk_left == 0:
+                await self._wait(reader.readline())
+            return data
+
+        if self._remaining is None:
+            data = await self._wait(reader.read(amt))
+            self._done = not data
+            return data
+
+        data = await self._wait(reader.read(min(amt, self._remaining)))
+        if not data:
+            # Closed early, the caller notices the missing bytes.
+            self.will_close = True
+            self._done = True
+            return b""
+        self._remaining -= len(data)
+        self._done = self._remaining == 0
+        return data
+
+    async def _wait(self, awaitable):
+        """Waits for a read, giving up after the pool's timeout."""
+        return await wait_for(awaitable, self.pool.timeout)
+
+
+class AsyncConnectionPool:
+    """Minimal HTTP/1.1 client on asyncio streams, keeping connections to
+    the remote hosts so they are reused between requests. The amount of
+    connections open to a host is limited, requests beyond it wait for a
+    connection to be released. Only ever used from the thread running the
+    event loop, so it needs no locking.
+    """
+    MAX_REDIRECTS: int = 5
+    STREAM_LIMIT: int = 1024 * 1024
+    RETRY_ERRORS = (ConnectionResetError,
+                    ConnectionAbortedError,
+                    BrokenPipeError,
+                    asyncio.IncompleteReadError)
+
+    def __init__(self, size: int = 8, idle_timeout: float = 30.0,
+                 timeout: float = 30.0, max_connections: int = 64) -> None:
+        self.size = max(1, size)
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.max_connections = max(self.size, max_connections)
+        self.connections_opened: int = 0
+        self.requests: int = 0
+        self.reconnects: int = 0
+        self._idle: dict[tuple[str, str, int], list[AsyncConnection]] = {}
+        self._slots: dict[tuple[str, str, int], asyncio.Semaphore] = {}
+
+    @property
+    def requests_per_connection(self) -> float:
+        """Average amount of requests that were sent over a connection."""
+        if self.connections_opened == 0:
+            return 0.0
+        return self.requests / self.connections_opened
+
+    async def request(self, url: str,
+                      headers: Optional[dict[str, str]] = None,
+                      method: str = 'GET',
+                      body: Optional[bytes] = None) -> AsyncResponse:
+        """Sends a request, following redirects, and returns the response.
+        Raises HTTPStatusError if the host responds with an error.
+        """
+        for _ in range(AsyncConnectionPool.MAX_REDIRECTS + 1):
+            response = await self._send(url, headers or {}, method, body)
+            if response.status not in (301, 302, 303, 307, 308):
+                break
+
+            # Follow the redirect, the old response is no longer needed.
+            location = response.getheader('location', None)
+            await response.read()
+            response.close()
+            if not location:
+                raise HTTPStatusError(response.status, "Missing location")
+            url = urllib.parse.urljoin(url, location)
+        else:
+            raise HTTPStatusError(response.status, "Too many redirects")
+
+        if response.status >= 400:
+            await response.read()
+            response.close()
+            raise HTTPStatusError(response.status, response.reason)
+        return response
+
+    def release(self, key: tuple[str, str, int], conn: AsyncConnection,
+                reusable: bool) -> None:
+        """Returns a connection to the pool, closing it if it cannot be
+        reused or the pool is already full.
+        """
+        conn.last_used = time.monotonic()
+        self._slot(key).release()
+        idle = self._idle.setdefault(key, [])
+        if reusable and conn.is_open and len(idle) < self.size:
+            idle.append(conn)
+            return
+        conn.close()
+
+    def close(self) -> None:
+        """Closes all idle connections."""
+        for conns in self._idle.values():
+            for conn in conns:
+                conn.close()
+        self._idle = {}
+
+    async def _send(self, url: str, headers: dict[str, str], method: str,
+                    body: Optional[bytes] = None) -> AsyncResponse:
+        """Sends a single request over a pooled connection. If a reused
+        connection was closed by the host, it is reconnected once.
+        """
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme.lower() or 'http'
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parts.hostname or '', port)
+        target = parts.path or '/'
+        if parts.query:
+            target = f"{target}?{parts.query}"
+        target = urllib.parse.quote(target, safe="/?&=%:+@!$,;~")
+
+        host = key[1] if port in (80, 443) else f"{key[1]}:{port}"
+        lines = [f"{method} {target} HTTP/1.1", f"Host: {host}"]
+        if "accept-encoding" not in {name.lower() for name in headers}:
+            lines.append("Accept-Encoding: identity")
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        if body is not None:
+            lines.append(f"Content-Length: {len(body)}")
+        payload = ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1')
+        if body:
+            payload += body
+
+        # Held until the response is released back to the pool.
+        await self._slot(key).acquire()
+        try:
+            for attempt in range(2):
+                conn = self._acquire(key)
+                reused = conn is not None
+                if not conn:
+                    conn = await self._connect(key)
+                    self.connections_opened += 1
+                try:
+                    conn.writer.write(payload)
+                    await conn.writer.drain()
+                    response = await self._read_head(key, conn, method)
+                except AsyncConnectionPool.RETRY_ERRORS:
+                    # The host closed a connection we expected to be alive.
+                    conn.close()
+                    if not reused or attempt > 0:
+                        raise
+                    self.reconnects += 1
+                    continue
+                except BaseException:
+                    conn.close()
+                    raise
+
+                self.requests += 1
+                conn.requests += 1
+                return response
+            raise ConnectionError(f"Could not connect to {key[1]}:{key[2]}")
+        except BaseException:
+            self._slot(key).release()
+            raise
+
+    async def _read_head(self, key: tuple[str, str, int],
+                         conn: AsyncConnection,
+                         method: str) -> AsyncResponse:
+        """Reads the status line and headers of a response."""
+        while True:
+            line = await wait_for(conn.reader.readline(), self.timeout)
+            if not line:
+                raise ConnectionResetError("Remote end closed connection.")
+            version, _, rest = line.decode('latin-1').strip().partition(' ')
+            code, _, reason = rest.partition(' ')
+            try:
+                status = int(code)
+            except ValueError:
+                raise ConnectionError(f"Bad status line: {line!r}")
+
+            headers: dict[str, str] = {}
+            while True:
+                line = await wait_for(conn.reader.readline(), self.timeout)
+                if not line.strip():
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            # Interim responses are followed by the actual one.
+            if 100 <= status < 200 and status != 101:
+                continue
+            return AsyncResponse(self, key, conn, version, status, reason,
+                                 headers, method)
+
+    def _slot(self, key: tuple[str, str, int]) -> asyncio.Semaphore:
+        """Gets the semaphore limiting the connections open to a host."""
+        slot = self._slots.get(key, None)
+        if not slot:
+            slot = asyncio.Semaphore(self.max_connections)
+            self._slots[key] = slot
+        return slot
+
+    def _acquire(self, key: tuple[str, str, int]
+                 ) -> Optional[AsyncConnection]:
+        """Gets an idle connection to the host if one is available."""
+        now = time.monotonic()
+        idle = self._idle.get(key, [])
+        while idle:
+            conn = idle.pop()
+            if now - conn.last_used > self.idle_timeout or not conn.is_open:
+                # Connections idle for too long are likely closed by the host.
+                conn.close()
+                continue
+            return conn
+        return None
+
+    async def _connect(self, key: tuple[str, str, int]) -> AsyncConnection:
+        """Opens a new connection to the host."""
+        scheme, host, port = key
+        context = ssl.create_default_context() if scheme == 'https' else None
+        reader, writer = await wait_for(
+            asyncio.open_connection(host, port, ssl=context,
+                                    limit=AsyncConnectionPool.STREAM_LIMIT),
+            self.timeout)
+        return AsyncConnection(reader, writer)
+
+
+class PartFile:
+    """A '.part' file written by the async engine. Every method does disk
+    or CPU work, so they are called on an executor and not the event loop.
+    """
+
+    def __init__(self, part_resource: str, offset: int,
+                 gzipped: bool) -> None:
+        self.part_resource = part_resource
+        self.offset = offset
+        self.size: int = offset
+        self.hash_md5 = hashlib.md5()
+        self.decoder = None
+        if gzipped:
+            self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._file = None
+
+    @property
+    def stream_complete(self) -> bool:
+        """Checks that a compressed stream was received in its entirety."""
+        return not self.decoder or self.decoder.eof
+
+    def open(self) -> None:
+        """Opens the file, hashing the content being resumed."""
+        pathlib.Path(self.part_resource).parent.mkdir(parents=True,
+                                                      exist_ok=True)
+        if self.offset > 0:
+            md5_update(self.hash_md5, self.part_resource, limit=self.offset)
+        self._file = open(self.part_resource,
+                          'r+b' if self.offset > 0 else 'wb')
+        self._file.seek(self.offset)
+        self._file.truncate()
+
+    def write(self, chunk: bytes) -> None:
+        """Decompresses if needed, writing and hashing the chunk."""
+        if self.decoder:
+            chunk = self.decoder.decompress(chunk)
+        self._write(chunk)
+
+    def close(self) -> None:
+        """Writes what remains of a compressed stream and closes the file."""
+        if not self._file:
+            return
+        if self.decoder:
+            self._write(self.decoder.flush())
+        self._file.close()
+        self._file = None
+
+    def copy_from(self, local_resource: str, source: int, length: int,
+                  chunk_size: int = 1024 * 1024) -> None:
+        """Writes and hashes length bytes of a local file starting at the
+        source offset.
+        """
+        with open(local_resource, 'rb') as local:
+            local.seek(source)
+            while length > 0:
+                chunk = local.read(min(chunk_size, length))
+                if not chunk:
+                    raise OSError(f"Local copy changed: '{local_resource}'")
+                self._write(chunk)
+                length -= len(chunk)
+
+    def _write(self, data: bytes) -> None:
+        """Writes and hashes decompressed data."""
+        self._file.write(data)
+        self.hash_md5.update(data)
+        self.size += len(data)
+
+
+class AsyncDownloadEngine:
+    """Patch engine running on a single asyncio event loop. Transfers are
+    streams on the loop, so thousands can be in flight without a thread
+    for each connection, while disk writes and hashing are handed to a
+    small executor. Produces the same files, hashes and statistics as the
+    DownloadEngine.
+    """
+
+    def __init__(self, jobs: int = 1, verbose: bool = False,
+                 metrics: Optional[Metrics] = None,
+                 pool_size: int = 8, idle_timeout: float = 30.0,
+                 disk_workers: int = 4, max_connections: int = 64,
+                 transfers: int = 256) -> None:
+        self.jobs = max(1, jobs)
+        # Files in flight, the sockets are bounded per host by the pool.
+        self.transfers = max(1, transfers)
+        self.verbose = verbose
+        self.metrics = metrics
+        self.pool = AsyncConnectionPool(pool_size, idle_timeout,
+                                        max_connections=max_connections)
+        self.loop = asyncio.new_event_loop()
+        self.total_size: int = 0
+        self.failed: list[str] = []
+        self._disk = ThreadPoolExecutor(max_workers=max(1, disk_workers))
+
+    @property
+    def show_progress(self) -> bool:
+        """Progress bars are only shown for a single transfer, otherwise
+        the lines from the transfers would overwrite each other.
+        """
+        return self.verbose and self.transfers == 1
+
+    def run(self, coroutine):
+        """Runs a coroutine on the engine's event loop until it is done."""
+        try:
+            return self.loop.run_until_complete(coroutine)
+        except KeyboardInterrupt:
+            Log.warn("Interrupt detected, exiting.")
+            sys.exit(1)
+
+    def close(self) -> None:
+        """Closes the connections, the executor, and the event loop."""
+        self.pool.close()
+        self._disk.shutdown(wait=True)
+        # Give the closed transports a chance to finish.
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+
+    def update(self, update_file: UpdateFile,
+               validators: Optional[Validators] = None) -> bool:
+        """Updates the Manifest or Hashes, only downloading it if the
+        remote changed when validators are passed.
+        """
+        return self.run(self._update(update_file, validators))
+
+    def pull_updates(self, plan: Plan, hashes: Hashes) -> tuple[int, int]:
+        """Executes the plan, pulling updates from the remote server.
+        Returns the amount of bytes downloaded and the amount of files
+        that failed.
+        """
+        return self.run(self._pull_updates(plan, hashes))
+
+    async def download_file(self, remote_resource: str,
+                            local_resource: str,
+                            chunk_size: int = 1024 * 1024,
+                            expected_size: int = -1,
+                            expected_hashes: Optional[tuple[str, ...]] = None,
+                            headers: Optional[dict[str, str]] = None,
+                            accept_gzip: bool = False,
+                            gzipped: bool = False,
+                            verify: Optional[Callable[[str], bool]] = None,
+                            ) -> DownloadStats:
+        """Downloads a file from a remote host into a local repository, the
+        same as download_file but streamed on the event loop. The '.part'
+        file is resumed if possible and only moved into place once the size
+        and hash checks pass and verify accepts it.
+        """
+        start: datetime = datetime.now()
+        part_resource = partial_resource(local_resource)
+        name = pathlib.Path(remote_resource).name
+
+        # Resume from the previous partial download if one exists. Without
+        # hashes a '.part' of another version could not be told apart.
+        offset: int = 0
+        if expected_hashes and os.path.isfile(part_resource):
+            offset = os.stat(part_resource).st_size
+            if 0 < expected_size < offset:
+                offset = 0
+
+        # Compressed content can only be requested from the start.
+        request_headers = dict(headers or {})
+        if accept_gzip and offset == 0:
+            request_headers["Accept-Encoding"] = "gzip"
+
+        response, offset = await self._open_remote(remote_resource, offset,
+                                                   request_headers)
+        validators = get_validators(response)
+
+        if response.status == 304:
+            await response.read()
+            response.close()
+            elapsed = (datetime.now() - start).total_seconds()
+            size = os.stat(local_resource).st_size
+            return DownloadStats(size, elapsed, True, 0, modified=False,
+                                 validators=validators)
+
+        # Calculate size of the downloaded content.
+        max_size: int = 0
+        content_length = response.getheader("content-length", None)
+        if content_length:
+            try:
+                max_size = offset + int(content_length)
+            except ValueError:
+                max_size = 0
+
+        # Decompress the content if it is being sent compressed.
+        encoding = response.getheader("content-encoding", "").lower()
+        part = PartFile(part_resource, offset,
+                        offset == 0 and (gzipped
+                                         or encoding in ("gzip", "x-gzip")))
+        wire_size: int = max_size
+        if part.decoder:
+            max_size = max(0, expected_size)
+
+        transferred: int = 0
+        try:
+            await self._in_executor(part.open)
+            while True:
+                chunk = await self._read_limited(response, chunk_size)
+                if not chunk:
+                    break
+
+                # If VERBOSE is enabled in config, print the progress bar.
+                if self.show_progress:
+                    progress_bar(name, part.size, max_size, start)
+
+                transferred += len(chunk)
+                await self._in_executor(part.write, chunk)
+        finally:
+            response.close()
+            await self._in_executor(part.close)
+
+        elapsed = (datetime.now() - start).total_seconds()
+        downloaded = part.size - offset
+
+        # Keep the partial download if it was cut short, it can be resumed.
+        if ((wire_size > 0 and offset + transferred != wire_size)
+                or not part.stream_complete
+                or (expected_size >= 0 and part.size != expected_size)):
+            if 0 < expected_size < part.size:
+                await self._in_executor(os.remove, part_resource)
+            return DownloadStats(part.size, elapsed, False, downloaded,
+                                 validators=validators,
+                                 transferred=transferred)
+
+        # Verify the contents before replacing the local file.
+        md5 = part.hash_md5.hexdigest().lower()
+        if expected_hashes and md5 not in expected_hashes:
+            Log.warn(f"Hash mismatch: '{name}'")
+            await self._in_executor(os.remove, part_resource)
+            return DownloadStats(part.size, elapsed, False, downloaded, md5,
+                                 validators=validators,
+                                 transferred=transferred)
+        if verify and not await self._in_executor(verify, part_resource):
+            Log.warn(f"Unreadable download: '{name}'")
+            await self._in_executor(os.remove, part_resource)
+            return DownloadStats(part.size, elapsed, False, downloaded, md5,
+                                 validators=validators,
+                                 transferred=transferred)
+
+        await self._in_executor(os.replace, part_resource, local_resource)
+        return DownloadStats(part.size, elapsed, True, downloaded, md5,
+                             validators=validators, transferred=transferred)
+
+    async def download_segmented(self, remote_resource: str,
+                                 local_resource: str, size: int,
+                                 segments: int,
+                                 chunk_size: int = 1024 * 1024,
+                                 expected_hashes: Optional[
+                                     tuple[str, ...]] = None,
+                                 sources: Optional[list[str]] = None,
+                                 on_range: Optional[
+                                     Callable[[str, int, float, bool],
+                                              None]] = None,
+                                 ) -> DownloadStats:
+        """Downloads a large file as several byte ranges at the same time,
+        the same as download_segmented but streamed on the event loop. Each
+        range is written into its position of the preallocated '.part' file
+        and a failed range is retried once from the next source. If the
+        host ignores ranges, the single stream download is used instead.
+        """
+        start: datetime = datetime.now()
+        part_resource = partial_resource(local_resource)
+        name = pathlib.Path(remote_resource).name
+
+        # Continue after the partial download if one can be verified.
+        offset: int = 0
+        if expected_hashes and os.path.isfile(part_resource):
+            offset = os.stat(part_resource).st_size
+            if offset > size:
+                offset = 0
+
+        # Split the remaining bytes into the segments, preallocating the file.
+        remaining = size - offset
+        segment_size = max(1, -(-remaining // segments))
+        ranges = [(first, min(first + segment_size, size) - 1)
+                  for first in range(offset, size, segment_size)]
+        await self._in_executor(allocate, part_resource, offset, size)
+
+        written: list[int] = [0] * len(ranges)
+        progress: list[int] = [offset]
+        sources = sources if sources else [remote_resource]
+
+        def on_chunk(amount: int) -> None:
+            progress[0] += amount
+            if self.show_progress:
+                progress_bar(name, progress[0], size, start)
+
+        async def fetch_from(source: str, index: int) -> None:
+            first, last = ranges[index]
+            before, started = written[index], time.perf_counter()
+            try:
+                await self._fetch_range(source, part_resource, first, last,
+                                        written, index, chunk_size,
+                                        on_chunk)
+            except Exception:
+                if on_range:
+                    on_range(source, written[index] - before,
+                             time.perf_counter() - started, False)
+                raise
+            if on_range:
+                on_range(source, written[index] - before,
+                         time.perf_counter() - started, True)
+
+        async def fetch(index: int) -> None:
+            try:
+                await fetch_from(sources[index % len(sources)], index)
+            except RangeNotSupported:
+                raise
+            except Exception:
+                # Try the rest of the range once more, from the next source.
+                await fetch_from(sources[(index + 1) % len(sources)], index)
+
+        failure: Optional[BaseException] = None
+        try:
+            results = await asyncio.gather(
+                *(fetch(index) for index in range(len(ranges))),
+                return_exceptions=True)
+            failure = next((result for result in results
+                            if isinstance(result, BaseException)), None)
+        finally:
+            # Only keep the contiguous prefix so the part can be resumed.
+            complete = offset
+            for (first, last), amount in zip(ranges, written):
+                complete += amount
+                if amount < last - first + 1:
+                    break
+            if complete < size:
+                await self._in_executor(truncate, part_resource, complete)
+
+        if isinstance(failure, RangeNotSupported):
+            Log.debug(f"Ranges not supported, single stream: '{name}'")
+            return await self.download_file(remote_resource, local_resource,
+                                            chunk_size, size,
+                                            expected_hashes)
+
+        elapsed = (datetime.now() - start).total_seconds()
+        downloaded = sum(written)
+        if complete < size:
+            return DownloadStats(complete, elapsed, False, downloaded,
+                                 transferred=downloaded)
+
+        # Ranges arrive out of order, the hash can only be checked at the end.
+        md5 = await self._in_executor(md5sum, part_resource)
+        if expected_hashes and md5 not in expected_hashes:
+            Log.warn(f"Hash mismatch: '{name}'")
+            await self._in_executor(os.remove, part_resource)
+            return DownloadStats(size, elapsed, False, downloaded, md5,
+                                 transferred=downloaded)
+
+        await self._in_executor(os.replace, part_resource, local_resource)
+        return DownloadStats(size, elapsed, True, downloaded, md5,
+                             transferred=downloaded)
+
+    async def _fetch_range(self, remote_resource: str, part_resource: str,
+                           start: int, end: int, written: list[int],
+                           index: int, chunk_size: int,
+                           on_chunk: Callable[[int], None]) -> None:
+        """Downloads the inclusive byte range [start, end] into the same
+        position of the part file, the same as fetch_range but streamed on
+        the event loop. The bytes written are tracked in written[index].
+        """
+        offset = start + written[index]
+        if offset > end:
+            return
+
+        response = await self.pool.request(
+            remote_resource, {"Range": f"bytes={offset}-{end}"})
+        try:
+            content_range = response.getheader("content-range", "")
+            if (response.status != 206
+                    or not content_range.startswith(f"bytes {offset}-")):
+                raise RangeNotSupported(
+                    f"Range ignored for {remote_resource}")
+
+            f = await self._in_executor(open, part_resource, 'r+b')
+            try:
+                await self._in_executor(f.seek, offset)
+                while offset <= end:
+                    chunk = await self._read_limited(
+                        response, min(chunk_size, end - offset + 1))
+                    if not chunk:
+                        break
+                    await self._in_executor(f.write, chunk)
+                    offset += len(chunk)
+                    written[index] += len(chunk)
+                    on_chunk(len(chunk))
+            finally:
+                await self._in_executor(f.close)
+        finally:
+            response.close()
+
+        if offset <= end:
+            raise ConnectionError(f"Range {start}-{end} was cut short.")
+
+    async def download_delta(self, remote_resource: str,
+                             local_resource: str, expected_size: int,
+                             expected_hashes: Optional[tuple[str, ...]],
+                             chunk_size: int = 1024 * 1024,
+                             ) -> Optional[DownloadStats]:
+        """Updates a local file by only fetching the blocks that differ
+        from the remote, the same as download_delta but streamed on the
+        event loop. Returns None if the file needs to be downloaded in full.
+        """
+        start: datetime = datetime.now()
+        part_resource = partial_resource(local_resource)
+        name = pathlib.Path(remote_resource).name
+
+        blocks = await self._fetch_blocks(remote_resource)
+        if not blocks or blocks.size != expected_size:
+            return None
+
+        local_digests = await self._in_executor(block_digests,
+                                                local_resource,
+                                                blocks.block_size)
+        plan = DeltaPlan(blocks, local_digests)
+        fetch_size = plan.fetch_size
+        if fetch_size > blocks.size * UOFile.DELTA_MAX_RATIO:
+            Log.debug(f"Delta of {fetch_size} bytes too large: '{name}'")
+            return None
+
+        part = PartFile(part_resource, 0, False)
+        downloaded: int = 0
+        ranges_ignored: bool = False
+        try:
+            await self._in_executor(part.open)
+            for source, first, last in plan.runs():
+                if source is not None:
+                    # Unchanged blocks are copied from the local file.
+                    await self._in_executor(part.copy_from, local_resource,
+                                            source, last - first + 1)
+                    continue
+
+                response = await self.pool.request(
+                    remote_resource, {"Range": f"bytes={first}-{last}"})
+                try:
+                    content_range = response.getheader("content-range", "")
+                    if (response.status != 206 or not
+                            content_range.startswith(f"bytes {first}-")):
+                        ranges_ignored = True
+                        break
+                    while part.size <= last:
+                        chunk = await self._read_limited(
+                            response, min(chunk_size, last - part.size + 1))
+                        if not chunk:
+                            raise ConnectionError(
+                                f"Range {first}-{last} was cut short.")
+                        downloaded += len(chunk)
+                        await self._in_executor(part.write, chunk)
+                finally:
+                    response.close()
+
+                # If VERBOSE is enabled in config, print the progress bar.
+                if self.show_progress:
+                    progress_bar(name, part.size, blocks.size, start)
+        finally:
+            await self._in_executor(part.close)
+
+        if ranges_ignored:
+            Log.debug(f"Ranges not supported, no delta: '{name}'")
+            await self._in_executor(os.remove, part_resource)
+            return None
+
+        elapsed = (datetime.now() - start).total_seconds()
+        md5 = part.hash_md5.hexdigest().lower()
+        if expected_hashes and md5 not in expected_hashes:
+            Log.warn(f"Delta mismatch: '{name}', downloading it in full.")
+            await self._in_executor(os.remove, part_resource)
+            return None
+
+        await self._in_executor(os.replace, part_resource, local_resource)
+        Log.debug(f"Delta of '{name}': fetched {downloaded} of "
+                  f"{blocks.size} bytes.")
+        return DownloadStats(blocks.size, elapsed, True, downloaded, md5,
+                             transferred=downloaded)
+
+    async def _fetch_blocks(self,
+                            remote_resource: str) -> Optional[BlockList]:
+        """Obtains the block checksums the remote publishes for a file,
+        None if there are none.
+        """
+        try:
+            response = await self.pool.request(
+                f"{remote_resource}{BLOCKS_SUFFIX}")
+        except HTTPStatusError as exc:
+            if exc.code != 404:
+                raise
+            return None
+
+        try:
+            data = await response.read()
+        finally:
+            response.close()
+        return BlockList.parse(data.decode('utf-8', errors='replace'))
+
+    async def _update(self, update_file: UpdateFile,
+                      validators: Optional[Validators]) -> bool:
+        """Downloads the update file, loading it on the executor."""
+        try:
+            headers = validators.headers(update_file) if validators else None
+            stats = await self._download_uofile(update_file, -1, 0, headers)
+            return await self._in_executor(update_file.apply, stats,
+                                           validators)
+        except Exception as exc:
+            Log.error(f"Could not update {update_file.name}: {exc}")
+        return False
+
+    async def _pull_updates(self, plan: Plan,
+                            hashes: Hashes) -> tuple[int, int]:
+        """Removes the files marked for deletion, then downloads all of
+        the files that need to be created at the same time.
+        """
+        self.total_size = 0
+        self.failed = []
+        for uofile in plan.skip:
+            Log.info(f"Skipped: '{uofile.name}'", end='\r')
+
+        # Deletes finish before any download modifies the Hashes.
+        remover = DownloadEngine(hashes, verbose=self.verbose)
+        await asyncio.gather(*(self._in_executor(remover.remove, uofile, True)
+                               for uofile in plan.delete))
+
+        # Small files are requested together in bundles.
+        limit = asyncio.Semaphore(self.transfers)
+        batches, single = Bundle.split(plan.create, plan.sizes, self.jobs)
+        await asyncio.gather(
+            *(self._download_bundle(batch, plan.sizes, hashes, limit)
+              for batch in batches),
+            *(self._download(uofile, plan.sizes.get(uofile.id, 0), hashes,
+                             limit)
+              for uofile in single))
+        if self.failed:
+            Log.warn(f"Failed to download {len(self.failed)} file(s).")
+
+        Log.clear()
+        return self.total_size, len(self.failed)
+
+    async def _download(self, uofile: UOFile, remote_size: int,
+                        hashes: Hashes, limit: asyncio.Semaphore) -> None:
+        """Downloads a single file, retrying once if the full expected
+        file was not obtained.
+        """
+        async with limit:
+            start = time.perf_counter()
+            retries: int = 0
+            expected_size = remote_size if remote_size > 0 else -1
+            stats = await self._fetch(uofile, expected_size, hashes)
+            downloaded = stats.downloaded if stats else 0
+            transferred = stats.transferred if stats else 0
+            if not stats or not stats.complete:
+                Log.warn(f"Failed: '{uofile.name}', trying again.")
+                # Resumes the partial download, or starts over if discarded.
+                retries += 1
+                stats = await self._fetch(uofile, expected_size, hashes)
+                downloaded += stats.downloaded if stats else 0
+                transferred += stats.transferred if stats else 0
+
+        failed = not stats or not stats.complete
+        if failed:
+            Log.error(f"Failed: '{uofile.name}'")
+            self.failed.append(uofile.id)
+
+        if self.metrics:
+            self.metrics.record_file(uofile.id, downloaded,
+                                     time.perf_counter() - start,
+                                     retries, failed, transferred)
+        self.total_size += downloaded
+
+    async def _download_bundle(self, uofiles: list[UOFile],
+                               sizes: dict[str, int], hashes: Hashes,
+                               limit: asyncio.Semaphore) -> None:
+        """Downloads the files as a bundle, the files it did not provide
+        are downloaded one at a time.
+        """
+        completed: dict[str, DownloadStats] = {}
+        remote_root = Bundle.remote_root()
+        if Bundle.supported(remote_root):
+            async with limit:
+                start = time.perf_counter()
+                completed = await self.download_bundle(
+                    remote_root,
+                    [(uofile, sizes.get(uofile.id, -1))
+                     for uofile in uofiles])
+            if completed:
+                Log.debug(f"Bundle of {len(completed)}/{len(uofiles)} "
+                          f"files in {time.perf_counter() - start:0.2f} "
+                          "sec.")
+
+        missing: list[UOFile] = []
+        for uofile in uofiles:
+            stats = completed.get(os.path.normcase(uofile.id), None)
+            if not stats:
+                missing.append(uofile)
+                continue
+
+            hashes.store_local(uofile, stats.md5)
+            if self.metrics:
+                self.metrics.record_file(uofile.id, stats.downloaded,
+                                         stats.elapsed, 0, False,
+                                         stats.transferred)
+            Log.notify(f"Downloaded: '{uofile.name}'")
+            self.total_size += stats.downloaded
+
+        await asyncio.gather(*(self._download(uofile,
+                                              sizes.get(uofile.id, 0),
+                                              hashes, limit)
+                               for uofile in missing))
+
+    async def download_bundle(self, remote_root: str,
+                              files: list[tuple[UOFile, int]],
+                              chunk_size: int = 1024 * 1024,
+                              ) -> dict[str, DownloadStats]:
+        """Downloads the files as a single bundle, the same as
+        download_bundle but streamed on the event loop. Returns the
+        statistics of the files that were received and verified.
+        """
+        extractor = BundleExtractor(files)
+        try:
+            response = await self.pool.request(
+                f"{remote_root}/{Bundle.PATH}",
+                {"Content-Type": "text/plain; charset=utf-8"},
+                method='POST',
+                body=Bundle.request_body(uofile for uofile, _ in files))
+            try:
+                while not extractor.done:
+                    chunk = await self._read_limited(response, chunk_size)
+                    if not chunk:
+                        break
+                    await self._in_executor(extractor.feed, chunk)
+            finally:
+                response.close()
+        except HTTPStatusError as exc:
+            if not Bundle.unsupported(remote_root, exc):
+                Log.warn(f"Bundle of {len(files)} files failed: {exc}")
+        except Exception as exc:
+            Log.warn(f"Bundle of {len(files)} files failed: {exc}")
+        finally:
+            await self._in_executor(extractor.close)
+        return extractor.completed
+
+    async def _fetch(self, uofile: UOFile, expected_size: int,
+                     hashes: Hashes) -> Optional[DownloadStats]:
+        """Performs the download of the file, returns the statistics."""
+        if not self.show_progress:
+            Log.notify(f"Downloading: '{uofile.name}'", end='\r')
+
+        compressed_size = hashes.compressed_sizes.get(uofile.id, 0)
+        try:
+            stats = await self._download_uofile(uofile, expected_size,
+                                                compressed_size)
+        except Exception as exc:
+            Log.error(f"Could not download {uofile.name}: {exc}")
+            return None
+        if not stats.complete:
+            return stats
+
+        # The verified digest means the new file never needs to be reread.
+        md5 = stats.md5 if stats.md5 else await self._in_executor(
+            uofile.get_md5sum)
+        hashes.store_local(uofile, md5)
+
+        if not self.show_progress:
+            Log.notify(f"Downloaded: '{uofile.name}'")
+        return stats
+
+    async def _download_uofile(self, uofile: UOFile, expected_size: int,
+                               compressed_size: int,
+                               headers: Optional[dict[str, str]] = None,
+                               ) -> DownloadStats:
+        """Downloads a file, preferring the pre-compressed '.gz' sibling
+        if the remote lists one and failing over between the mirrors, the
+        same as UOFile.download.
+        """
+        try:
+            mirrors = MirrorSet.shared()
+            if mirrors:
+                return await self._download_mirrors(mirrors, uofile,
+                                                    expected_size,
+                                                    compressed_size, headers)
+            return await self._download_resources(uofile, UOFile.REMOTE_ROOT,
+                                                  expected_size,
+                                                  compressed_size, headers)
+        finally:
+            # The local file may have been replaced.
+            uofile.refresh()
+
+    async def _download_mirrors(self, mirrors: MirrorSet, uofile: UOFile,
+                                expected_size: int, compressed_size: int,
+                                headers: Optional[dict[str, str]],
+                                ) -> DownloadStats:
+        """Downloads the file from the best mirror, failing over to the
+        next one on errors or incomplete transfers. Large files are spread
+        across the healthy mirrors.
+        """
+        stats: Optional[DownloadStats] = None
+        for mirror in mirrors.ranked():
+            sources = {m.resource(uofile.id): m
+                       for m in mirrors.spread(mirror)}
+            ranges: list[str] = []
+
+            def on_range(source: str, amount: int, seconds: float,
+                         success: bool) -> None:
+                ranges.append(source)
+                mirrors.record(sources[source], amount, seconds, success)
+
+            start = time.perf_counter()
+            try:
+                stats = await self._download_resources(uofile, mirror.url,
+                                                       expected_size,
+                                                       compressed_size,
+                                                       headers,
+                                                       list(sources),
+                                                       on_range)
+            except Exception as exc:
+                Log.warn(f"Mirror '{mirror.url}' failed for "
+                         f"'{uofile.name}': {exc}")
+                mirrors.record(mirror, 0, 0.0, False)
+                continue
+
+            # Segmented downloads already recorded each of their ranges.
+            if not ranges:
+                mirrors.record(mirror, stats.transferred,
+                               time.perf_counter() - start, stats.complete)
+            if stats.complete:
+                return stats
+            Log.warn(f"Incomplete from '{mirror.url}': '{uofile.name}', "
+                     "trying the next mirror.")
+
+        if not stats:
+            raise ConnectionError("No mirror could provide the file.")
+        return stats
+
+    async def _download_resources(self, uofile: UOFile, remote_root: str,
+                                  expected_size: int, compressed_size: int,
+                                  headers: Optional[dict[str, str]] = None,
+                                  sources: Optional[list[str]] = None,
+                                  on_range: Optional[Callable] = None,
+                                  ) -> DownloadStats:
+        """Fetches only the changed blocks if possible, else downloads the
+        '.gz' sibling if there is one, else the file, in several ranges if
+        it is at or above the segment threshold. The ranges may be spread
+        across the other sources passed.
+        """
+        remote_resource = f"{remote_root}/{uofile.id}"
+        if uofile.can_delta(expected_size):
+            stats = await self.download_delta(remote_resource,
+                                              uofile.local_resource,
+                                              expected_size,
+                                              uofile.remote_hashes)
+            if stats:
+                return stats
+
+        if (UOFile.COMPRESSION and compressed_size > 0
+                and not os.path.isfile(
+                    partial_resource(uofile.local_resource))):
+            try:
+                return await self.download_file(
+                    f"{remote_resource}.gz", uofile.local_resource,
+                    expected_size=expected_size,
+                    expected_hashes=uofile.remote_hashes, gzipped=True)
+            except HTTPStatusError as exc:
+                if exc.code != 404:
+                    raise
+            Log.debug(f"Compressed copy missing: '{uofile.name}'")
+
+        if (UOFile.SEGMENTS > 1
+                and expected_size >= UOFile.SEGMENT_THRESHOLD):
+            return await self.download_segmented(
+                remote_resource, uofile.local_resource, expected_size,
+                UOFile.SEGMENTS, expected_hashes=uofile.remote_hashes,
+                sources=sources, on_range=on_range)
+        return await self.download_file(remote_resource,
+                                        uofile.local_resource,
+                                        expected_size=expected_size,
+                                        expected_hashes=uofile.remote_hashes,
+                                        headers=headers,
+                                        accept_gzip=UOFile.COMPRESSION,
+                                        verify=uofile.accepts)
+
+    async def _open_remote(self, remote_resource: str, offset: int = 0,
+                           extra_headers: Optional[dict[str, str]] = None,
+                           ) -> tuple[AsyncResponse, int]:
+        """Opens the remote resource, requesting the content starting at
+        the offset if it is above zero. Returns the response and the offset
+        the response actually starts at.
+        """
+        headers: dict[str, str] = dict(extra_headers or {})
+        if offset > 0:
+            headers["Range"] = f"bytes={offset}-"
+
+        try:
+            response = await self.pool.request(remote_resource, headers)
+        except HTTPStatusError as exc:
+            if offset > 0 and exc.code == 416:
+                # Partial download is not usable, obtain the entire file.
+                return await self._open_remote(remote_resource,
+                                               extra_headers=extra_headers)
+            raise
+
+        if response.status == 304:
+            # Local copy is current, nothing will be sent.
+            return response, offset
+
+        if offset > 0 and response.status == 206:
+            # Make sure the server is resuming from the requested position.
+            content_range = response.getheader("content-range", "")
+            if content_range.startswith(f"bytes {offset}-"):
+                return response, offset
+            response.close()
+            return await self._open_remote(remote_resource,
+                                           extra_headers=extra_headers)
+
+        # Server ignored the range, a full copy is being sent.
+        return response, 0
+
+    async def _read_limited(self, response: AsyncResponse,
+                            chunk_size: int) -> bytes:
+        """Reads a chunk from the response, honoring the bandwidth limit
+        that is shared by every transfer without blocking the loop.
+        """
+        bucket = TokenBucket.shared()
+        if not bucket:
+            return await response.read(chunk_size)
+
+        chunk = await response.read(bucket.chunk_size(chunk_size))
+        wait = bucket.reserve(len(chunk))
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return chunk
+
+    async def _in_executor(self, func, *args):
+        """Runs blocking disk or hashing work on the executor."""
+        return await self.loop.run_in_executor(self._disk, func, *args)
@@ -0,0 +1,310 @@
+import os
+import gzip
+import hashlib
+import pathlib
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from log import Log
+from delta import BLOCKS_SUFFIX, BlockList
+from hashcache import HashCache
+from localindex import LocalIndex, STATE_FILES, PARTIAL_SUFFIXES
+from uofile import FileAction, parse_uofile
+from updatefile import Version
+
+# Suffix of the pre-compressed copy of a file.
+GZIP_SUFFIX: str = '.gz'
+
+
+def build_file(local_resource: str, hash_file: bool, block_size: int,
+               compress: bool,
+               buffer_size: int = 1024 * 1024) -> tuple[Optional[str], int]:
+    """Reads a file once, hashing it if requested, writing the '.blocks'
+    sidecar if a block size is passed and the '.gz' sibling if it should
+    be compressed. Returns the md5 (None if it was not hashed) and the size
+    of the '.gz', 0 if none was written.
+    """
+    hash_md5 = hashlib.md5() if hash_file else None
+    digests: list[str] = []
+    compressed = raw = None
+    if compress:
+        compressed_path = f"{local_resource}{GZIP_SUFFIX}.tmp"
+        raw = open(compressed_path, 'wb')
+        # No name or time in the header so unchanged files compress the same.
+        compressed = gzip.GzipFile(filename='', mode='wb', mtime=0,
+                                   fileobj=raw)
+
+    size: int = 0
+    try:
+        f = open(local_resource, 'rb')
+    except FileNotFoundError:
+        if compressed:
+            compressed.close()
+            raw.close()
+            os.remove(compressed_path)
+        return None, 0
+
+    try:
+        with f:
+            while True:
+                chunk = f.read(block_size or buffer_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if hash_md5:
+                    hash_md5.update(chunk)
+                if block_size:
+                    digests.append(hashlib.md5(chunk).hexdigest().lower())
+                if compressed:
+                    compressed.write(chunk)
+    finally:
+        if compressed:
+            compressed.close()
+            raw.close()
+
+    if block_size:
+        blocks = BlockList(block_size, size, digests)
+        _write_atomic(f"{local_resource}{BLOCKS_SUFFIX}",
+                      blocks.to_text().encode())
+
+    compressed_size: int = 0
+    if compressed:
+        compressed_size = os.path.getsize(compressed_path)
+        os.replace(compressed_path, f"{local_resource}{GZIP_SUFFIX}")
+    return (hash_md5.hexdigest().lower() if hash_md5 else None,
+            compressed_size)
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    """Writes a file through a temporary file so it is never partial."""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+class Builder:
+    """Creates the Manifest and Hashes for a source tree, the layout a
+    remote host serves. Hashes are kept in a HashCache inside the source
+    root, so only files whose stat data changed since the last build are
+    read again, and those are read in parallel. Optionally the '.blocks'
+    sidecars of large files and the '.gz' siblings of all files are written
+    in the same pass. A '.gz' is listed only if it saves enough, but it is
+    kept either way so it is not compressed again on the next build.
+    """
+    BLOCK_THRESHOLD: int = 32 * 1024 * 1024
+    COMPRESS_RATIO: float = 0.9
+
+    def __init__(self, source_root: str, workers: int = 1,
+                 use_processes: bool = False, blocks: bool = False,
+                 compress: bool = False,
+                 block_size: int = BlockList.DEFAULT_BLOCK_SIZE,
+                 block_threshold: int = BLOCK_THRESHOLD) -> None:
+        self.source_root = source_root
+        self.workers = workers
+        self.use_processes = use_processes
+        self.blocks = blocks
+        self.compress = compress
+        self.block_size = block_size
+        self.block_threshold = block_threshold
+        self.cache = HashCache(source_root)
+        self.hashed: int = 0
+
+    def build(self, version: Optional[Version] = None) -> Optional[Version]:
+        """Writes the Manifest and Hashes if the tree changed, bumping the
+        last component of the version unless one is passed. Returns the
+        version written, None if nothing changed.
+        """
+        previous_version, previous = self._read_manifest()
+        files = self.scan(set(previous))
+        self.cache.load()
+        hashes, compressed = self._hash(files)
+        # Files removed while being read are left for the next build.
+        files = {file_id: entry for file_id, entry in files.items()
+                 if file_id in hashes}
+        sizes = {file_id: key[0] for file_id, (_, key) in files.items()}
+
+        # Files that were removed stay listed to be deleted by patchers.
+        actions: dict[str, tuple[str, FileAction]] = {}
+        for file_id, (name, _) in previous.items():
+            if file_id not in files:
+                actions[file_id] = (name, FileAction.DELETE)
+        for file_id, (name, _) in files.items():
+            _, action = previous.get(file_id, (name, FileAction.NONE))
+            if action == FileAction.DELETE:
+                action = FileAction.NONE
+            actions[file_id] = (name, action)
+
+        manifest = [Builder._manifest_line(*actions[file_id])
+                    for file_id in sorted(actions)]
+        hashes_lines = []
+        for file_id in sorted(files):
+            md5 = hashes[file_id].upper()
+            line = f"{files[file_id][0]}\t{md5}\t{md5}\t{sizes[file_id]}"
+            if compressed.get(file_id, 0) > 0:
+                line += f"\t{compressed[file_id]}"
+            hashes_lines.append(line)
+
+        manifest_text = "".join(f"{line}\n" for line in manifest)
+        hashes_text = "".join(f"{line}\n" for line in hashes_lines)
+        self.cache.prune(set(files))
+        self.cache.save()
+        if (version is None and previous_version is not None
+                and manifest_text == self._read_body('Manifest')
+                and hashes_text == self._read_body('Hashes', first=0)):
+            return None
+
+        if version is None:
+            value = (previous_version.value if previous_version
+                     else (1, 0, 0, 0))
+            version = Version((*value[:-1], value[-1] + 1))
+
+        # The Hashes is replaced first, a patcher that sees the new Manifest
+        # always finds the matching Hashes.
+        root = pathlib.Path(self.source_root)
+        _write_atomic(str(root / 'Hashes'), hashes_text.encode('utf-8'))
+        _write_atomic(str(root / 'Manifest'),
+                      f"[{version}]\n{manifest_text}".encode('utf-8'))
+        return version
+
+    def scan(self, published: set[str]
+             ) -> dict[str, tuple[str, tuple[int, int, int]]]:
+        """Finds the files to publish. Maps the id of each file to its
+        Manifest name and stat data, ignoring the state files, partial
+        files and the sidecars written by the builder. Sidecars of
+        published files that were removed are removed as well.
+        """
+        found = dict(LocalIndex.walk(self.source_root))
+        files: dict[str, tuple[str, tuple[int, int, int]]] = {}
+        for path, key in found.items():
+            base, suffix = os.path.splitext(path)
+            if path in STATE_FILES or path.endswith(PARTIAL_SUFFIXES):
+                continue
+            if suffix in (BLOCKS_SUFFIX, GZIP_SUFFIX):
+                if base in published and base not in found:
+                    Builder._remove(os.path.join(self.source_root, path))
+                    continue
+                if base in found:
+                    continue
+            if os.path.basename(path)[:1] in ('+', '-'):
+                Log.warn(f"Skipped: '{path}', the name would be read as "
+                         "an action.")
+                continue
+            files[path] = ("\\" + path.replace(os.sep, "\\"), key)
+        return files
+
+    def _hash(self, files: dict[str, tuple[str, tuple[int, int, int]]]
+              ) -> tuple[dict[str, str], dict[str, int]]:
+        """Gets the md5 of every file and the size of its '.gz', reading
+        only the files that changed or are missing a sidecar.
+        """
+        hashes: dict[str, str] = {}
+        compressed: dict[str, int] = {}
+        targets: list[tuple[str, str, bool, int, bool]] = []
+        for file_id, (_, key) in files.items():
+            resource = os.path.join(self.source_root, file_id)
+            md5 = self.cache.lookup(file_id, key)
+            if md5:
+                hashes[file_id] = md5
+
+            block_size = 0
+            if self.blocks and key[0] >= self.block_threshold:
+                if not md5 or not os.path.isfile(resource + BLOCKS_SUFFIX):
+                    block_size = self.block_size
+            elif not md5:
+                Builder._remove(resource + BLOCKS_SUFFIX)
+
+            compress = False
+            if self.compress:
+                gz_size = (_size(resource + GZIP_SUFFIX) if md5 else -1)
+                compress = gz_size < 0
+                if not compress:
+                    compressed[file_id] = gz_size
+            elif not md5:
+                Builder._remove(resource + GZIP_SUFFIX)
+
+            if not md5 or block_size or compress:
+                targets.append((file_id, resource, not md5, block_size,
+                                compress))
+
+        if targets:
+            Log.info(f"Reading {len(targets)} file(s).")
+        args = [[target[n] for target in targets] for n in range(1, 5)]
+        if self.workers <= 1 or len(targets) <= 1:
+            results = list(map(build_file, *args))
+        else:
+            pool = (ProcessPoolExecutor if self.use_processes
+                    else ThreadPoolExecutor)
+            with pool(max_workers=self.workers) as executor:
+                results = list(executor.map(
+                    build_file, *args,
+                    chunksize=1 if not self.use_processes else 16))
+
+        for (file_id, resource, *_), (md5, gz_size) in zip(targets, results):
+            if md5:
+                self.hashed += 1
+                hashes[file_id] = md5
+                self.cache.store(file_id, resource, md5)
+            if gz_size:
+                compressed[file_id] = gz_size
+
+        # Only list the '.gz' copies that are worth downloading instead.
+        return hashes, {file_id: gz_size
+                        for file_id, gz_size in compressed.items()
+                        if gz_size <= files[file_id][1][0]
+                        * Builder.COMPRESS_RATIO}
+
+    def _read_manifest(self) -> tuple[Optional[Version],
+                                      dict[str, tuple[str, FileAction]]]:
+        """Reads the version and the files of the existing Manifest."""
+        path = pathlib.Path(self.source_root, 'Manifest')
+        if not path.is_file():
+            return None, {}
+
+        version = None
+        files: dict[str, tuple[str, FileAction]] = {}
+        with open(path, 'r', encoding='utf-8') as f:
+            for n, line in enumerate(f):
+                if n == 0:
+                    version = Version(Version.parse(line.strip()))
+                    continue
+                uofile = parse_uofile(line)
+                if uofile.name:
+                    name = "\\" + str(uofile.path).replace(os.sep, "\\")
+                    files[uofile.id] = (name, uofile.action)
+        return version, files
+
+    def _read_body(self, filename: str, first: int = 1) -> Optional[str]:
+        """Gets the contents of an existing file, skipping the first lines
+        (the version of the Manifest).
+        """
+        try:
+            with open(pathlib.Path(self.source_root, filename), 'r',
+                      encoding='utf-8') as f:
+                return "".join(f.readlines()[first:])
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _manifest_line(name: str, action: FileAction) -> str:
+        """Places the action in front of the name of the file."""
+        prefix = {FileAction.CREATE: '+', FileAction.DELETE: '-'}.get(action,
+                                                                      '')
+        parent, _, base = name.rpartition("\\")
+        return f"{parent}\\{prefix}{base}"
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        """Removes a sidecar that no longer matches its file."""
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _size(path: str) -> int:
+    """Gets the size of a file, -1 if it does not exist."""
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return -1
@@ -0,0 +1,368 @@
+import os
+import time
+import tarfile
+import hashlib
+import threading
+from typing import BinaryIO, Iterable, Optional
+
+from log import Log
+from mirrors import MirrorSet
+from connpool import ConnectionPool, HTTPStatusError
+from uofile import UOFile, DownloadStats, partial_resource, read_limited
+
+# Events produced by the TarStream.
+MEMBER, DATA, END = range(3)
+
+
+class TarStream:
+    """Incremental reader of an uncompressed tar stream. Bytes are fed as
+    they arrive and the members are produced as events without buffering
+    their contents: (MEMBER, name, size) when a regular file starts,
+    (DATA, chunk, 0) for each part of its contents and (END, name, size)
+    once it is complete. Long names from pax and GNU headers are supported,
+    other kinds of members are skipped.
+    """
+    BLOCK: int = 512
+
+    def __init__(self) -> None:
+        self.done: bool = False
+        self._buffer = bytearray()
+        self._name: str = ""
+        self._size: int = 0
+        self._remaining: int = 0
+        self._padding: int = 0
+        self._emit: bool = False
+        self._meta: Optional[bytes] = None
+        self._meta_type: bytes = b""
+        self._long_name: Optional[str] = None
+
+    def feed(self, data: bytes) -> list[tuple]:
+        """Processes the next bytes of the stream, returning the events."""
+        events: list[tuple] = []
+        view = memoryview(data)
+        while len(view) > 0 and not self.done:
+            if self._remaining > 0:
+                # Contents of the current member.
+                take = min(self._remaining, len(view))
+                chunk = bytes(view[:take])
+                view = view[take:]
+                self._remaining -= take
+                if self._meta is not None:
+                    self._meta += chunk
+                elif self._emit:
+                    events.append((DATA, chunk, 0))
+                if self._remaining == 0:
+                    self._end_member(events)
+                continue
+
+            if self._padding > 0:
+                take = min(self._padding, len(view))
+                view = view[take:]
+                self._padding -= take
+                continue
+
+            take = min(TarStream.BLOCK - len(self._buffer), len(view))
+            self._buffer += view[:take]
+            view = view[take:]
+            if len(self._buffer) == TarStream.BLOCK:
+                header = bytes(self._buffer)
+                self._buffer.clear()
+                self._start_member(header, events)
+        return events
+
+    def _start_member(self, header: bytes, events: list[tuple]) -> None:
+        """Parses a header block and starts the member it describes."""
+        if header == bytes(TarStream.BLOCK):
+            # End of the archive.
+            self.done = True
+            return
+
+        checksum = _number(header[148:156])
+        if checksum != sum(header[:148]) + 256 + sum(header[156:]):
+            raise ValueError("Bad tar header checksum.")
+
+        name = header[:100].split(b'\0', 1)[0].decode('utf-8', 'replace')
+        if header[257:262] == b'ustar':
+            prefix = header[345:500].split(b'\0', 1)[0]
+            if prefix:
+                name = f"{prefix.decode('utf-8', 'replace')}/{name}"
+        size = _number(header[124:136])
+        kind = header[156:157]
+
+        self._size, self._remaining = size, size
+        self._padding = -size % TarStream.BLOCK
+        self._emit = False
+        if kind in (b'x', b'L', b'g'):
+            # Extended headers describe the next member.
+            self._meta, self._meta_type = b"", kind
+        elif kind in (b'0', b'\0', b'7'):
+            self._name = self._long_name or name
+            self._long_name = None
+            self._emit = True
+            events.append((MEMBER, self._name, size))
+        else:
+            self._long_name = None
+        if size == 0:
+            self._end_member(events)
+
+    def _end_member(self, events: list[tuple]) -> None:
+        """Finishes the contents of the current member."""
+        if self._meta is not None:
+            meta, self._meta = self._meta, None
+            if self._meta_type == b'L':
+                self._long_name = meta.split(b'\0', 1)[0].decode('utf-8',
+                                                                 'replace')
+            elif self._meta_type == b'x':
+                path = _pax_path(meta)
+                if path:
+                    self._long_name = path
+        elif self._emit:
+            events.append((END, self._name, self._size))
+            self._emit = False
+
+
+def _number(field: bytes) -> int:
+    """Reads a numeric header field, octal or base-256."""
+    if field and field[0] & 0x80:
+        return int.from_bytes(field[1:], 'big')
+    value = field.split(b'\0', 1)[0].strip()
+    return int(value, 8) if value else 0
+
+
+def _pax_path(meta: bytes) -> Optional[str]:
+    """Gets the path from the records of a pax header."""
+    while meta:
+        length, _, _ = meta.partition(b' ')
+        try:
+            record = meta[:int(length)]
+        except ValueError:
+            return None
+        meta = meta[len(record):]
+        key, _, value = record.partition(b' ')[2].partition(b'=')
+        if key == b'path':
+            return value.rstrip(b'\n').decode('utf-8', 'replace')
+    return None
+
+
+class BundleExtractor:
+    """Writes the members of a bundle straight to disk. Each requested
+    file is written to its '.part' file and hashed as it arrives, then
+    moved into place once its size and hash are verified. Members that
+    were not requested are skipped, their names are never used as paths.
+    """
+
+    def __init__(self, files: list[tuple[UOFile, int]]) -> None:
+        self.files = {os.path.normcase(uofile.id): (uofile, size)
+                      for uofile, size in files}
+        self.completed: dict[str, DownloadStats] = {}
+        self.received: int = 0
+        self._stream = TarStream()
+        self._start = time.perf_counter()
+        self._current: Optional[tuple[UOFile, int]] = None
+        self._file: Optional[BinaryIO] = None
+        self._hash_md5 = hashlib.md5()
+
+    @property
+    def done(self) -> bool:
+        """Checks if the end of the bundle was reached."""
+        return self._stream.done
+
+    def feed(self, data: bytes) -> None:
+        """Processes the next bytes of the bundle."""
+        self.received += len(data)
+        for kind, value, size in self._stream.feed(data):
+            if kind == MEMBER:
+                self._open(value)
+            elif kind == DATA and self._file:
+                self._file.write(value)
+                self._hash_md5.update(value)
+            elif kind == END and self._file:
+                self._finish(size)
+
+    def close(self) -> None:
+        """Closes a member that was cut short, its '.part' is kept so the
+        file can be resumed.
+        """
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _open(self, name: str) -> None:
+        """Starts writing a requested member."""
+        file_id = os.path.normcase(name.replace('/', os.sep))
+        entry = self.files.get(file_id, None)
+        if not entry or file_id in self.completed:
+            return
+
+        uofile = entry[0]
+        os.makedirs(os.path.dirname(uofile.local_resource) or '.',
+                    exist_ok=True)
+        self._current = entry
+        self._file = open(partial_resource(uofile.local_resource), 'wb')
+        self._hash_md5 = hashlib.md5()
+
+    def _finish(self, size: int) -> None:
+        """Verifies a completed member and moves it into place."""
+        self._file.close()
+        self._file = None
+        uofile, expected_size = self._current
+        part_resource = partial_resource(uofile.local_resource)
+        md5 = self._hash_md5.hexdigest().lower()
+        if ((expected_size >= 0 and size != expected_size)
+                or (uofile.remote_hashes
+                    and md5 not in uofile.remote_hashes)):
+            Log.warn(f"Hash mismatch in bundle: '{uofile.name}'")
+            os.remove(part_resource)
+            return
+
+        os.replace(part_resource, uofile.local_resource)
+        uofile.refresh()
+        self.completed[os.path.normcase(uofile.id)] = DownloadStats(
+            size, time.perf_counter() - self._start, True, size, md5,
+            transferred=size)
+
+
+class Bundle:
+    """Requests many small files at once, which avoids a request for every
+    file. The ids of the files are sent in a POST to the 'bundle' path of
+    the remote, one per line, and the files are received as a single tar
+    stream. Hosts that do not support it are remembered for the run and
+    their files are downloaded one at a time.
+    """
+    PATH: str = "bundle"
+    THRESHOLD: int = 512 * 1024
+    MAX_FILES: int = 256
+    MAX_SIZE: int = 32 * 1024 * 1024
+    MIN_FILES: int = 16
+    UNSUPPORTED: set[str] = set()
+    _lock = threading.Lock()
+
+    @staticmethod
+    def remote_root() -> str:
+        """Host the bundles are requested from, the best mirror."""
+        mirrors = MirrorSet.shared()
+        return mirrors.best.url if mirrors else UOFile.REMOTE_ROOT
+
+    @staticmethod
+    def supported(remote_root: str) -> bool:
+        """Checks if bundles are enabled and the host was not found to
+        lack support for them.
+        """
+        return (Bundle.THRESHOLD > 0 and Bundle.MAX_FILES > 1
+                and remote_root not in Bundle.UNSUPPORTED)
+
+    @staticmethod
+    def split(uofiles: Iterable[UOFile], sizes: dict[str, int], jobs: int
+              ) -> tuple[list[list[UOFile]], list[UOFile]]:
+        """Divides the files into batches of small files to be bundled and
+        the files to download one at a time. Enough batches are made to
+        keep the jobs busy.
+        """
+        single: list[UOFile] = []
+        small: list[UOFile] = []
+        for uofile in uofiles:
+            size = sizes.get(uofile.id, 0)
+            if (0 < size <= Bundle.THRESHOLD
+                    and not os.path.isfile(
+                        partial_resource(uofile.local_resource))):
+                small.append(uofile)
+            else:
+                single.append(uofile)
+
+        if not Bundle.supported(Bundle.remote_root()) or len(small) < 2:
+            return [], single + small
+
+        total = sum(sizes.get(uofile.id, 0) for uofile in small)
+        count = max(-(-len(small) // Bundle.MAX_FILES),
+                    -(-total // Bundle.MAX_SIZE),
+                    min(jobs, len(small) // Bundle.MIN_FILES), 1)
+        batches: list[list[UOFile]] = [[] for _ in range(count)]
+        for n, uofile in enumerate(small):
+            batches[n % count].append(uofile)
+        return batches, single
+
+    @staticmethod
+    def request_body(uofiles: Iterable[UOFile]) -> bytes:
+        """Creates the body of a bundle request."""
+        return "\n".join(uofile.id.replace(os.sep, '/')
+                         for uofile in uofiles).encode('utf-8')
+
+    @staticmethod
+    def parse_request(body: bytes, limit: int = 4096) -> list[str]:
+        """Gets the file ids of a bundle request, as sent by the patcher."""
+        names = body.decode('utf-8', 'replace').splitlines()
+        return [name.strip() for name in names if name.strip()][:limit]
+
+    @staticmethod
+    def unsupported(remote_root: str, exc: HTTPStatusError) -> bool:
+        """Remembers a host that has no bundles, returns True if the
+        error means it does not support them.
+        """
+        if exc.code not in (404, 405, 501):
+            return False
+        with Bundle._lock:
+            if remote_root not in Bundle.UNSUPPORTED:
+                Log.debug(f"Bundles not supported by '{remote_root}'.")
+            Bundle.UNSUPPORTED.add(remote_root)
+        return True
+
+
+def download_bundle(remote_root: str, files: list[tuple[UOFile, int]],
+                    chunk_size: int = 1024 * 1024,
+                    pool: Optional[ConnectionPool] = None,
+                    ) -> dict[str, DownloadStats]:
+    """Downloads the files as a single bundle, unpacking them to disk as
+    the stream arrives. Returns the statistics of the files that were
+    received and verified, the rest need to be downloaded on their own.
+    """
+    pool = pool if pool else ConnectionPool.shared()
+    extractor = BundleExtractor(files)
+    try:
+        response = pool.request(
+            f"{remote_root}/{Bundle.PATH}",
+            {"Content-Type": "text/plain; charset=utf-8"}, method='POST',
+            body=Bundle.request_body(uofile for uofile, _ in files))
+        with response:
+            while not extractor.done:
+                chunk = read_limited(response, chunk_size)
+                if not chunk:
+                    break
+                extractor.feed(chunk)
+    except HTTPStatusError as exc:
+        if not Bundle.unsupported(remote_root, exc):
+            Log.warn(f"Bundle of {len(files)} files failed: {exc}")
+    except Exception as exc:
+        Log.warn(f"Bundle of {len(files)} files failed: {exc}")
+    finally:
+        extractor.close()
+    return extractor.completed
+
+
+def write_bundle(out: BinaryIO,
+                 members: Iterable[tuple[str, str,
+                                         Optional[tuple[int, int, int]]]]
+                 ) -> int:
+    """Writes the members as a tar stream, each is the name to store, the
+    local resource, and the (size, mtime_ns, inode) the file needs to still
+    have or None. Files that are missing or changed are left out. Returns
+    the amount of files written.
+    """
+    written: int = 0
+    with tarfile.open(fileobj=out, mode='w|',
+                      format=tarfile.PAX_FORMAT) as tar:
+        for name, local_resource, key in members:
+            try:
+                f = open(local_resource, 'rb')
+            except OSError:
+                continue
+            with f:
+                stat = os.fstat(f.fileno())
+                if key and (stat.st_size, stat.st_mtime_ns,
+                            stat.st_ino) != key:
+                    continue
+                info = tarfile.TarInfo(name)
+                info.size = stat.st_size
+                info.mtime = int(stat.st_mtime)
+                tar.addfile(info, f)
+                written += 1
+    return written
@@ -45,6 +45,171 @@ class Config:
         """Remote port number for the remote source of the updates."""
         return self.config.getint('DEFAULT', 'REMOTE_PORT', fallback=8080)
 
+    @property
+    def mirrors(self) -> list[str]:
+        """Additional hosts serving the same updates, such as
+        'http://mirror1.example.com:8080, http://mirror2.example.com'. The
+        remote root and port is always the first mirror.
+        """
+        raw = self.config.get('DEFAULT', 'MIRRORS', fallback="")
+        return [url.strip() for url in raw.replace(',', ' ').split()]
+
+    @property
+    def jobs(self) -> int:
+        """Amount of files that are allowed to download at the same time."""
+        return max(1, self.config.getint('DEFAULT', 'JOBS', fallback=4))
+
+    @property
+    def hash_workers(self) -> int:
+        """Amount of files that are allowed to be hashed at the same time."""
+        return max(1, self.config.getint('DEFAULT', 'HASH_WORKERS',
+                                         fallback=4))
+
+    @property
+    def hash_processes(self) -> bool:
+        """Hash files using processes instead of threads."""
+        return self.config.getboolean('DEFAULT', 'HASH_PROCESSES',
+                                      fallback=False)
+
+    @property
+    def pool_size(self) -> int:
+        """Amount of idle connections kept open to the remote host."""
+        return max(1, self.config.getint('DEFAULT', 'POOL_SIZE', fallback=8))
+
+    @property
+    def pool_idle_timeout(self) -> float:
+        """Seconds an idle connection is kept before it is closed."""
+        return self.config.getfloat('DEFAULT', 'POOL_IDLE_TIMEOUT',
+                                    fallback=30.0)
+
+    @property
+    def segments(self) -> int:
+        """Amount of ranges a large file is split into while downloading."""
+        return max(1, self.config.getint('DEFAULT', 'SEGMENTS', fallback=4))
+
+    @property
+    def segment_threshold(self) -> int:
+        """Size in megabytes a file needs to be to download in segments."""
+        return max(1, self.config.getint('DEFAULT', 'SEGMENT_THRESHOLD',
+                                         fallback=64))
+
+    @property
+    def bundle_threshold(self) -> int:
+        """Size in kilobytes a file can be to be requested together with
+        other small files in a bundle, 0 requests every file on its own.
+        """
+        return max(0, self.config.getint('DEFAULT', 'BUNDLE_THRESHOLD',
+                                         fallback=512))
+
+    @property
+    def bundle_files(self) -> int:
+        """Most files requested in a single bundle."""
+        return max(2, self.config.getint('DEFAULT', 'BUNDLE_FILES',
+                                         fallback=256))
+
+    @property
+    def delta_threshold(self) -> int:
+        """Size in megabytes a file needs to be to only fetch its changed
+        blocks, 0 always downloads changed files in full.
+        """
+        return max(0, self.config.getint('DEFAULT', 'DELTA_THRESHOLD',
+                                         fallback=32))
+
+    @property
+    def delta_max_ratio(self) -> float:
+        """Fraction of a file that can differ before it is downloaded in
+        full instead of fetching only the changed blocks.
+        """
+        return min(1.0, max(0.0, self.config.getfloat(
+            'DEFAULT', 'DELTA_MAX_RATIO', fallback=0.5)))
+
+    @property
+    def engine(self) -> str:
+        """Engine used to patch, 'sync' uses threads and 'async' uses a
+        single event loop.
+        """
+        return self.config.get('DEFAULT', 'ENGINE', fallback='sync').lower()
+
+    @property
+    def async_transfers(self) -> int:
+        """Amount of files the async engine downloads at the same time."""
+        return max(1, self.config.getint('DEFAULT', 'ASYNC_TRANSFERS',
+                                         fallback=256))
+
+    @property
+    def compression(self) -> bool:
+        """Request compressed transfers, using pre-compressed copies of
+        files when the remote lists them.
+        """
+        return self.config.getboolean('DEFAULT', 'COMPRESSION',
+                                      fallback=True)
+
+    @property
+    def max_rate(self) -> str:
+        """Bandwidth limit for all downloads such as '512K' or '2M' per
+        second, 0 is unlimited.
+        """
+        return self.config.get('DEFAULT', 'MAX_RATE', fallback="0")
+
+    @property
+    def rate_schedule(self) -> str:
+        """Limits that apply during parts of the day, overriding the
+        max_rate, such as '08:00-23:00=512K; 23:00-08:00=0'.
+        """
+        return self.config.get('DEFAULT', 'RATE_SCHEDULE', fallback="")
+
+    @property
+    def serve_host(self) -> str:
+        """Address the local root is shared on when serving to peers."""
+        return self.config.get('DEFAULT', 'SERVE_HOST', fallback="0.0.0.0")
+
+    @property
+    def serve_port(self) -> int:
+        """Port the local root is shared on when serving to peers."""
+        return self.config.getint('DEFAULT', 'SERVE_PORT', fallback=8090)
+
+    @property
+    def watch_interval(self) -> float:
+        """Seconds between checks for updates while watching."""
+        return max(1.0, self.config.getfloat('DEFAULT', 'WATCH_INTERVAL',
+                                             fallback=300.0))
+
+    @property
+    def watch_max_interval(self) -> float:
+        """Longest wait between checks while the remote keeps failing."""
+        return max(self.watch_interval,
+                   self.config.getfloat('DEFAULT', 'WATCH_MAX_INTERVAL',
+                                        fallback=3600.0))
+
+    @property
+    def verify_interval(self) -> float:
+        """Hours between checks of every tracked file, in between only
+        the files that changed remotely are checked. 0 checks every file
+        on every run.
+        """
+        return max(0.0, self.config.getfloat('DEFAULT', 'VERIFY_INTERVAL',
+                                             fallback=168.0))
+
+    @property
+    def report_file(self) -> str:
+        """File the JSON report of the run is written to, empty to skip.
+        A relative path is placed in the local root.
+        """
+        return self.config.get('DEFAULT', 'REPORT_FILE', fallback="")
+
+    @property
+    def prometheus_file(self) -> str:
+        """File the Prometheus metrics are written to, empty to skip.
+        A relative path is placed in the local root.
+        """
+        return self.config.get('DEFAULT', 'PROMETHEUS_FILE', fallback="")
+
+    def resolve(self, file_path: str) -> str:
+        """Places a relative path in the local root, so output files do not
+        depend on the directory the patcher was started from.
+        """
+        return str(pathlib.Path(self.local_root, file_path))
+
     @staticmethod
     def exists(file_path: pathlib.Path) -> bool:
         """Checks if the configuration file already exists."""
@@ -74,6 +239,30 @@ class Config:
         config['DEFAULT']['LOCAL_ROOT'] = str(self.local_root)
         config['DEFAULT']['REMOTE_ROOT'] = str(self.remote_root)
         config['DEFAULT']['REMOTE_PORT'] = str(self.remote_port)
+        config['DEFAULT']['MIRRORS'] = ", ".join(self.mirrors)
+        config['DEFAULT']['JOBS'] = str(self.jobs)
+        config['DEFAULT']['HASH_WORKERS'] = str(self.hash_workers)
+        config['DEFAULT']['HASH_PROCESSES'] = str(self.hash_processes)
+        config['DEFAULT']['POOL_SIZE'] = str(self.pool_size)
+        config['DEFAULT']['POOL_IDLE_TIMEOUT'] = str(self.pool_idle_timeout)
+        config['DEFAULT']['SEGMENTS'] = str(self.segments)
+        config['DEFAULT']['SEGMENT_THRESHOLD'] = str(self.segment_threshold)
+        config['DEFAULT']['COMPRESSION'] = str(self.compression)
+        config['DEFAULT']['BUNDLE_THRESHOLD'] = str(self.bundle_threshold)
+        config['DEFAULT']['BUNDLE_FILES'] = str(self.bundle_files)
+        config['DEFAULT']['DELTA_THRESHOLD'] = str(self.delta_threshold)
+        config['DEFAULT']['DELTA_MAX_RATIO'] = str(self.delta_max_ratio)
+        config['DEFAULT']['ENGINE'] = str(self.engine)
+        config['DEFAULT']['ASYNC_TRANSFERS'] = str(self.async_transfers)
+        config['DEFAULT']['MAX_RATE'] = str(self.max_rate)
+        config['DEFAULT']['RATE_SCHEDULE'] = str(self.rate_schedule)
+        config['DEFAULT']['SERVE_HOST'] = str(self.serve_host)
+        config['DEFAULT']['SERVE_PORT'] = str(self.serve_port)
+        config['DEFAULT']['WATCH_INTERVAL'] = str(self.watch_interval)
+        config['DEFAULT']['WATCH_MAX_INTERVAL'] = str(self.watch_max_interval)
+        config['DEFAULT']['VERIFY_INTERVAL'] = str(self.verify_interval)
+        config['DEFAULT']['REPORT_FILE'] = str(self.report_file)
+        config['DEFAULT']['PROMETHEUS_FILE'] = str(self.prometheus_file)
 
         with open(self.file_path, 'w', encoding='utf-8') as f:
             config.write(f)
@@ -94,6 +283,30 @@ class Config:
         config['DEFAULT']['LOCAL_ROOT'] = "client"
         config['DEFAULT']['REMOTE_ROOT'] = "patch.example.com"
         config['DEFAULT']['REMOTE_PORT'] = "8080"
+        config['DEFAULT']['MIRRORS'] = ""
+        config['DEFAULT']['JOBS'] = "4"
+        config['DEFAULT']['HASH_WORKERS'] = "4"
+        config['DEFAULT']['HASH_PROCESSES'] = "False"
+        config['DEFAULT']['POOL_SIZE'] = "8"
+        config['DEFAULT']['POOL_IDLE_TIMEOUT'] = "30.0"
+        config['DEFAULT']['SEGMENTS'] = "4"
+        config['DEFAULT']['SEGMENT_THRESHOLD'] = "64"
+        config['DEFAULT']['COMPRESSION'] = "True"
+        config['DEFAULT']['BUNDLE_THRESHOLD'] = "512"
+        config['DEFAULT']['BUNDLE_FILES'] = "256"
+        config['DEFAULT']['DELTA_THRESHOLD'] = "32"
+        config['DEFAULT']['DELTA_MAX_RATIO'] = "0.5"
+        config['DEFAULT']['ENGINE'] = "sync"
+        config['DEFAULT']['ASYNC_TRANSFERS'] = "256"
+        config['DEFAULT']['MAX_RATE'] = "0"
+        config['DEFAULT']['RATE_SCHEDULE'] = ""
+        config['DEFAULT']['SERVE_HOST'] = "0.0.0.0"
+        config['DEFAULT']['SERVE_PORT'] = "8090"
+        config['DEFAULT']['WATCH_INTERVAL'] = "300.0"
+        config['DEFAULT']['WATCH_MAX_INTERVAL'] = "3600.0"
+        config['DEFAULT']['VERIFY_INTERVAL'] = "168.0"
+        config['DEFAULT']['REPORT_FILE'] = ""
+        config['DEFAULT']['PROMETHEUS_FILE'] = ""
 
         # Save it locally.
         with open(file_path, 'w', encoding='utf-8') as f:
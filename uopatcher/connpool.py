@@ -0,0 +1,251 @@
+import ssl
+import time
+import threading
+import http.client
+import urllib.parse
+from typing import Optional
+
+
+class HTTPStatusError(ConnectionError):
+    """Raised when the remote host responds with an error status."""
+
+    def __init__(self, code: int, reason: str) -> None:
+        super().__init__(f"HTTP Error {code}: {reason}")
+        self.code = code
+        self.reason = reason
+
+
+class PooledConnection:
+    """A persistent connection to a host along with its usage."""
+
+    def __init__(self, conn: http.client.HTTPConnection) -> None:
+        self.conn = conn
+        self.requests: int = 0
+        self.last_used: float = time.monotonic()
+
+    @property
+    def is_open(self) -> bool:
+        """Checks if the underlying socket is still connected."""
+        return self.conn.sock is not None
+
+
+class PooledResponse:
+    """Response from the pool, returns the connection to the pool once the
+    response has been completely read and closed.
+    """
+
+    def __init__(self, pool: 'ConnectionPool', key: tuple[str, str, int],
+                 pooled: PooledConnection,
+                 response: http.client.HTTPResponse, url: str) -> None:
+        self.pool = pool
+        self.key = key
+        self.pooled = pooled
+        self.response = response
+        self.url = url
+        self._released: bool = False
+
+    @property
+    def status(self) -> int:
+        """Status code of the response."""
+        return self.response.status
+
+    def getheader(self, name: str, default=None):
+        """Gets a header from the response."""
+        return self.response.getheader(name, default)
+
+    def read(self, amt: Optional[int] = None) -> bytes:
+        """Reads from the response body."""
+        return self.response.read(amt)
+
+    def close(self) -> None:
+        """Closes the response, returning the connection to the pool if it
+        can be reused.
+        """
+        if self._released:
+            return
+        self._released = True
+
+        reusable = self.response.isclosed() and not self.response.will_close
+        self.response.close()
+        self.pool.release(self.key, self.pooled, reusable)
+
+    def __enter__(self) -> 'PooledResponse':
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+
+class ConnectionPool:
+    """Keeps persistent connections to the remote hosts so that they can
+    be reused between requests instead of connecting for every file.
+    """
+    SHARED: Optional['ConnectionPool'] = None
+    MAX_REDIRECTS: int = 5
+    RETRY_ERRORS = (http.client.RemoteDisconnected,
+                    http.client.BadStatusLine,
+                    ConnectionResetError,
+                    ConnectionAbortedError,
+                    BrokenPipeError)
+
+    def __init__(self, size: int = 8, idle_timeout: float = 30.0,
+                 timeout: float = 30.0) -> None:
+        self.size = max(1, size)
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.connections_opened: int = 0
+        self.requests: int = 0
+        self.reconnects: int = 0
+        self._idle: dict[tuple[str, str, int], list[PooledConnection]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def shared() -> 'ConnectionPool':
+        """Gets the pool that is shared for the entire session."""
+        if not ConnectionPool.SHARED:
+            ConnectionPool.SHARED = ConnectionPool()
+        return ConnectionPool.SHARED
+
+    @staticmethod
+    def configure(size: int, idle_timeout: float) -> 'ConnectionPool':
+        """Replaces the shared pool with one using the settings passed."""
+        if ConnectionPool.SHARED:
+            ConnectionPool.SHARED.close()
+        ConnectionPool.SHARED = ConnectionPool(size, idle_timeout)
+        return ConnectionPool.SHARED
+
+    @property
+    def requests_per_connection(self) -> float:
+        """Average amount of requests that were sent over a connection."""
+        if self.connections_opened == 0:
+            return 0.0
+        return self.requests / self.connections_opened
+
+    def request(self, url: str, headers: Optional[dict[str, str]] = None,
+                method: str = 'GET',
+                body: Optional[bytes] = None) -> PooledResponse:
+        """Sends a request, following redirects, and returns the response.
+        Raises HTTPStatusError if the host responds with an error.
+        """
+        for _ in range(ConnectionPool.MAX_REDIRECTS + 1):
+            response = self._send(url, headers or {}, method, body)
+            if response.status not in (301, 302, 303, 307, 308):
+                break
+
+            # Follow the redirect, the old response is no longer needed.
+            location = response.getheader('location', None)
+            response.read()
+            response.close()
+            if not location:
+                raise HTTPStatusError(response.status, "Missing location")
+            url = urllib.parse.urljoin(url, location)
+        else:
+            raise HTTPStatusError(response.status, "Too many redirects")
+
+        if response.status >= 400:
+            reason = response.response.reason
+            response.read()
+            response.close()
+            raise HTTPStatusError(response.status, reason)
+        return response
+
+    def release(self, key: tuple[str, str, int], pooled: PooledConnection,
+                reusable: bool) -> None:
+        """Returns a connection to the pool, closing it if it cannot be
+        reused or the pool is already full.
+        """
+        pooled.last_used = time.monotonic()
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if reusable and pooled.is_open and len(idle) < self.size:
+                idle.append(pooled)
+                return
+        self._discard(pooled)
+
+    def close(self) -> None:
+        """Closes all idle connections."""
+        with self._lock:
+            idle = [pooled for conns in self._idle.values()
+                    for pooled in conns]
+            self._idle = {}
+        for pooled in idle:
+            self._discard(pooled)
+
+    def _send(self, url: str, headers: dict[str, str], method: str,
+              body: Optional[bytes] = None) -> PooledResponse:
+        """Sends a single request over a pooled connection. If a reused
+        connection was closed by the host, it is reconnected once.
+        """
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme.lower() or 'http'
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parts.hostname or '', port)
+        target = parts.path or '/'
+        if parts.query:
+            target = f"{target}?{parts.query}"
+        target = urllib.parse.quote(target, safe="/?&=%:+@!$,;~")
+
+        pooled = self._acquire(key)
+        for attempt in range(2):
+            reused = pooled.is_open
+            if not reused:
+                with self._lock:
+                    self.connections_opened += 1
+            try:
+                pooled.conn.request(method, target, body=body,
+                                    headers=headers)
+                response = pooled.conn.getresponse()
+            except ConnectionPool.RETRY_ERRORS:
+                # The host closed a connection we expected to be alive.
+                pooled.conn.close()
+                if not reused or attempt > 0:
+                    self._discard(pooled)
+                    raise
+                with self._lock:
+                    self.reconnects += 1
+                continue
+            except BaseException:
+                self._discard(pooled)
+                raise
+
+            with self._lock:
+                self.requests += 1
+                pooled.requests += 1
+            return PooledResponse(self, key, pooled, response, url)
+        raise ConnectionError(f"Could not connect to {key[1]}:{key[2]}")
+
+    def _acquire(self, key: tuple[str, str, int]) -> PooledConnection:
+        """Gets an idle connection to the host or creates a new one."""
+        now = time.monotonic()
+        stale: list[PooledConnection] = []
+        pooled: Optional[PooledConnection] = None
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                candidate = idle.pop()
+                if now - candidate.last_used > self.idle_timeout:
+                    stale.append(candidate)
+                    continue
+                pooled = candidate
+                break
+
+        # Connections idle for too long are likely closed by the host.
+        for candidate in stale:
+            self._discard(candidate)
+
+        if pooled:
+            return pooled
+
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(
+                host, port, timeout=self.timeout,
+                context=ssl.create_default_context())
+        else:
+            conn = http.client.HTTPConnection(host, port,
+                                              timeout=self.timeout)
+        return PooledConnection(conn)
+
+    def _discard(self, pooled: PooledConnection) -> None:
+        """Closes a connection that will no longer be used."""
+        pooled.conn.close()
@@ -4,17 +4,36 @@ import os
 import ssl
 import sys
 import json
+import shutil
+import tempfile
 import pathlib
 import platform
 import argparse
 import urllib.request
-from datetime import datetime
+from typing import Optional
 
 from log import Log
 from hashes import Hashes
 from config import Config
 from manifest import Manifest
-from uofile import UOFile, FileAction
+from engine import DownloadEngine
+from aioengine import AsyncDownloadEngine
+from planner import Plan, build_plan, resume_plan
+from connpool import ConnectionPool
+from mirrors import MirrorSet
+from peerserver import PeerServer
+from bundle import Bundle
+from updatefile import UpdateFile, Version
+from validators import Validators
+from metrics import Metrics
+from ratelimit import TokenBucket, parse_rate
+from uofile import UOFile
+from localindex import LocalIndex
+from hashcache import HashCache
+from watcher import Watcher
+from journal import Journal
+from snapshot import Snapshot, Entry
+from builder import Builder
 
 
 class OPTS:
@@ -23,6 +42,21 @@ class OPTS:
     ONLY_UPDATE: bool = False
     ONLY_VERSION: bool = False
     VERBOSE: bool = False
+    JOBS: Optional[int] = None
+    REHASH: bool = False
+    VERIFY: bool = False
+    ONLY_PLAN: bool = False
+    MAX_RATE: Optional[str] = None
+    ENGINE: Optional[str] = None
+    SERVE: bool = False
+    WATCH: bool = False
+    BUILD_SOURCE: Optional[str] = None
+    BUILD_VERSION: Optional[str] = None
+    BUILD_BLOCKS: bool = False
+    BUILD_COMPRESS: bool = False
+    BUILD_BLOCK_THRESHOLD: int = 32
+    BUILD_JOBS: int = os.cpu_count() or 1
+    BUILD_PROCESSES: bool = False
     CONFIG_FILE: pathlib.Path = pathlib.Path(Config.FILENAME)
 
 
@@ -50,12 +84,99 @@ def parse_args() -> None:
                         action="store_true",
                         dest="verbose",
                         help="Overrides VERBOSE in config.ini.")
+    parser.add_argument("--jobs",
+                        type=int,
+                        dest="jobs",
+                        metavar="N",
+                        help="Overrides JOBS in config.ini.")
+    parser.add_argument("--rehash",
+                        action="store_true",
+                        dest="rehash",
+                        help="Ignores cached hashes and checks every local "
+                             "file.")
+    parser.add_argument("--verify",
+                        action="store_true",
+                        dest="verify",
+                        help="Checks every local file, not only the changed.")
+    parser.add_argument("--max-rate",
+                        dest="max_rate",
+                        metavar="RATE",
+                        help="Overrides MAX_RATE in config.ini.")
+    parser.add_argument("--plan",
+                        action="store_true",
+                        dest="only_plan",
+                        help="Prints the planned changes as JSON and exits.")
+    parser.add_argument("--engine",
+                        choices=("sync", "async"),
+                        dest="engine",
+                        help="Overrides ENGINE in config.ini.")
+    parser.add_argument("--serve",
+                        action="store_true",
+                        dest="serve",
+                        help="Shares the patched files with other patchers.")
+    parser.add_argument("--watch",
+                        action="store_true",
+                        dest="watch",
+                        help="Keeps running, applying updates as they appear.")
+
+    # Commands for the host of the patches.
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    builder = commands.add_parser("build",
+                                  help="Creates the Manifest and Hashes "
+                                       "for a source tree.")
+    builder.add_argument("source",
+                         help="Root of the files to publish.")
+    builder.add_argument("--set-version",
+                         dest="set_version",
+                         metavar="VERSION",
+                         help="Writes this version instead of bumping it.")
+    builder.add_argument("--blocks",
+                         action="store_true",
+                         dest="blocks",
+                         help="Writes the block checksums of large files.")
+    builder.add_argument("--block-threshold",
+                         type=int,
+                         dest="block_threshold",
+                         metavar="MB",
+                         default=OPTS.BUILD_BLOCK_THRESHOLD,
+                         help="Size in megabytes a file needs to be to get "
+                              "block checksums.")
+    builder.add_argument("--compress",
+                         action="store_true",
+                         dest="compress",
+                         help="Writes pre-compressed '.gz' copies of files.")
+    builder.add_argument("--jobs",
+                         type=int,
+                         dest="build_jobs",
+                         metavar="N",
+                         default=OPTS.BUILD_JOBS,
+                         help="Amount of files read in parallel.")
+    builder.add_argument("--processes",
+                         action="store_true",
+                         dest="processes",
+                         help="Reads the files in processes, not threads.")
 
     # Parse the arguments passed to the application.
     args = parser.parse_args()
     OPTS.ONLY_UPDATE = args.only_update
     OPTS.ONLY_VERSION = args.only_version
     OPTS.VERBOSE = args.verbose
+    OPTS.JOBS = args.jobs
+    OPTS.REHASH = args.rehash
+    OPTS.VERIFY = args.verify
+    OPTS.ONLY_PLAN = args.only_plan
+    OPTS.MAX_RATE = args.max_rate
+    OPTS.ENGINE = args.engine
+    OPTS.SERVE = args.serve
+    OPTS.WATCH = args.watch
+    if args.command == "build":
+        OPTS.BUILD_SOURCE = args.source
+        OPTS.BUILD_VERSION = args.set_version
+        OPTS.BUILD_BLOCKS = args.blocks
+        OPTS.BUILD_COMPRESS = args.compress
+        OPTS.BUILD_BLOCK_THRESHOLD = max(0, args.block_threshold)
+        OPTS.BUILD_JOBS = max(1, args.build_jobs)
+        OPTS.BUILD_PROCESSES = args.processes
 
     # Modify the configuration file location if it was passed.
     if args.config:
@@ -93,91 +214,61 @@ def needs_update() -> bool:
     return OPTS.LVERSION < OPTS.RVERSION
 
 
-def remove_file(hashes: Hashes, uofile: UOFile, clean: bool):
-    """Removes / Deletes a file and cleans up the Hashes file."""
-    if not uofile.local_exists:
-        return
-
-    try:
-        os.remove(uofile.local_resource)
-        Log.info(f"Removed: '{uofile.name}'", end='\r')
-    except FileNotFoundError:
-        Log.error(f"File cannot be deleted: '{uofile.id}'")
-
-    if clean:
-        del hashes.local_hashes[uofile.id]
-        del hashes.sizes[uofile.id]
-
-
-def process_uofile(hashes: Hashes, uofile: UOFile,
-                   remote_size: int, verbose: bool) -> int:
-    """Processes the creation or removal of a UO File."""
-    # Check if the local version exists.
-    action: FileAction = FileAction.NONE
-    local_hash = hashes.local_hashes.get(uofile.id, None)
-
-    if not local_hash and uofile.action != FileAction.DELETE:
-        # File needs to be downloaded since it does not exist.
-        action = FileAction.CREATE
-    elif (uofile.local_size >= 0 and remote_size >= 0
-          and uofile.action == FileAction.NONE
-          and uofile.local_size != remote_size):
-        # File may not have been downloaded correctly.
-        action = FileAction.CREATE
-    elif local_hash and uofile.action == FileAction.DELETE:
-        # Mark the file for deletion.
-        action = FileAction.DELETE
-    elif local_hash and uofile.action == FileAction.CREATE:
-        # File exists, should not be updated every patch.
-        action = FileAction.NONE
-    elif local_hash and uofile.remote_hashes:
-        if local_hash not in uofile.remote_hashes:
-            # Hash mismatch, needs the new version.
-            action = FileAction.CREATE
-
-    # Perform the non-create actions.
-    if action == FileAction.NONE:
+def pull_updates(plan: Plan,
+                 hashes: Hashes,
+                 verbose: bool,
+                 jobs: int = 1,
+                 metrics: Optional[Metrics] = None) -> tuple[int, int]:
+    """Executes the plan, pulling updates from the remote server. Returns
+    the amount of bytes downloaded and the amount of files that failed.
+    """
+    engine = DownloadEngine(hashes, jobs=jobs, verbose=verbose,
+                            metrics=metrics)
+    for uofile in plan.skip:
         Log.info(f"Skipped: '{uofile.name}'", end='\r')
-        return 0
-    elif action == FileAction.DELETE:
+
+    for uofile in plan.delete:
         Log.info(f"Removing: '{uofile.name}'", end='\r')
-        remove_file(hashes, uofile, True)
-        return 0
+        engine.remove(uofile, True)
 
-    if not verbose:
-        Log.notify(f"Downloading: '{uofile.name}'", end='\r')
+    # Downloads are handed off to the engine's workers, small files are
+    # requested together in bundles.
+    batches, single = Bundle.split(plan.create, plan.sizes, jobs)
+    for batch in batches:
+        engine.submit_bundle(batch, plan.sizes)
+    for uofile in single:
+        engine.submit(uofile, plan.sizes.get(uofile.id, 0))
 
-    stats = uofile.download(show_progress=verbose)
-    if not stats:
-        Log.error(f"Failed: '{uofile.name}'")
-        return 0
+    total_size = engine.wait()
+    if engine.failed:
+        Log.warn(f"Failed to download {len(engine.failed)} file(s).")
 
-    if not verbose:
-        Log.notify(f"Downloaded: '{uofile.name}'")
+    Log.clear()
+    return total_size, len(engine.failed)
 
-    return stats[0]
 
+def update_file(update: UpdateFile, validators: Validators,
+                aio: Optional[AsyncDownloadEngine] = None) -> bool:
+    """Updates the Manifest or Hashes with the selected engine."""
+    if aio:
+        return aio.update(update, validators)
+    return update.update(validators)
 
-def pull_updates(manifest: Manifest,
-                 hashes: Hashes,
-                 verbose: bool) -> int:
-    """Pulls updates from the remote server."""
-    total_size: int = 0
-    for _, uofile in manifest.FILES.items():
-        remote_size = hashes.sizes.get(uofile.id, 0)
-
-        size = process_uofile(hashes, uofile, remote_size, verbose)
-        if size > 0 and remote_size > 0 and size < remote_size:
-            Log.warn(f"Failed: '{uofile.name}, trying again.'")
-            # Full expected file not installed. Try again.
-            remove_file(hashes, uofile, False)
-            size = process_uofile(hashes, uofile, remote_size, verbose)
-
-        # Add the size.
-        total_size = total_size + size
 
-    Log.clear()
-    return total_size
+def check_space(local_root: str, plan: Plan) -> None:
+    """Warns if the planned downloads may not fit on the disk."""
+    path = pathlib.Path(local_root)
+    while not path.exists() and path != path.parent:
+        path = path.parent
+    try:
+        free = shutil.disk_usage(path).free
+    except OSError:
+        return
+
+    if plan.create_size > free:
+        Log.warn(f"Not enough disk space, need "
+                 f"{plan.create_size / 1024 / 1024:0.2f} mb but only "
+                 f"{free / 1024 / 1024:0.2f} mb is available.")
 
 
 def confirm_location(local_root: str) -> bool:
@@ -204,12 +295,264 @@ def confirm_location(local_root: str) -> bool:
     return False
 
 
+def write_report(config: Config, metrics: Metrics) -> None:
+    """Writes the metrics for the run to the configured report files."""
+    mirrors = MirrorSet.shared()
+    if mirrors:
+        metrics.mirrors = mirrors.to_dict()
+    try:
+        if config.report_file:
+            metrics.write_json(config.resolve(config.report_file))
+        if config.prometheus_file:
+            metrics.write_prometheus(config.resolve(config.prometheus_file))
+    except OSError as exc:
+        Log.error(f"Could not write the run report: {exc}")
+
+
+def configure_transfers(config: Config,
+                        metrics: Metrics) -> tuple[str, ConnectionPool]:
+    """Sets up the connections, mirrors, and limits shared by every
+    transfer. Returns the remote root to use and the connection pool.
+    """
+    uri = f"{config.remote_root}:{config.remote_port}"
+    pool = ConnectionPool.configure(config.pool_size,
+                                    config.pool_idle_timeout)
+
+    # Start with the fastest mirror, the others are used when it fails.
+    mirrors = MirrorSet.configure([uri] + config.mirrors)
+    if mirrors:
+        with metrics.phase('mirror_probe'):
+            mirrors.probe()
+        for mirror in mirrors.ranked():
+            Log.debug(f"Mirror '{mirror.url}': "
+                      f"{mirror.latency * 1000:0.1f} ms, "
+                      f"{mirror.throughput / 1024 / 1024:0.2f} MB/s, "
+                      f"{'healthy' if mirror.healthy else 'demoted'}")
+        uri = mirrors.best.url
+        Log.notify(f"Using mirror '{uri}' of {len(mirrors)}.")
+    metrics.remote = uri
+    UOFile.SEGMENTS = config.segments
+    UOFile.SEGMENT_THRESHOLD = config.segment_threshold * 1024 * 1024
+    UOFile.COMPRESSION = config.compression
+    UOFile.DELTA_THRESHOLD = config.delta_threshold * 1024 * 1024
+    UOFile.DELTA_MAX_RATIO = config.delta_max_ratio
+    Bundle.THRESHOLD = config.bundle_threshold * 1024
+    Bundle.MAX_FILES = config.bundle_files
+    max_rate = OPTS.MAX_RATE if OPTS.MAX_RATE is not None else config.max_rate
+    TokenBucket.configure(parse_rate(max_rate), config.rate_schedule)
+    return uri, pool
+
+
+def create_engine(config: Config, metrics: Metrics
+                  ) -> tuple[int, Optional[AsyncDownloadEngine]]:
+    """Gets the amount of jobs and the async engine if it is selected,
+    None means the threaded engine is used.
+    """
+    # The async engine drives every transfer from a single event loop.
+    jobs = OPTS.JOBS if OPTS.JOBS else config.jobs
+    engine = OPTS.ENGINE if OPTS.ENGINE else config.engine
+    if engine not in ("sync", "async"):
+        Log.warn(f"Unknown engine '{engine}', using 'sync'.")
+        engine = "sync"
+    if engine != "async":
+        return jobs, None
+    return jobs, AsyncDownloadEngine(jobs=jobs, verbose=Log.verbose_mode,
+                                     metrics=metrics,
+                                     transfers=config.async_transfers,
+                                     pool_size=config.pool_size,
+                                     idle_timeout=config.pool_idle_timeout,
+                                     disk_workers=config.hash_workers)
+
+
+def serve() -> None:
+    """Shares the verified files of the local root with other patchers
+    until interrupted.
+    """
+    config = Config.load(OPTS.CONFIG_FILE)
+    if not config:
+        return
+
+    server = PeerServer(config.local_root, config.serve_host,
+                        config.serve_port)
+    Log.notify(f"Serving '{config.local_root}' on {server.address}, "
+               "press Ctrl+C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+    Log.notify(f"Served {server.requests} files "
+               f"({server.bytes_sent / 1024 / 1024:0.2f} mb).")
+
+
+def watch() -> None:
+    """Keeps the local root patched, checking for updates at the watch
+    interval until interrupted. With --serve the files are shared while
+    watching.
+    """
+    config = Config.load(OPTS.CONFIG_FILE)
+    if not config:
+        Log.warn(f"Configuration file '{Config.FILENAME}' does not exist.")
+        return
+    config.save()
+
+    Log.debug_mode = config.debug
+    Log.verbose_mode = config.verbose or OPTS.VERBOSE
+    if not config.skip_prompt:
+        if not confirm_location(config.local_root):
+            sys.exit(0)
+        print("")
+
+    metrics = Metrics()
+    uri, pool = configure_transfers(config, metrics)
+    jobs, aio = create_engine(config, metrics)
+
+    def update(update: UpdateFile, validators: Validators) -> bool:
+        return update_file(update, validators, aio)
+
+    def pull(plan: Plan, hashes: Hashes,
+             metrics: Metrics) -> tuple[int, int]:
+        if aio:
+            aio.metrics = metrics
+            return aio.pull_updates(plan, hashes)
+        return pull_updates(plan, hashes, Log.verbose_mode, jobs=jobs,
+                            metrics=metrics)
+
+    def report(metrics: Metrics) -> None:
+        write_report(config, metrics)
+
+    watcher = Watcher(uri, config.local_root, update, pull,
+                      hash_workers=config.hash_workers,
+                      hash_processes=config.hash_processes, report=report)
+
+    server: Optional[PeerServer] = None
+    if OPTS.SERVE:
+        server = PeerServer(config.local_root, config.serve_host,
+                            config.serve_port).start()
+        Log.notify(f"Serving '{config.local_root}' on {server.address}.")
+
+    Log.notify(f"Watching for updates every {config.watch_interval:0.0f} "
+               "sec, press Ctrl+C to stop.")
+    try:
+        watcher.run(config.watch_interval, config.watch_max_interval)
+    finally:
+        if server:
+            server.stop()
+        if aio:
+            aio.close()
+        else:
+            pool.close()
+
+
+def check_local_files(config: Config, manifest: Manifest, hashes: Hashes,
+                      metrics: Metrics) -> Plan:
+    """Hashes the local files and plans the changes for every file the
+    Manifest tracks.
+    """
+    # One pass over the local files replaces a stat for every tracked file.
+    index = LocalIndex(config.local_root)
+    with metrics.phase('scan_local'):
+        index.scan()
+    UOFile.INDEX = index
+    Log.debug(f"Indexed {len(index)} local files in "
+              f"{metrics.phases['scan_local']:0.2f} sec.")
+
+    Log.notify("Generating local hashes.")
+    with metrics.phase('build_localhash'):
+        hashes.build_localhash(workers=config.hash_workers,
+                               use_processes=config.hash_processes,
+                               rehash=OPTS.REHASH)
+    Log.notify(f"Hashed {len(hashes.local_hashes)} local files "
+               f"({hashes.cache.hits} cached) in "
+               f"{metrics.phases['build_localhash']:0.2f} sec.\n")
+
+    # Decide what needs to be done before touching any files.
+    with metrics.phase('plan'):
+        plan = build_plan(manifest.FILES, hashes, str(manifest.version))
+        # The reports of the runs are not part of the client either.
+        reports = [os.path.relpath(config.resolve(name), config.local_root)
+                   for name in (config.report_file, config.prometheus_file)
+                   if name]
+        plan.untracked = index.untracked([*manifest.FILES, *reports])
+    metrics.count('untracked_files', len(plan.untracked))
+    if plan.untracked:
+        Log.notify(f"{len(plan.untracked)} local files are not part of "
+                   f"the Manifest.")
+        for file_id in plan.untracked:
+            Log.debug(f"Untracked: {file_id}")
+    return plan
+
+
+def check_changed_files(config: Config, manifest: Manifest,
+                        hashes: Hashes, snapshot: Snapshot,
+                        current: dict[str, Entry], metrics: Metrics) -> Plan:
+    """Hashes the local files and plans the changes only for the files
+    that were added or changed remotely since the snapshot was applied.
+    """
+    added, removed, changed = snapshot.diff(current)
+    changed |= added
+    Log.notify(f"Since '{snapshot.version}': {len(added)} added, "
+               f"{len(removed)} removed, {len(changed) - len(added)} "
+               "changed.")
+    metrics.count('changed_files', len(changed))
+
+    with metrics.phase('build_localhash'):
+        hashes.build_localhash(workers=config.hash_workers,
+                               use_processes=config.hash_processes,
+                               file_ids=changed)
+    Log.notify(f"Hashed {len(changed)} changed files "
+               f"({hashes.cache.hits} cached) in "
+               f"{metrics.phases['build_localhash']:0.2f} sec.\n")
+
+    with metrics.phase('plan'):
+        files = {file_id: uofile
+                 for file_id, uofile in manifest.FILES.items()
+                 if file_id in changed}
+        plan = build_plan(files, hashes, str(manifest.version))
+    return plan
+
+
+def build() -> None:
+    """Creates the Manifest and Hashes for the source tree, only reading
+    the files that changed since the last build.
+    """
+    source = OPTS.BUILD_SOURCE
+    if not os.path.isdir(source):
+        Log.error(f"Source '{source}' is not a directory.")
+        return
+
+    version = None
+    if OPTS.BUILD_VERSION:
+        version = Version(Version.parse(OPTS.BUILD_VERSION))
+
+    Log.verbose_mode = OPTS.VERBOSE
+    Log.notify(f"Building '{source}' with {OPTS.BUILD_JOBS} job(s).")
+    builder = Builder(source, workers=OPTS.BUILD_JOBS,
+                      use_processes=OPTS.BUILD_PROCESSES,
+                      blocks=OPTS.BUILD_BLOCKS,
+                      compress=OPTS.BUILD_COMPRESS,
+                      block_threshold=OPTS.BUILD_BLOCK_THRESHOLD
+                      * 1024 * 1024)
+    written = builder.build(version)
+    cache = builder.cache
+    Log.notify(f"Read {builder.hashed} changed file(s), {cache.hits} "
+               "unchanged.")
+    if written is None:
+        Log.notify("Nothing changed, the Manifest and Hashes were kept.")
+    else:
+        Log.notify(f"Manifest Version: '{written}'")
+
+
 def main():
     """Entrance into the application."""
+    metrics = Metrics()
+
     # Try to load the configuration, if it fails it will be created.
     try:
         Log.notify(f"Loading configuration file: '{Config.FILENAME}'\n")
-        config = Config.load(OPTS.CONFIG_FILE)
+        with metrics.phase('config_load'):
+            config = Config.load(OPTS.CONFIG_FILE)
     except BaseException as err:
         Log.error(f"Error while loading configuration file:\n{str(err)}")
         return
@@ -228,64 +571,195 @@ def main():
     Log.verbose_mode = config.verbose or OPTS.VERBOSE
 
     # Ask the user for permission.
-    if not config.skip_prompt:
+    if not config.skip_prompt and not OPTS.ONLY_PLAN:
         if not confirm_location(config.local_root):
             sys.exit(0)
         print("")
     Log.notify("Checking for file updates.")
 
-    uri = f"{config.remote_root}:{config.remote_port}"
+    uri, pool = configure_transfers(config, metrics)
+    jobs, aio = create_engine(config, metrics)
+    if aio:
+        pool = aio.pool
+
+    # Validators allow unchanged update files to not be downloaded again.
+    validators = Validators(config.local_root)
+    validators.load()
 
     # Load the local manifest, if it does not exist, get it.
     manifest = Manifest(uri, config.local_root)
-    loaded = manifest.load()
-    if not loaded:
-        Log.warn("Local Manifest missing, downloading new one.")
-        if not manifest.update():
-            raise ConnectionError("Could not download remote Manifest.")
-
-    # Was able to load a local manifest, check for updates.
-    if loaded:
-        version = manifest.version
-        if not manifest.update():
-            raise ConnectionError("Could not download remote Manifest.")
-
-        # Check if the local is newer or the same.
-        if version >= manifest.version:
-            Log.notify("Already have the most up-to-date Manifest.")
+    hashes = Hashes(uri, config.local_root)
+
+    # Planning leaves the local root untouched, the update files, their
+    # validators and the HashCache are written to a temporary directory
+    # that is removed on exit.
+    if OPTS.ONLY_PLAN:
+        staging = tempfile.TemporaryDirectory(prefix="uopatcher-")
+        manifest.relocate(staging.name)
+        hashes.relocate(staging.name)
+        validators.file_path = pathlib.Path(staging.name,
+                                            Validators.FILENAME)
+        hashes.cache.load()
+        hashes.cache.file_path = pathlib.Path(staging.name,
+                                              HashCache.FILENAME)
+    with metrics.phase('manifest_update'):
+        try:
+            loaded = manifest.load()
+        except ValueError as exc:
+            # A broken copy is replaced instead of stopping every run.
+            Log.warn(f"Local Manifest unreadable: {exc}")
+            UpdateFile.FILES.clear()
+            manifest.clear()
+            os.remove(manifest.local_resource)
+            manifest.refresh()
+            loaded = False
+        if not loaded:
+            Log.warn("Local Manifest missing, downloading new one.")
+            if not update_file(manifest, validators, aio):
+                raise ConnectionError("Could not download remote Manifest.")
+
+        # Was able to load a local manifest, check for updates.
+        if loaded:
+            version = manifest.version
+            if not update_file(manifest, validators, aio):
+                raise ConnectionError("Could not download remote Manifest.")
+
+            # Check if the local is newer or the same.
+            if version >= manifest.version:
+                Log.notify("Already have the most up-to-date Manifest.")
 
     Log.notify(f"Manifest Version: '{manifest.version}'\n")
+    metrics.version = str(manifest.version)
 
     # Build the hashes.
-    hashes = Hashes(uri, config.local_root)
     Log.notify(f"Updating '{hashes.name}' file.")
-    hashes.update()
-    Log.notify("Generating local hashes.\n")
-    hashes.build_localhash()
+    with metrics.phase('hashes_update'):
+        update_file(hashes, validators, aio)
+
+    # Every file is checked now and then, between those only the files
+    # that changed since the last completed patch.
+    snapshot = Snapshot(config.local_root)
+    snapshot.load()
+    full = (OPTS.REHASH or OPTS.VERIFY or OPTS.ONLY_PLAN
+            or snapshot.due(config.verify_interval))
+
+    # Nothing changed remotely since the last completed patch.
+    if (not full and not manifest.modified and not hashes.modified
+            and validators.is_applied(str(manifest.version))):
+        Log.notify("Manifest and Hashes unchanged since the last patch.")
+        Log.notify("All files are up-to-date.")
+        write_report(config, metrics)
+        if aio:
+            aio.close()
+        return
+
+    # Continue an interrupted patch of the same update files from where it
+    # stopped, otherwise check the changed or every local file.
+    current = Snapshot.capture(manifest.FILES, hashes.sizes)
+    journal = Journal(config.local_root)
+    resumed = (not OPTS.REHASH and not OPTS.ONLY_PLAN and journal.load()
+               and journal.matches(str(manifest.version), validators.files))
+    if resumed:
+        full = False
+        with metrics.phase('plan'):
+            plan = resume_plan(manifest.FILES, hashes, journal,
+                               str(manifest.version))
+        hashes.cache.save()
+        Log.notify(f"Resuming the interrupted patch, "
+                   f"{len(journal.committed)} files were already done.\n")
+    elif not full:
+        plan = check_changed_files(config, manifest, hashes, snapshot,
+                                   current, metrics)
+    else:
+        plan = check_local_files(config, manifest, hashes, metrics)
+    if OPTS.ONLY_PLAN:
+        print(plan.to_json())
+        if aio:
+            aio.close()
+        return
+
+    check_space(config.local_root, plan)
+
+    # Until this patch completes, the next run needs to check the files.
+    validators.clear_applied()
+    journal.begin(str(manifest.version), validators.files,
+                  [uofile.id for uofile in plan.create],
+                  [uofile.id for uofile in plan.delete])
+    hashes.journal = journal
 
     # Start checking for updates.
-    Log.notify("Getting updates.")
-    timestamp: datetime = datetime.now()
-    size = pull_updates(manifest, hashes, Log.verbose_mode)
-    timelength = datetime.now() - timestamp
+    Log.notify(f"Getting updates: {len(plan.create)} to download "
+               f"({plan.create_size / 1024 / 1024:0.2f} mb), "
+               f"{len(plan.delete)} to remove.")
+    with metrics.phase('pull_updates'):
+        if aio:
+            size, failed = aio.pull_updates(plan, hashes)
+        else:
+            size, failed = pull_updates(plan, hashes, Log.verbose_mode,
+                                        jobs=jobs, metrics=metrics)
+    hashes.cache.save()
+    hashes.journal = None
+    if failed == 0:
+        validators.mark_applied(str(manifest.version))
+        snapshot.save(str(manifest.version), current, verified=full)
+        journal.finish()
+    else:
+        # The failed files are continued by the next run.
+        journal.close()
+    if aio:
+        aio.close()
+    else:
+        pool.close()
+    Log.debug(f"Connections opened: {pool.connections_opened}, "
+              f"requests: {pool.requests} "
+              f"({pool.requests_per_connection:0.2f} per connection), "
+              f"reconnects: {pool.reconnects}")
+    metrics.count('connections_opened', pool.connections_opened)
+    metrics.count('requests', pool.requests)
+    metrics.count('cache_hits', hashes.cache.hits)
+    write_report(config, metrics)
+    if failed > 0:
+        Log.error("Patch incomplete, run the patcher again to retry the "
+                  "failed files.")
+        sys.exit(1)
 
     # Print some statistics.
     size_mb = size / 1024 / 1024
-    time_sec = timelength.total_seconds()
+    time_sec = metrics.phases['pull_updates']
     print("\n")
     Log.notify("All files are up-to-date.")
-    Log.notify(f"Download rate: {(size_mb / time_sec):0.2f} mbps")
+    Log.notify(f"Download rate: {(size_mb / max(time_sec, 1e-6)):0.2f} MB/s")
     Log.notify(f"Total time: {(time_sec/60):0.2f} min")
     Log.notify(f"Total size: {(size_mb / 1024):0.2f} gb ({size_mb:0.2f} mb)")
+    if metrics.compression_saved > 0:
+        saved_mb = metrics.compression_saved / 1024 / 1024
+        Log.notify(f"Saved by compression: {saved_mb:0.2f} mb")
 
 
 if __name__ == "__main__":
     parse_args()
+    if OPTS.BUILD_SOURCE:
+        # Building the files for a host does not patch anything.
+        try:
+            build()
+        except KeyboardInterrupt:
+            Log.warn("Interrupt detected, exiting.")
+            sys.exit(1)
+        except BaseException as exc:
+            Log.error(f"Critical Error: {exc}")
+            sys.exit(1)
+        sys.exit(0)
+
     update_exists: bool = False
     try:
-        if not OPTS.ONLY_VERSION and not OPTS.ONLY_UPDATE:
+        if OPTS.ONLY_PLAN:
+            # Only the plan is printed to stdout, the logs go to stderr.
+            Log.quiet_mode = True
+            Log.stream = sys.stderr
+        elif not OPTS.ONLY_VERSION and not OPTS.ONLY_UPDATE:
             Log.notify("Checking for patcher updates.")
-        update_exists = needs_update()
+        if not OPTS.ONLY_PLAN:
+            update_exists = needs_update()
     except BaseException as exc:
         Log.error(f"Could not check for updates. {exc}")
 
@@ -304,11 +778,22 @@ if __name__ == "__main__":
             Log.warn("Update for the patcher is available at:\n"
                      "\thttps://github.com/Ohkthx/uopatcher")
             print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n\n")
-        main()
+        if OPTS.WATCH:
+            watch()
+        else:
+            main()
     except SystemExit:
-        pass
+        # Keep the exit code of an incomplete patch.
+        raise
     except KeyboardInterrupt:
         Log.warn("Interrupt detected, exiting.")
         sys.exit(1)
     except BaseException as exc:
         Log.error(f"Critical Error: {exc}")
+
+    # Share the files even if the patch failed, only verified ones are sent.
+    if OPTS.SERVE and not OPTS.WATCH:
+        try:
+            serve()
+        except BaseException as exc:
+            Log.error(f"Could not serve the local files: {exc}")
@@ -0,0 +1,132 @@
+import os
+import hashlib
+from typing import Optional
+
+# Suffix of the sidecar listing the block checksums of a remote file.
+BLOCKS_SUFFIX: str = '.blocks'
+
+
+def block_digests(local_resource: str, block_size: int) -> list[str]:
+    """Generates the md5 of every block of a local file, the last block
+    may be shorter. Returns an empty list if the file does not exist.
+    """
+    digests: list[str] = []
+    try:
+        with open(local_resource, 'rb') as f:
+            while True:
+                block = f.read(block_size)
+                if not block:
+                    break
+                digests.append(hashlib.md5(block).hexdigest().lower())
+    except FileNotFoundError:
+        return []
+    return digests
+
+
+class BlockList:
+    """Checksums of the fixed size blocks of a file, published by the
+    remote as a '.blocks' sidecar next to the file. The first line holds
+    the block size and size of the file separated by a tab, followed by
+    the md5 of each block in order.
+    """
+    DEFAULT_BLOCK_SIZE: int = 1024 * 1024
+
+    def __init__(self, block_size: int, size: int,
+                 digests: list[str]) -> None:
+        self.block_size = block_size
+        self.size = size
+        self.digests = digests
+
+    def __len__(self) -> int:
+        return len(self.digests)
+
+    @property
+    def valid(self) -> bool:
+        """Checks if the amount of blocks covers the size of the file."""
+        return (self.block_size > 0 and self.size >= 0
+                and len(self.digests) == -(-self.size // self.block_size))
+
+    def block_range(self, index: int) -> tuple[int, int]:
+        """Gets the inclusive byte range [first, last] of a block."""
+        first = index * self.block_size
+        return first, min(first + self.block_size, self.size) - 1
+
+    @staticmethod
+    def parse(text: str) -> Optional['BlockList']:
+        """Parses the contents of a sidecar, None if it is malformed."""
+        lines = text.split()
+        if len(lines) < 2:
+            return None
+        try:
+            block_size, size = (int(value) for value in lines[:2])
+        except ValueError:
+            return None
+
+        blocks = BlockList(block_size, size,
+                           [digest.lower() for digest in lines[2:]])
+        return blocks if blocks.valid else None
+
+    @staticmethod
+    def build(local_resource: str,
+              block_size: int = DEFAULT_BLOCK_SIZE) -> 'BlockList':
+        """Creates the block checksums of a local file."""
+        digests = block_digests(local_resource, block_size)
+        size = os.path.getsize(local_resource) if digests else 0
+        return BlockList(block_size, size, digests)
+
+    def to_text(self) -> str:
+        """Converts the checksums into the contents of a sidecar."""
+        return "\n".join([f"{self.block_size}\t{self.size}"]
+                         + self.digests) + "\n"
+
+
+class DeltaPlan:
+    """How a new version of a file is assembled from the local copy. Each
+    remote block is either copied from a block of the local file with the
+    same checksum, preferring the same position, or fetched from the
+    remote. Blocks are compared at block aligned offsets, data that moved
+    by less than a block is fetched again.
+    """
+
+    def __init__(self, blocks: BlockList, local_digests: list[str]) -> None:
+        self.blocks = blocks
+        offsets: dict[str, int] = {}
+        for n, digest in enumerate(local_digests):
+            offsets.setdefault(digest, n * blocks.block_size)
+
+        # Local offset each block is copied from, None if it is fetched.
+        self.sources: list[Optional[int]] = []
+        for n, digest in enumerate(blocks.digests):
+            if n < len(local_digests) and local_digests[n] == digest:
+                self.sources.append(n * blocks.block_size)
+            else:
+                self.sources.append(offsets.get(digest, None))
+
+    @property
+    def fetch_size(self) -> int:
+        """Amount of bytes that need to be fetched from the remote."""
+        size: int = 0
+        for n, source in enumerate(self.sources):
+            if source is None:
+                first, last = self.blocks.block_range(n)
+                size += last - first + 1
+        return size
+
+    def runs(self) -> list[tuple[Optional[int], int, int]]:
+        """Gets the file as consecutive runs of (source, first, last),
+        where the source is the local offset the inclusive byte range
+        [first, last] is copied from or None if it is fetched. Neighbouring
+        blocks from the same place are merged into a single run.
+        """
+        runs: list[tuple[Optional[int], int, int]] = []
+        for n, source in enumerate(self.sources):
+            first, last = self.blocks.block_range(n)
+            if runs:
+                previous, run_first, _ = runs[-1]
+                if ((source is None and previous is None)
+                        or (source is not None and previous is not None
+                            and previous + first - run_first == source)):
+                    runs[-1] = (previous, run_first, last)
+                    continue
+            runs.append((source, first, last))
+        return runs
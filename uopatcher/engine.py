@@ -0,0 +1,204 @@
+import os
+import time
+import threading
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from log import Log
+from hashes import Hashes
+from metrics import Metrics
+from uofile import UOFile, DownloadStats, partial_resource
+from bundle import Bundle, download_bundle
+
+
+class DownloadEngine:
+    """Downloads and removes files using a bounded pool of workers.
+    All modifications to the Hashes are done under a single lock so that
+    workers can safely run at the same time.
+    """
+
+    def __init__(self, hashes: Hashes, jobs: int = 1,
+                 verbose: bool = False,
+                 metrics: Optional[Metrics] = None) -> None:
+        self.hashes = hashes
+        self.metrics = metrics
+        self.jobs = max(1, jobs)
+        self.verbose = verbose
+        self.total_size: int = 0
+        self.failed: list[str] = []
+        self._lock = threading.Lock()
+        self._futures: list[Future] = []
+        self._executor = None
+        if self.jobs > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self.jobs)
+
+    @property
+    def show_progress(self) -> bool:
+        """Progress bars are only shown for a single worker, otherwise
+        the lines from the workers would overwrite each other.
+        """
+        return self.verbose and self.jobs == 1
+
+    def remove(self, uofile: UOFile, clean: bool) -> None:
+        """Removes / Deletes a file and cleans up the Hashes file."""
+        part_resource = partial_resource(uofile.local_resource)
+        if os.path.isfile(part_resource):
+            os.remove(part_resource)
+
+        if not uofile.local_exists:
+            return
+
+        try:
+            os.remove(uofile.local_resource)
+            Log.info(f"Removed: '{uofile.name}'", end='\r')
+        except FileNotFoundError:
+            Log.error(f"File cannot be deleted: '{uofile.id}'")
+        uofile.refresh()
+
+        with self._lock:
+            self.hashes.cache.evict(uofile.id)
+            if clean:
+                self.hashes.remove_local(uofile)
+                self.hashes.sizes.pop(uofile.id, None)
+
+    def submit(self, uofile: UOFile, remote_size: int) -> None:
+        """Queues a file to be downloaded. If there is only a single
+        worker, the file is downloaded immediately.
+        """
+        if not self._executor:
+            self._add_size(self.download(uofile, remote_size))
+            return
+
+        future = self._executor.submit(self.download, uofile, remote_size)
+        future.add_done_callback(self._on_done)
+        self._futures.append(future)
+
+    def submit_bundle(self, uofiles: list[UOFile],
+                      sizes: dict[str, int]) -> None:
+        """Queues small files to be downloaded as a single bundle. If
+        there is only a single worker, they are downloaded immediately.
+        """
+        if not self._executor:
+            self._add_size(self.download_bundle(uofiles, sizes))
+            return
+
+        future = self._executor.submit(self.download_bundle, uofiles, sizes)
+        future.add_done_callback(self._on_done)
+        self._futures.append(future)
+
+    def wait(self) -> int:
+        """Waits for all queued downloads to finish, returning the total
+        amount of bytes downloaded.
+        """
+        if self._executor:
+            try:
+                self._executor.shutdown(wait=True)
+            except KeyboardInterrupt:
+                # Stop anything that has not started yet.
+                for future in self._futures:
+                    future.cancel()
+                raise
+        return self.total_size
+
+    def download(self, uofile: UOFile, remote_size: int) -> int:
+        """Downloads a single file, retrying once if the full expected
+        file was not obtained. Returns the amount of bytes transferred.
+        """
+        start = time.perf_counter()
+        retries: int = 0
+        expected_size = remote_size if remote_size > 0 else -1
+        stats = self._fetch(uofile, expected_size)
+        downloaded = stats.downloaded if stats else 0
+        transferred = stats.transferred if stats else 0
+        if not stats or not stats.complete:
+            Log.warn(f"Failed: '{uofile.name}', trying again.")
+            # Resumes the partial download, or starts over if discarded.
+            retries += 1
+            stats = self._fetch(uofile, expected_size)
+            downloaded += stats.downloaded if stats else 0
+            transferred += stats.transferred if stats else 0
+
+        failed = not stats or not stats.complete
+        if failed:
+            Log.error(f"Failed: '{uofile.name}'")
+            with self._lock:
+                self.failed.append(uofile.id)
+
+        if self.metrics:
+            self.metrics.record_file(uofile.id, downloaded,
+                                     time.perf_counter() - start,
+                                     retries, failed, transferred)
+        return downloaded
+
+    def download_bundle(self, uofiles: list[UOFile],
+                        sizes: dict[str, int]) -> int:
+        """Downloads the files as a bundle, the files it did not provide
+        are downloaded one at a time. Returns the amount of bytes
+        transferred.
+        """
+        completed: dict[str, DownloadStats] = {}
+        remote_root = Bundle.remote_root()
+        if Bundle.supported(remote_root):
+            start = time.perf_counter()
+            completed = download_bundle(
+                remote_root,
+                [(uofile, sizes.get(uofile.id, -1)) for uofile in uofiles])
+            if completed:
+                Log.debug(f"Bundle of {len(completed)}/{len(uofiles)} "
+                          f"files in {time.perf_counter() - start:0.2f} "
+                          "sec.")
+
+        downloaded: int = 0
+        for uofile in uofiles:
+            stats = completed.get(os.path.normcase(uofile.id), None)
+            if not stats:
+                downloaded += self.download(uofile, sizes.get(uofile.id, 0))
+                continue
+
+            with self._lock:
+                self.hashes.store_local(uofile, stats.md5)
+            if self.metrics:
+                self.metrics.record_file(uofile.id, stats.downloaded,
+                                         stats.elapsed, 0, False,
+                                         stats.transferred)
+            Log.notify(f"Downloaded: '{uofile.name}'")
+            downloaded += stats.downloaded
+        return downloaded
+
+    def _fetch(self, uofile: UOFile,
+               expected_size: int) -> Optional[DownloadStats]:
+        """Performs the download of the file, returns the statistics."""
+        if not self.show_progress:
+            Log.notify(f"Downloading: '{uofile.name}'", end='\r')
+
+        compressed_size = self.hashes.compressed_sizes.get(uofile.id, 0)
+        stats = uofile.download(show_progress=self.show_progress,
+                                expected_size=expected_size,
+                                compressed_size=compressed_size)
+        if not stats or not stats.complete:
+            return stats
+
+        # The verified digest means the new file never needs to be reread.
+        md5 = stats.md5 if stats.md5 else uofile.get_md5sum()
+        with self._lock:
+            self.hashes.store_local(uofile, md5)
+
+        if not self.show_progress:
+            Log.notify(f"Downloaded: '{uofile.name}'")
+        return stats
+
+    def _add_size(self, size: int) -> None:
+        """Adds to the total amount of bytes downloaded."""
+        with self._lock:
+            self.total_size += size
+
+    def _on_done(self, future: Future) -> None:
+        """Called when a worker completes a download."""
+        if future.cancelled():
+            return
+
+        exc = future.exception()
+        if exc:
+            Log.error(f"Download worker failed: {exc}")
+            return
+        self._add_size(future.result())
@@ -0,0 +1,125 @@
+import os
+import array
+from typing import Iterator, Optional
+
+from uofile import UOFile, FileAction
+
+# Prefix that recreates the action when a file id is parsed again.
+ACTION_PREFIX: dict[FileAction, str] = {FileAction.NONE: '',
+                                        FileAction.CREATE: '+',
+                                        FileAction.DELETE: '-'}
+
+
+class FileTable:
+    """Compact table of every file in the manifest. Each row holds the id,
+    action, remote size and both remote md5 hashes in flat arrays, so a
+    manifest with hundreds of thousands of entries does not need an object
+    per file. UOFiles are only created for the rows that are used.
+    """
+    HASH_BYTES: int = 16
+
+    def __init__(self) -> None:
+        self.ids: list[str] = []
+        self.rows: dict[str, int] = {}
+        self.actions = array.array('B')
+        self.sizes = array.array('q')
+        self.hashed = array.array('B')
+        self.hashes = bytearray()
+        # Hashes that are not md5 hex digests are kept as they are.
+        self.other_hashes: dict[int, tuple[str, str]] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, file_id: str) -> bool:
+        return file_id in self.rows
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.ids)
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes used by the arrays, not including the ids."""
+        return (self.actions.itemsize * len(self.actions)
+                + self.sizes.itemsize * len(self.sizes)
+                + self.hashed.itemsize * len(self.hashed)
+                + len(self.hashes))
+
+    @staticmethod
+    def from_files(files: dict[str, UOFile],
+                   sizes: Optional[dict[str, int]] = None) -> 'FileTable':
+        """Creates a table from the tracked files and their remote sizes."""
+        sizes = sizes if sizes else {}
+        table = FileTable()
+        for file_id, uofile in files.items():
+            table.add(file_id, uofile.action, uofile.remote_hashes,
+                      sizes.get(file_id, -1))
+        return table
+
+    def add(self, file_id: str, action: FileAction = FileAction.NONE,
+            hashes: Optional[tuple[str, str]] = None,
+            size: int = -1) -> int:
+        """Adds a file, merging it with an existing row the same way the
+        tracked files are: the higher priority action is kept and hashes
+        and sizes replace the previous ones. Returns the row.
+        """
+        row = self.rows.get(file_id, None)
+        if row is None:
+            row = len(self.ids)
+            self.rows[file_id] = row
+            self.ids.append(file_id)
+            self.actions.append(action)
+            self.sizes.append(size)
+            self.hashed.append(0)
+            self.hashes.extend(bytes(FileTable.HASH_BYTES * 2))
+        else:
+            self.actions[row] = max(self.actions[row], action)
+            if size >= 0:
+                self.sizes[row] = size
+
+        if hashes:
+            self._set_hashes(row, hashes)
+        return row
+
+    def action(self, row: int) -> FileAction:
+        """Gets the action for the row."""
+        return FileAction(self.actions[row])
+
+    def size(self, row: int) -> int:
+        """Gets the remote size for the row, -1 if unknown."""
+        return self.sizes[row]
+
+    def remote_hashes(self, row: int) -> Optional[tuple[str, str]]:
+        """Gets the remote hashes for the row as lowercase hex digests."""
+        if not self.hashed[row]:
+            return None
+        if row in self.other_hashes:
+            return self.other_hashes[row]
+        start = row * FileTable.HASH_BYTES * 2
+        middle = start + FileTable.HASH_BYTES
+        return (self.hashes[start:middle].hex(),
+                self.hashes[middle:middle + FileTable.HASH_BYTES].hex())
+
+    def uofile(self, row: int) -> UOFile:
+        """Creates the UOFile for the row."""
+        # The action is a prefix on the name, not the entire path.
+        parent, sep, name = self.ids[row].rpartition(os.sep)
+        prefix = ACTION_PREFIX[self.action(row)]
+        uofile = UOFile(f"{parent}{sep}{prefix}{name}")
+        uofile.remote_hashes = self.remote_hashes(row)
+        return uofile
+
+    def _set_hashes(self, row: int, hashes: tuple[str, str]) -> None:
+        """Stores the hashes as raw bytes if they are md5 digests."""
+        self.hashed[row] = 1
+        try:
+            packed = b''.join(bytes.fromhex(value) for value in hashes)
+        except ValueError:
+            packed = b''
+        if len(packed) != FileTable.HASH_BYTES * 2:
+            self.other_hashes[row] = (hashes[0], hashes[1])
+            return
+
+        self.other_hashes.pop(row, None)
+        start = row * FileTable.HASH_BYTES * 2
+        self.hashes[start:start + len(packed)] = packed
@@ -0,0 +1,96 @@
+import os
+import json
+import pathlib
+import threading
+from typing import Optional
+
+from log import Log
+from localindex import stat_key
+
+
+class HashCache:
+    """Persistent cache of local md5 hashes. Each file id maps to the
+    (size, mtime_ns, inode, md5) of the file when it was last hashed, a
+    file only needs to be hashed again if its stat data has changed.
+    """
+    FILENAME: str = "HashCache"
+    VERSION: int = 1
+
+    def __init__(self, local_root: str) -> None:
+        self.file_path = pathlib.Path(local_root, HashCache.FILENAME)
+        self.entries: dict[str, tuple[int, int, int, str]] = {}
+        self.hits: int = 0
+        self.misses: int = 0
+        self.loaded: bool = False
+        self._lock = threading.Lock()
+        self._dirty: bool = False
+
+    def load(self) -> bool:
+        """Loads the cache from the local file."""
+        if not self.file_path.is_file():
+            return False
+
+        try:
+            with open(self.file_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') != HashCache.VERSION:
+                return False
+            self.entries = {file_id: tuple(entry)
+                            for file_id, entry in data['files'].items()}
+            self.loaded = True
+        except BaseException as exc:
+            Log.warn(f"Could not load '{HashCache.FILENAME}', "
+                     f"rebuilding: {exc}")
+            self.entries = {}
+            return False
+        return True
+
+    def save(self) -> None:
+        """Saves the cache, only if it has been modified."""
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {'version': HashCache.VERSION, 'files': self.entries}
+            self.file_path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = self.file_path.with_name(f"{HashCache.FILENAME}.tmp")
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.replace(temp_path, self.file_path)
+            self._dirty = False
+
+    def lookup(self, file_id: str,
+               key: Optional[tuple[int, int, int]]) -> Optional[str]:
+        """Gets the cached md5 for a file if its stat data is unchanged."""
+        entry = self.entries.get(file_id, None)
+        if entry and key and tuple(entry[:3]) == key:
+            self.hits += 1
+            return entry[3]
+        self.misses += 1
+        return None
+
+    def store(self, file_id: str, local_resource: str, md5: str) -> None:
+        """Adds or replaces the entry for a file that was just hashed."""
+        key = stat_key(local_resource)
+        if not key:
+            self.evict(file_id)
+            return
+
+        with self._lock:
+            self.entries[file_id] = (*key, md5)
+            self._dirty = True
+
+    def evict(self, file_id: str) -> None:
+        """Removes the entry for a file."""
+        with self._lock:
+            if self.entries.pop(file_id, None):
+                self._dirty = True
+
+    def prune(self, file_ids: set[str]) -> None:
+        """Removes all entries that are not part of the file ids."""
+        with self._lock:
+            stale = [file_id for file_id in self.entries
+                     if file_id not in file_ids]
+            for file_id in stale:
+                del self.entries[file_id]
+            if stale:
+                self._dirty = True
@@ -1,4 +1,10 @@
-from uofile import UOFile
+from typing import Iterable, Optional
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from uofile import UOFile, md5sum, parse_uofile, parse_int
+from hashcache import HashCache
+from journal import Journal
+from filetable import FileTable
 from updatefile import UpdateFile
 
 
@@ -10,36 +16,142 @@ class Hashes(UpdateFile):
                          remote_root=remote_root,
                          local_root=local_root)
         self.sizes: dict[str, int] = {}
+        self.compressed_sizes: dict[str, int] = {}
         self.local_hashes: dict[str, str] = {}
+        self.cache = HashCache(local_root)
+        # Records the files committed while a plan is being applied.
+        self.journal: Optional[Journal] = None
 
-    def build_localhash(self) -> None:
-        """Generates all the local md5 hashes for the files"""
-        for file_id, uofile in self.FILES.items():
-            md5sum = uofile.get_md5sum()
-            if md5sum:
-                self.local_hashes[file_id] = md5sum
+    def build_localhash(self, workers: int = 1,
+                        use_processes: bool = False,
+                        buffer_size: int = 1024 * 1024,
+                        rehash: bool = False,
+                        file_ids: Optional[Iterable[str]] = None) -> None:
+        """Generates all the local md5 hashes for the files. Files that
+        have not changed since they were last hashed are obtained from the
+        HashCache unless a rehash is requested. If more than one worker is
+        requested the files are hashed in parallel, using threads by
+        default since hashlib releases the GIL. The stat of every file is
+        read from the local index when one has been scanned. If file ids
+        are passed only those files are checked, the hashes of the others
+        are kept.
+        """
+        if not rehash and not self.cache.loaded:
+            self.cache.load()
 
-    def _process(self, line_data: str, _: int):
-        """Extracts information for the file."""
-        # Filename, Hash, Hash, Size
-        data = line_data.split('\t')
+        # Split the existing files into cached and those needing a hash.
+        targets: list[tuple[str, str]] = []
+        files = self.FILES
+        if file_ids is not None:
+            files = {file_id: self.FILES[file_id] for file_id in file_ids
+                     if file_id in self.FILES}
+        for file_id, uofile in files.items():
+            key = uofile.stat_key()
+            uofile.refresh(key[0] if key else -1)
+            if not key:
+                # File no longer exists locally.
+                self.local_hashes.pop(file_id, None)
+                self.cache.evict(file_id)
+                continue
 
-        # Ignore bad inputs.
-        if len(data) < 3:
-            return
+            md5 = None if rehash else self.cache.lookup(file_id, key)
+            if md5:
+                self.local_hashes[file_id] = md5
+            else:
+                targets.append((file_id, uofile.local_resource))
+
+        resources = [resource for _, resource in targets]
+        if workers <= 1 or len(targets) <= 1:
+            results = [md5sum(resource, buffer_size) for resource in resources]
+        else:
+            pool = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+            with pool(max_workers=workers) as executor:
+                results = list(executor.map(
+                    md5sum, resources, [buffer_size] * len(resources),
+                    chunksize=1 if not use_processes else 16))
+
+        for (file_id, resource), md5 in zip(targets, results):
+            if md5:
+                self.local_hashes[file_id] = md5
+                self.cache.store(file_id, resource, md5)
+
+        # Keep the same ordering as the manifest for consistency.
+        self.local_hashes = {file_id: self.local_hashes[file_id]
+                             for file_id in self.FILES
+                             if file_id in self.local_hashes}
+        self.cache.prune(set(self.FILES))
+        self.cache.save()
+
+    def clear(self) -> None:
+        """Forgets the sizes that were loaded, the local hashes are kept."""
+        super().clear()
+        self.sizes.clear()
+        self.compressed_sizes.clear()
+
+    def file_table(self) -> FileTable:
+        """Creates a compact table of the tracked files and remote sizes,
+        an alternative to keeping a UOFile for every entry of very large
+        manifests.
+        """
+        return FileTable.from_files(self.FILES, self.sizes)
 
-        uofile = UOFile(data[0])
-        if not uofile.name or len(uofile.name) == 0:
+    def store_local(self, uofile: UOFile, md5: Optional[str] = None) -> None:
+        """Records the hash of a local file that was just written,
+        hashing it if the md5 was not provided.
+        """
+        if not md5:
+            md5 = uofile.get_md5sum()
+        if not md5:
             return
+        self.local_hashes[uofile.id] = md5
+        self.cache.store(uofile.id, uofile.local_resource, md5)
+        if self.journal:
+            self.journal.commit(uofile.id, uofile.local_resource, md5)
+
+    def remove_local(self, uofile: UOFile) -> None:
+        """Forgets the local hash of a file that has been removed."""
+        self.local_hashes.pop(uofile.id, None)
+        self.cache.evict(uofile.id)
+        if self.journal:
+            self.journal.remove(uofile.id)
+
+    def _accepts_line(self, line: str) -> bool:
+        """Every line needs a name and both hashes."""
+        return not line.strip() or len(line.split('\t')) >= 3
+
+    def _process(self, line_data: str, line_number: int):
+        """Extracts information for the file."""
+        self._process_lines([line_data], line_number)
+
+    def _process_lines(self, lines: list[str], _: int):
+        """Extracts the information for a block of files."""
+        files = self.FILES
+        sizes = self.sizes
+        compressed_sizes = self.compressed_sizes
+        for line in lines:
+            # Filename, Hash, Hash, Size, Compressed Size (optional)
+            data = line.strip().split('\t')
+
+            # Ignore bad inputs.
+            if len(data) < 3:
+                continue
+
+            uofile = parse_uofile(data[0])
+            if not uofile.name:
+                continue
+
+            # Size of the pre-compressed '.gz' copy, if the host has one.
+            if len(data) >= 5:
+                compressed = parse_int(data[4])
+                if compressed > 0:
+                    compressed_sizes[uofile.id] = compressed
 
-        # Attempt to extract the size.
-        size: int = -1
-        try:
-            if len(data) >= 4:
-                size = int(data[3])
-        except BaseException:
-            size = -1
-
-        # Update the hashes.
-        self.add_hashes(uofile, (data[1].lower(), data[2].lower()))
-        self.sizes[uofile.id] = size
+            # Update the hashes, the same as add_hashes.
+            hashes = (data[1].lower(), data[2].lower())
+            tracked = files.get(uofile.id, None)
+            if tracked:
+                tracked.remote_hashes = hashes
+            else:
+                uofile.remote_hashes = hashes
+                files[uofile.id] = uofile
+            sizes[uofile.id] = parse_int(data[3]) if len(data) >= 4 else -1
@@ -0,0 +1,141 @@
+import os
+import json
+import pathlib
+import threading
+from typing import Optional, TextIO
+
+from log import Log
+from localindex import stat_key
+
+
+class Journal:
+    """Append-only record of a patch in progress. The first line holds
+    the plan: the version, the validators of the update files it was made
+    from and the files to download and remove. A line is appended as each
+    file is committed, after the download has been moved into place, with
+    the size, mtime, inode and md5 it was committed with. An interrupted
+    patch is continued from the journal without scanning and hashing the
+    local files again. A line torn by a crash ends the replay.
+    """
+    FILENAME: str = "Journal"
+    VERSION: int = 1
+
+    def __init__(self, local_root: str) -> None:
+        self.file_path = pathlib.Path(local_root, Journal.FILENAME)
+        self.version: Optional[str] = None
+        self.files: dict[str, dict] = {}
+        self.create: list[str] = []
+        self.delete: list[str] = []
+        self.committed: dict[str, tuple[int, int, int, str]] = {}
+        self.removed: set[str] = set()
+        self._file: Optional[TextIO] = None
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self) -> bool:
+        """Checks if a plan was loaded that has not finished."""
+        return self.version is not None
+
+    def matches(self, version: str, files: dict[str, dict]) -> bool:
+        """Checks if the pending plan was made from the same update files,
+        identified by their version and validators.
+        """
+        return (self.pending and self.version == version
+                and self.files == files)
+
+    def load(self) -> bool:
+        """Replays the journal left by an interrupted patch."""
+        if not self.file_path.is_file():
+            return False
+
+        try:
+            with open(self.file_path, 'r', encoding='utf-8') as f:
+                for n, line in enumerate(f):
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    if n == 0:
+                        self._load_plan(record)
+                    else:
+                        self._replay(record)
+        except BaseException as exc:
+            Log.warn(f"Could not load '{Journal.FILENAME}': {exc}")
+            self.version = None
+            return False
+        return self.pending
+
+    def begin(self, version: str, files: dict[str, dict],
+              create: list[str], delete: list[str]) -> None:
+        """Starts the journal for a new plan, replacing the previous one.
+        The plan is written through a temporary file so it is never
+        partial.
+        """
+        self.close()
+        self.version, self.files = version, dict(files)
+        self.create, self.delete = list(create), list(delete)
+        self.committed, self.removed = {}, set()
+
+        plan = {'journal': Journal.VERSION, 'version': version,
+                'files': self.files, 'create': self.create,
+                'delete': self.delete}
+        self.file_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.file_path.with_name(f"{Journal.FILENAME}.tmp")
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(plan, separators=(',', ':')) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.file_path)
+        self._file = open(self.file_path, 'a', encoding='utf-8')
+
+    def commit(self, file_id: str, local_resource: str, md5: str) -> None:
+        """Records a file that was downloaded and moved into place."""
+        key = stat_key(local_resource)
+        if key:
+            self._append({'commit': file_id, 'stat': key, 'md5': md5})
+
+    def remove(self, file_id: str) -> None:
+        """Records a file that was removed."""
+        self._append({'remove': file_id})
+
+    def finish(self) -> None:
+        """Removes the journal once the plan has been fully applied."""
+        self.close()
+        self.version = None
+        try:
+            os.remove(self.file_path)
+        except FileNotFoundError:
+            pass
+
+    def close(self) -> None:
+        """Stops recording, the journal is kept to be continued."""
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    def _append(self, record: dict) -> None:
+        """Writes a single line, flushed so it survives the process."""
+        line = json.dumps(record, separators=(',', ':')) + "\n"
+        with self._lock:
+            if not self._file:
+                return
+            self._file.write(line)
+            self._file.flush()
+
+    def _load_plan(self, record: dict) -> None:
+        """Reads the plan from the first line."""
+        if record.get('journal') != Journal.VERSION:
+            raise ValueError("unsupported version")
+        self.version = record['version']
+        self.files = record.get('files', {})
+        self.create = record.get('create', [])
+        self.delete = record.get('delete', [])
+
+    def _replay(self, record: dict) -> None:
+        """Applies a line recorded for a file."""
+        if 'commit' in record:
+            self.committed[record['commit']] = (*record['stat'],
+                                                record['md5'])
+        elif 'remove' in record:
+            self.removed.add(record['remove'])
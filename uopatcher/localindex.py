@@ -0,0 +1,138 @@
+import os
+import threading
+from stat import S_ISREG
+from typing import Iterable, Iterator, Optional
+
+from log import Log
+
+# Files the patcher keeps in the local root for its own state.
+STATE_FILES: set[str] = {'Manifest', 'Hashes', 'HashCache', 'Validators',
+                         'Journal', 'Snapshot'}
+
+# Suffixes of files that are still being written.
+PARTIAL_SUFFIXES: tuple[str, ...] = ('.part', '.tmp')
+
+
+def stat_key(local_resource: str) -> Optional[tuple[int, int, int]]:
+    """Gets the (size, mtime_ns, inode) of a regular file, None if it does
+    not exist or is not a regular file.
+    """
+    try:
+        stat = os.stat(local_resource)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    if not S_ISREG(stat.st_mode):
+        return None
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+class LocalIndex:
+    """Index of every regular file under the local root, built with a
+    single pass of os.scandir. Each path relative to the root, the same
+    as a file id, maps to the (size, mtime_ns, inode) of the file, so the
+    local state of every tracked file can be read without a stat each.
+    Entries are updated as files are downloaded or removed.
+    """
+
+    def __init__(self, local_root: str) -> None:
+        self.local_root = local_root
+        self.entries: dict[str, tuple[int, int, int]] = {}
+        self.scanned: bool = False
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @staticmethod
+    def covers(file_id: str) -> bool:
+        """Checks if the file id is a path inside of the local root, those
+        that are anchored or go up a directory are not indexed.
+        """
+        return bool(file_id) and not (file_id[0] in (os.sep, os.altsep)
+                                      or ':' in file_id or '..' in file_id)
+
+    def scan(self) -> int:
+        """Walks the local root, replacing the index. Returns the amount
+        of files found.
+        """
+        entries = {os.path.normcase(path): key
+                   for path, key in LocalIndex.walk(self.local_root)}
+        with self._lock:
+            self.entries = entries
+            self.scanned = True
+        return len(entries)
+
+    @staticmethod
+    def walk(root: str) -> Iterator[tuple[str, tuple[int, int, int]]]:
+        """Finds every regular file under the root with a single pass of
+        os.scandir, producing the path relative to the root and the
+        (size, mtime_ns, inode) of each.
+        """
+        visited: set[tuple[int, int]] = set()
+        stack: list[tuple[str, str]] = [('', root or '.')]
+        while stack:
+            prefix, directory = stack.pop()
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        found = LocalIndex._visit(entry, prefix, stack,
+                                                  visited)
+                        if found:
+                            yield found
+            except FileNotFoundError:
+                continue
+            except OSError as exc:
+                Log.debug(f"Could not scan '{directory}': {exc}")
+
+    @staticmethod
+    def _visit(entry: os.DirEntry, prefix: str,
+               stack: list[tuple[str, str]],
+               visited: set[tuple[int, int]]
+               ) -> Optional[tuple[str, tuple[int, int, int]]]:
+        """Gets the path and state of a file or queues a directory to be
+        scanned.
+        """
+        try:
+            if entry.is_dir():
+                # Directories are followed once, even through links.
+                stat = entry.stat()
+                if (stat.st_dev, stat.st_ino) not in visited:
+                    visited.add((stat.st_dev, stat.st_ino))
+                    stack.append((f"{prefix}{entry.name}{os.sep}",
+                                  entry.path))
+            elif entry.is_file():
+                stat = entry.stat()
+                # The inode is not part of the scan results on Windows.
+                inode = entry.inode() if os.name == 'nt' else stat.st_ino
+                return (prefix + entry.name,
+                        (stat.st_size, stat.st_mtime_ns, inode))
+        except OSError:
+            # Removed while scanning or a broken link.
+            pass
+        return None
+
+    def get(self, file_id: str) -> Optional[tuple[int, int, int]]:
+        """Gets the (size, mtime_ns, inode) of a file, None if missing."""
+        return self.entries.get(os.path.normcase(file_id), None)
+
+    def update(self, file_id: str,
+               local_resource: str) -> Optional[tuple[int, int, int]]:
+        """Reads the state of a file again after it was changed."""
+        key = stat_key(local_resource)
+        file_id = os.path.normcase(file_id)
+        with self._lock:
+            if key:
+                self.entries[file_id] = key
+            else:
+                self.entries.pop(file_id, None)
+        return key
+
+    def untracked(self, file_ids: Iterable[str]) -> list[str]:
+        """Gets the files that are not part of the file ids, ignoring the
+        state of the patcher and files that are still being written.
+        """
+        known = {os.path.normcase(file_id) for file_id in file_ids}
+        state = {os.path.normcase(name) for name in STATE_FILES}
+        return sorted(file_id for file_id in self.entries
+                      if file_id not in known and file_id not in state
+                      and not file_id.endswith(PARTIAL_SUFFIXES))
@@ -1,4 +1,6 @@
+import threading
 from enum import IntEnum, auto
+from typing import Optional, TextIO
 
 
 class LogType(IntEnum):
@@ -14,7 +16,11 @@ class Log:
     """Representation of a log used for printing information."""
     debug_mode: bool = False
     verbose_mode: bool = False
+    quiet_mode: bool = False
+    # Where the logs are printed, stdout if unset.
+    stream: Optional[TextIO] = None
     _last_len: int = 0
+    _lock = threading.Lock()
 
     @staticmethod
     def notify(msg: str, end: str = '\n') -> None:
@@ -45,6 +51,8 @@ class Log:
     def do(msg: str, end: str = '\n',
            logtype: LogType = LogType.INFO) -> None:
         """Creates a log input, saving if it ends in a new line."""
+        if Log.quiet_mode and logtype < LogType.WARN:
+            return
         if logtype == LogType.NOTIFY:
             Log._print(f"[{logtype.name.lower()}] {msg}", end=end)
         if logtype == LogType.INFO:
@@ -63,19 +71,20 @@ class Log:
     @staticmethod
     def clear() -> None:
         """Clears the current line, this is used on updating text."""
-        print(' ' * Log._last_len, end='\r')
+        print(' ' * Log._last_len, end='\r', file=Log.stream)
 
     @staticmethod
     def _print(text: str, end: str = '\n') -> None:
         """Prints text to console. By default, it creates a new line.
         Passing '\r' makes it return the cursor to the beginning of the line.
         """
-        diff: int = Log._last_len - len(text)
-        extra = ''
-        if diff > 0:
-            extra = ' ' * diff
-        print(f"{text}{extra}", end=end)
-        Log._last_len = len(text)
+        with Log._lock:
+            diff: int = Log._last_len - len(text)
+            extra = ''
+            if diff > 0:
+                extra = ' ' * diff
+            print(f"{text}{extra}", end=end, file=Log.stream)
+            Log._last_len = len(text)
 
     @staticmethod
     def _info(text: str, end: str = '\n') -> None:
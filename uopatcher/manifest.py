@@ -1,4 +1,4 @@
-from uofile import UOFile, FileAction
+from uofile import FileAction, parse_uofile
 from updatefile import UpdateFile, Version
 
 
@@ -12,17 +12,44 @@ class Manifest(UpdateFile):
         self.version: Version = Version((0, 0, 0, 0))
         self.data: dict[str, FileAction] = {}
 
+    def clear(self) -> None:
+        """Forgets the version and actions that were loaded."""
+        super().clear()
+        self.version = Version((0, 0, 0, 0))
+        self.data.clear()
+
+    def _accepts_line(self, line: str) -> bool:
+        """The first line needs to be the version."""
+        try:
+            Version.parse(line.strip())
+        except ValueError:
+            return False
+        return True
+
     def _process(self, line_data: str, line_number: int):
         """Used to process a specific line from the file."""
-        # Extract the version.
-        if line_number == 1:
-            self.version = Version(Version.parse(line_data))
-            return
-
-        # Extract the file.
-        uofile = UOFile(line_data)
-        if not uofile.name or len(uofile.name) == 0:
-            return
-
-        self.add_uofile(uofile)
-        self.data[uofile.id] = uofile.action
+        self._process_lines([line_data], line_number)
+
+    def _process_lines(self, lines: list[str], line_number: int):
+        """Processes a block of lines, the first line is the version and
+        every other line is a file.
+        """
+        files = self.FILES
+        data = self.data
+        for n, line in enumerate(lines, line_number):
+            # Extract the version.
+            if n == 1:
+                self.version = Version(Version.parse(line.strip()))
+                continue
+
+            # Extract the file.
+            uofile = parse_uofile(line)
+            if not uofile.name:
+                continue
+
+            # Track the file, the same as add_uofile.
+            original = files.get(uofile.id, None)
+            if original and original.action > uofile.action:
+                uofile.action = original.action
+            files[uofile.id] = uofile
+            data[uofile.id] = uofile.action
@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import pathlib
+import threading
+from contextlib import contextmanager
+
+
+class Metrics:
+    """Records the timing of each phase of a patch along with statistics
+    for every downloaded file, exported as a JSON report or a Prometheus
+    textfile.
+    """
+
+    def __init__(self, remote: str = "") -> None:
+        self.remote = remote
+        self.version: str = ""
+        self.started: float = time.time()
+        self.phases: dict[str, float] = {}
+        self.files: dict[str, dict] = {}
+        self.counters: dict[str, float] = {}
+        self.mirrors: list[dict] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        """Times the code within the context as the named phase."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - start
+
+    def record_file(self, file_id: str, size: int, duration: float,
+                    retries: int, failed: bool,
+                    transferred: int = -1) -> None:
+        """Records the result of downloading a single file. Transferred is
+        the amount of bytes sent over the network, which is less than the
+        size if the file was compressed.
+        """
+        with self._lock:
+            self.files[file_id] = {
+                'bytes': size,
+                'transferred': transferred if transferred >= 0 else size,
+                'seconds': round(duration, 6),
+                'retries': retries,
+                'failed': failed,
+            }
+
+    def count(self, name: str, value: float) -> None:
+        """Sets a counter that is included in the report."""
+        with self._lock:
+            self.counters[name] = value
+
+    @property
+    def downloaded(self) -> int:
+        """Total amount of bytes downloaded."""
+        return sum(entry['bytes'] for entry in self.files.values())
+
+    @property
+    def transferred(self) -> int:
+        """Total amount of bytes sent over the network."""
+        return sum(entry['transferred'] for entry in self.files.values())
+
+    @property
+    def compression_saved(self) -> int:
+        """Amount of bytes that did not need to be sent due to compression."""
+        return max(0, self.downloaded - self.transferred)
+
+    @property
+    def retries(self) -> int:
+        """Total amount of retries for the downloaded files."""
+        return sum(entry['retries'] for entry in self.files.values())
+
+    @property
+    def failures(self) -> int:
+        """Total amount of files that could not be downloaded."""
+        return sum(1 for entry in self.files.values() if entry['failed'])
+
+    @property
+    def download_rate(self) -> float:
+        """Download rate in bytes per second for the download phase."""
+        elapsed = self.phases.get('pull_updates', 0.0)
+        if elapsed <= 0:
+            return 0.0
+        return self.downloaded / elapsed
+
+    def to_dict(self) -> dict:
+        """Converts the metrics into a dictionary."""
+        return {
+            'remote': self.remote,
+            'version': self.version,
+            'started': self.started,
+            'phases': {name: round(seconds, 6)
+                       for name, seconds in self.phases.items()},
+            'downloaded': self.downloaded,
+            'download_rate': round(self.download_rate, 3),
+            'transferred': self.transferred,
+            'compression_saved': self.compression_saved,
+            'retries': self.retries,
+            'failures': self.failures,
+            'counters': dict(self.counters),
+            'mirrors': list(self.mirrors),
+            'files': dict(self.files),
+        }
+
+    def write_json(self, file_path: str) -> None:
+        """Writes the report as JSON."""
+        _write_atomic(file_path, json.dumps(self.to_dict(), indent=2))
+
+    def write_prometheus(self, file_path: str) -> None:
+        """Writes the report in the Prometheus textfile format."""
+        remote = _escape(self.remote)
+        lines = [
+            "# TYPE uopatcher_info gauge",
+            f'uopatcher_info{{remote="{remote}",'
+            f'version="{self.version}"}} 1',
+            "# TYPE uopatcher_last_run_timestamp_seconds gauge",
+            f"uopatcher_last_run_timestamp_seconds {self.started:.0f}",
+            "# TYPE uopatcher_phase_seconds gauge",
+        ]
+        lines += [f'uopatcher_phase_seconds{{phase="{name}"}} {seconds:.6f}'
+                  for name, seconds in self.phases.items()]
+        lines += [
+            "# TYPE uopatcher_download_bytes gauge",
+            f"uopatcher_download_bytes {self.downloaded}",
+            "# TYPE uopatcher_transfer_bytes gauge",
+            f"uopatcher_transfer_bytes {self.transferred}",
+            "# TYPE uopatcher_compression_saved_bytes gauge",
+            f"uopatcher_compression_saved_bytes {self.compression_saved}",
+            "# TYPE uopatcher_download_rate_bytes_per_second gauge",
+            f"uopatcher_download_rate_bytes_per_second "
+            f"{self.download_rate:.3f}",
+            "# TYPE uopatcher_files_downloaded gauge",
+            f"uopatcher_files_downloaded {len(self.files) - self.failures}",
+            "# TYPE uopatcher_files_failed gauge",
+            f"uopatcher_files_failed {self.failures}",
+            "# TYPE uopatcher_download_retries gauge",
+            f"uopatcher_download_retries {self.retries}",
+        ]
+        if self.mirrors:
+            lines.append("# TYPE uopatcher_mirror_throughput_bytes_per_second"
+                         " gauge")
+            lines += [f'uopatcher_mirror_throughput_bytes_per_second'
+                      f'{{mirror="{_escape(mirror["url"])}"}} '
+                      f'{mirror["throughput"]:.3f}'
+                      for mirror in self.mirrors]
+            lines.append("# TYPE uopatcher_mirror_failures gauge")
+            lines += [f'uopatcher_mirror_failures'
+                      f'{{mirror="{_escape(mirror["url"])}"}} '
+                      f'{mirror["failures"]}'
+                      for mirror in self.mirrors]
+        for name, value in self.counters.items():
+            lines.append(f"# TYPE uopatcher_{name} gauge")
+            lines.append(f"uopatcher_{name} {value}")
+        _write_atomic(file_path, "\n".join(lines) + "\n")
+
+
+def _escape(value: str) -> str:
+    """Escapes a Prometheus label value."""
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _write_atomic(file_path: str, data: str) -> None:
+    """Writes a file so that readers never see it partially written."""
+    path = pathlib.Path(file_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(f"{path.name}.tmp")
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(data)
+    os.replace(temp_path, path)
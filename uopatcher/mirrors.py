@@ -0,0 +1,232 @@
+import time
+import threading
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+
+from log import Log
+from connpool import ConnectionPool
+
+
+class Mirror:
+    """A remote host serving the patches and how it has performed during
+    the run. Latency and throughput are moving averages of the probe and
+    the transfers, the cost is the expected seconds to transfer a typical
+    file and is used to rank the mirrors.
+    """
+    SMOOTHING: float = 0.3
+    REFERENCE_SIZE: int = 4 * 1024 * 1024
+    MIN_SAMPLE: int = 64 * 1024
+    UNKNOWN_TRANSFER: float = 1.0
+
+    def __init__(self, url: str, order: int = 0) -> None:
+        self.url = url.rstrip('/')
+        self.order = order
+        self.latency: float = 0.0
+        self.throughput: float = 0.0
+        self.successes: int = 0
+        self.failures: int = 0
+        self.streak: int = 0
+        self.demotions: int = 0
+        self.demoted_until: float = 0.0
+
+    @property
+    def healthy(self) -> bool:
+        """Checks if the mirror is not currently demoted."""
+        return time.monotonic() >= self.demoted_until
+
+    @property
+    def cost(self) -> float:
+        """Expected seconds to transfer a typical file, growing with each
+        consecutive failure.
+        """
+        transfer = Mirror.UNKNOWN_TRANSFER
+        if self.throughput > 0:
+            transfer = Mirror.REFERENCE_SIZE / self.throughput
+        return (self.latency + transfer) * (1 + self.streak)
+
+    def resource(self, file_id: str) -> str:
+        """The location of a file on the mirror."""
+        return f"{self.url}/{file_id}"
+
+    def record_success(self, amount: int, seconds: float) -> None:
+        """Records a completed transfer. Large transfers update the
+        throughput, small ones are mostly latency.
+        """
+        self.successes += 1
+        self.streak = 0
+        if seconds <= 0:
+            return
+        if amount >= Mirror.MIN_SAMPLE:
+            self.throughput = self._average(self.throughput,
+                                            amount / seconds)
+        else:
+            self.latency = self._average(self.latency, seconds)
+
+    def record_failure(self, demote_after: int,
+                       demote_seconds: float) -> bool:
+        """Records a failed transfer, demoting the mirror after too many
+        failures in a row. Returns True if it was demoted.
+        """
+        self.failures += 1
+        self.streak += 1
+        if self.streak < demote_after:
+            return False
+        self.demote(demote_seconds)
+        return True
+
+    def demote(self, seconds: float) -> None:
+        """Stops using the mirror for a while, longer each time."""
+        self.demotions += 1
+        self.demoted_until = (time.monotonic()
+                              + seconds * 2 ** min(self.demotions - 1, 6))
+
+    def to_dict(self) -> dict:
+        """Converts the statistics of the mirror into a dictionary."""
+        return {
+            'url': self.url,
+            'latency': round(self.latency, 6),
+            'throughput': round(self.throughput, 3),
+            'cost': round(self.cost, 6),
+            'successes': self.successes,
+            'failures': self.failures,
+            'demotions': self.demotions,
+            'healthy': self.healthy,
+        }
+
+    def _average(self, current: float, sample: float) -> float:
+        """Moves the average towards the new sample."""
+        if current <= 0:
+            return sample
+        return current + (sample - current) * Mirror.SMOOTHING
+
+
+class MirrorSet:
+    """Every mirror the patches can be obtained from. Files are taken
+    from the mirror with the lowest cost, failing over to the next one on
+    errors. Mirrors that keep failing are demoted, they are only used once
+    the healthy mirrors have been tried.
+    """
+    SHARED: Optional['MirrorSet'] = None
+    PROBE_SIZE: int = 256 * 1024
+    PROBE_TIMEOUT: float = 5.0
+    DEMOTE_AFTER: int = 2
+    DEMOTE_SECONDS: float = 30.0
+    # Mirrors slower than this fraction of the best do not share segments.
+    SPREAD_RATIO: float = 0.25
+
+    def __init__(self, urls: list[str]) -> None:
+        self.mirrors: list[Mirror] = []
+        for url in urls:
+            if url.rstrip('/') not in (mirror.url for mirror in self.mirrors):
+                self.mirrors.append(Mirror(url, len(self.mirrors)))
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.mirrors)
+
+    @staticmethod
+    def shared() -> Optional['MirrorSet']:
+        """Gets the mirrors shared by every transfer, None if the patches
+        are only on a single host.
+        """
+        return MirrorSet.SHARED
+
+    @staticmethod
+    def configure(urls: list[str]) -> Optional['MirrorSet']:
+        """Sets up the shared mirrors, removing them if there is only one
+        host.
+        """
+        mirrors = MirrorSet(urls)
+        MirrorSet.SHARED = mirrors if len(mirrors) > 1 else None
+        return MirrorSet.SHARED
+
+    @property
+    def best(self) -> Mirror:
+        """The mirror that is currently preferred."""
+        return self.ranked()[0]
+
+    def ranked(self) -> list[Mirror]:
+        """Gets the mirrors in the order they should be tried, healthy ones
+        by cost followed by the demoted ones.
+        """
+        with self._lock:
+            healthy = [mirror for mirror in self.mirrors if mirror.healthy]
+            demoted = [mirror for mirror in self.mirrors
+                       if not mirror.healthy]
+            healthy.sort(key=lambda mirror: (mirror.cost, mirror.order))
+            demoted.sort(key=lambda mirror: mirror.demoted_until)
+        return healthy + demoted
+
+    def spread(self, first: Mirror) -> list[Mirror]:
+        """Gets the mirrors a large file can be split across, starting
+        with the one passed and excluding those that are demoted or much
+        slower than it.
+        """
+        mirrors = [first]
+        for mirror in self.ranked():
+            if mirror is first or not mirror.healthy:
+                continue
+            if (first.throughput > 0 and mirror.throughput
+                    < first.throughput * MirrorSet.SPREAD_RATIO):
+                continue
+            mirrors.append(mirror)
+        return mirrors
+
+    def record(self, mirror: Mirror, amount: int, seconds: float,
+               success: bool) -> None:
+        """Records the result of a transfer from a mirror."""
+        with self._lock:
+            if success:
+                mirror.record_success(amount, seconds)
+                return
+            demoted = mirror.record_failure(MirrorSet.DEMOTE_AFTER,
+                                            MirrorSet.DEMOTE_SECONDS)
+        if demoted:
+            Log.warn(f"Mirror '{mirror.url}' is failing, demoting it.")
+
+    def probe(self, path: str = "Manifest") -> None:
+        """Measures the latency and throughput of every mirror at the same
+        time by requesting the start of a file. Mirrors that cannot be
+        reached are demoted.
+        """
+        pool = ConnectionPool(1, timeout=MirrorSet.PROBE_TIMEOUT)
+        try:
+            with ThreadPoolExecutor(max_workers=len(self)) as executor:
+                for mirror in self.mirrors:
+                    executor.submit(self._probe, mirror, path, pool)
+        finally:
+            pool.close()
+
+    def to_dict(self) -> list[dict]:
+        """Converts the statistics of every mirror into a list."""
+        with self._lock:
+            return [mirror.to_dict() for mirror in self.mirrors]
+
+    def _probe(self, mirror: Mirror, path: str, pool: ConnectionPool) -> None:
+        """Probes a single mirror, see probe."""
+        start = time.perf_counter()
+        received: int = 0
+        try:
+            response = pool.request(
+                mirror.resource(path),
+                {"Range": f"bytes=0-{MirrorSet.PROBE_SIZE - 1}"})
+            with response:
+                latency = time.perf_counter() - start
+                while received < MirrorSet.PROBE_SIZE:
+                    chunk = response.read(
+                        min(64 * 1024, MirrorSet.PROBE_SIZE - received))
+                    if not chunk:
+                        break
+                    received += len(chunk)
+        except Exception as exc:
+            Log.debug(f"Could not probe mirror '{mirror.url}': {exc}")
+            with self._lock:
+                mirror.failures += 1
+                mirror.demote(MirrorSet.DEMOTE_SECONDS)
+            return
+
+        elapsed = time.perf_counter() - latency - start
+        with self._lock:
+            mirror.latency = latency
+            if received >= Mirror.MIN_SAMPLE and elapsed > 0:
+                mirror.throughput = received / elapsed
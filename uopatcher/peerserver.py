@@ -0,0 +1,273 @@
+import os
+import re
+import time
+import threading
+import urllib.parse
+from http import HTTPStatus
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Optional
+
+from log import Log
+from hashcache import HashCache
+from localindex import stat_key
+from uofile import parse_uofile
+from bundle import Bundle, write_bundle
+
+
+class PeerIndex:
+    """Files of the local root that are safe to share with other patchers.
+    A file is only served if its HashCache entry has the md5 listed in the
+    Hashes and the file still has the stat data it had when it was hashed,
+    so nothing partially written or modified since is handed out. The
+    index is rebuilt whenever the Hashes or HashCache change.
+    """
+    UPDATE_FILES: tuple[str, ...] = ('Manifest', 'Hashes')
+    REFRESH_SECONDS: float = 2.0
+
+    def __init__(self, local_root: str) -> None:
+        self.local_root = local_root
+        self.files: dict[str, tuple[str, tuple[int, int, int]]] = {}
+        self._stamp: Optional[tuple] = None
+        self._checked: float = 0.0
+        self._lock = threading.Lock()
+
+    def refresh(self) -> int:
+        """Rebuilds the index if the state files changed since the last
+        check. Returns the amount of files that can be served.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if (self._stamp is not None
+                    and now - self._checked < PeerIndex.REFRESH_SECONDS):
+                return len(self.files)
+            self._checked = now
+
+            names = PeerIndex.UPDATE_FILES + (HashCache.FILENAME,)
+            stamp = tuple(stat_key(os.path.join(self.local_root, name))
+                          for name in names)
+            if stamp != self._stamp:
+                self.files = self._build()
+                self._stamp = stamp
+                Log.debug(f"Serving {len(self.files)} verified files.")
+            return len(self.files)
+
+    def lookup(self, file_id: str
+               ) -> Optional[tuple[str, tuple[int, int, int]]]:
+        """Gets the local resource and the stat data it was verified with,
+        None if the file cannot be served.
+        """
+        self.refresh()
+        return self.files.get(os.path.normcase(file_id), None)
+
+    def _build(self) -> dict[str, tuple[str, tuple[int, int, int]]]:
+        """Verifies every file in the Hashes against the HashCache."""
+        cache = HashCache(self.local_root)
+        cache.load()
+
+        files: dict[str, tuple[str, tuple[int, int, int]]] = {}
+        for name in PeerIndex.UPDATE_FILES:
+            resource = os.path.join(self.local_root, name)
+            key = stat_key(resource)
+            if key:
+                files[os.path.normcase(name)] = (resource, key)
+
+        hashes_path = os.path.join(self.local_root, 'Hashes')
+        if not os.path.isfile(hashes_path):
+            return files
+
+        with open(hashes_path, 'r', encoding='utf-8-sig') as f:
+            for line in f:
+                data = line.strip().split('\t')
+                if len(data) < 3:
+                    continue
+                uofile = parse_uofile(data[0])
+                entry = cache.entries.get(uofile.id, None)
+                if (not uofile.name or not entry
+                        or entry[3] not in (data[1].lower(),
+                                            data[2].lower())):
+                    continue
+                files[os.path.normcase(uofile.id)] = (
+                    os.path.join(self.local_root, uofile.id),
+                    tuple(entry[:3]))
+        return files
+
+
+class PeerRequestHandler(BaseHTTPRequestHandler):
+    """Serves the verified files laid out the same as the remote host,
+    with keep-alive, byte ranges and ETag validation. File contents are
+    sent with sendfile so they are not copied through the process. Small
+    files can be requested together as a bundle.
+    """
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    RANGE = re.compile(r"bytes=(\d+)-(\d*)$")
+    MAX_REQUEST: int = 1024 * 1024
+
+    def __init__(self, *args, peer: 'PeerServer', **kwargs) -> None:
+        self.peer = peer
+        super().__init__(*args, **kwargs)
+
+    def log_message(self, format: str, *args) -> None:
+        """Only logs the requests while debugging."""
+        Log.debug(f"{self.address_string()} {format % args}")
+
+    def do_GET(self) -> None:
+        """Serves the body of a file."""
+        self._serve(send_body=True)
+
+    def do_HEAD(self) -> None:
+        """Serves only the headers of a file."""
+        self._serve(send_body=False)
+
+    def do_POST(self) -> None:
+        """Serves the requested files that are verified as a bundle."""
+        path = urllib.parse.urlsplit(self.path).path.strip('/')
+        try:
+            length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            length = -1
+        if path != Bundle.PATH or not 0 < length <= self.MAX_REQUEST:
+            # The body was not read, the connection cannot be reused.
+            self.close_connection = True
+            self._empty(HTTPStatus.NOT_FOUND if path != Bundle.PATH
+                        else HTTPStatus.BAD_REQUEST)
+            return
+
+        members = []
+        for name in Bundle.parse_request(self.rfile.read(length)):
+            file_id = os.sep.join(part for part in name.split('/') if part)
+            verified = self.peer.index.lookup(file_id)
+            if verified:
+                members.append((name, *verified))
+
+        # The size is not known up front, the end of the stream marks it.
+        self.close_connection = True
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/x-tar")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        try:
+            write_bundle(self.wfile, members)
+        except OSError:
+            return
+        self.peer.count(sum(key[0] for _, _, key in members))
+
+    def _serve(self, send_body: bool) -> None:
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        file_id = os.sep.join(part for part in
+                              path.replace('\\', '/').split('/') if part)
+        verified = self.peer.index.lookup(file_id)
+        if not verified:
+            self._empty(HTTPStatus.NOT_FOUND)
+            return
+
+        resource, key = verified
+        try:
+            f = open(resource, 'rb')
+        except OSError:
+            self._empty(HTTPStatus.NOT_FOUND)
+            return
+
+        with f:
+            # Changed since it was verified, it cannot be trusted.
+            stat = os.fstat(f.fileno())
+            if (stat.st_size, stat.st_mtime_ns, stat.st_ino) != key:
+                self._empty(HTTPStatus.NOT_FOUND)
+                return
+            self._send_file(f, stat.st_size, stat.st_mtime_ns, send_body)
+
+    def _send_file(self, f, size: int, mtime_ns: int,
+                   send_body: bool) -> None:
+        """Sends the requested range of an open file."""
+        etag = f'"{mtime_ns:x}-{size:x}"'
+        if self.headers.get("If-None-Match") == etag:
+            self._empty(HTTPStatus.NOT_MODIFIED, {"ETag": etag})
+            return
+
+        first, last = 0, size - 1
+        match = self.RANGE.match(self.headers.get("Range", ""))
+        if match:
+            first = int(match.group(1))
+            if match.group(2):
+                last = min(int(match.group(2)), size - 1)
+            if first >= size or first > last:
+                self._empty(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE,
+                            {"Content-Range": f"bytes */{size}"})
+                return
+            self.send_response(HTTPStatus.PARTIAL_CONTENT)
+            self.send_header("Content-Range", f"bytes {first}-{last}/{size}")
+        else:
+            self.send_response(HTTPStatus.OK)
+
+        length = max(0, last - first + 1)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.end_headers()
+        if not send_body or length == 0:
+            return
+
+        sent = self.connection.sendfile(f, first, length)
+        self.peer.count(sent)
+        if sent < length:
+            # The client went away, the connection is unusable.
+            self.close_connection = True
+
+    def _empty(self, status: HTTPStatus,
+               headers: Optional[dict[str, str]] = None) -> None:
+        """Sends a response without a body."""
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class PeerServer:
+    """Shares an up-to-date local root with other patchers on the network,
+    which can use it as their remote root or as a mirror.
+    """
+
+    def __init__(self, local_root: str, host: str = "0.0.0.0",
+                 port: int = 8090) -> None:
+        self.index = PeerIndex(local_root)
+        self.bytes_sent: int = 0
+        self.requests: int = 0
+        self._lock = threading.Lock()
+
+        def handler(*args, **kwargs):
+            return PeerRequestHandler(*args, peer=self, **kwargs)
+
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def address(self) -> str:
+        """Address the server is listening on."""
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, sent: int) -> None:
+        """Records a served file."""
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += sent
+
+    def serve_forever(self) -> None:
+        """Serves until interrupted."""
+        self.index.refresh()
+        self.httpd.serve_forever()
+
+    def start(self) -> 'PeerServer':
+        """Serves on a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stops serving and closes the socket."""
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,130 @@
+import json
+from typing import Optional
+
+from hashes import Hashes
+from journal import Journal
+from uofile import UOFile, FileAction
+
+
+def get_action(hashes: Hashes, uofile: UOFile,
+               remote_size: int) -> FileAction:
+    """Determines the action that needs to be performed for a UO File."""
+    # Check if the local version exists.
+    action: FileAction = FileAction.NONE
+    local_hash = hashes.local_hashes.get(uofile.id, None)
+
+    if not local_hash and uofile.action != FileAction.DELETE:
+        # File needs to be downloaded since it does not exist.
+        action = FileAction.CREATE
+    elif (uofile.local_size >= 0 and remote_size >= 0
+          and uofile.action == FileAction.NONE
+          and uofile.local_size != remote_size):
+        # File may not have been downloaded correctly.
+        action = FileAction.CREATE
+    elif local_hash and uofile.action == FileAction.DELETE:
+        # Mark the file for deletion.
+        action = FileAction.DELETE
+    elif local_hash and uofile.action == FileAction.CREATE:
+        # File exists, should not be updated every patch.
+        action = FileAction.NONE
+    elif local_hash and uofile.remote_hashes:
+        if local_hash not in uofile.remote_hashes:
+            # Hash mismatch, needs the new version.
+            action = FileAction.CREATE
+    return action
+
+
+class Plan:
+    """The actions a patch would perform, created without modifying any
+    of the local files.
+    """
+
+    def __init__(self, version: str = "") -> None:
+        self.version = version
+        self.create: list[UOFile] = []
+        self.delete: list[UOFile] = []
+        self.skip: list[UOFile] = []
+        self.sizes: dict[str, int] = {}
+        # Local files that the manifest does not know about.
+        self.untracked: list[str] = []
+
+    @property
+    def create_size(self) -> int:
+        """Amount of bytes expected to be downloaded."""
+        return sum(max(0, self.sizes.get(uofile.id, 0))
+                   for uofile in self.create)
+
+    @property
+    def delete_size(self) -> int:
+        """Amount of bytes expected to be freed by deleting files."""
+        return sum(max(0, uofile.local_size) for uofile in self.delete)
+
+    def add(self, uofile: UOFile, action: FileAction,
+            remote_size: int) -> None:
+        """Adds a file to the list for its action."""
+        self.sizes[uofile.id] = remote_size
+        if action == FileAction.CREATE:
+            self.create.append(uofile)
+        elif action == FileAction.DELETE:
+            self.delete.append(uofile)
+        else:
+            self.skip.append(uofile)
+
+    def to_dict(self) -> dict:
+        """Converts the plan into a dictionary."""
+        return {
+            'version': self.version,
+            'create': [{'id': uofile.id, 'size': self.sizes[uofile.id]}
+                       for uofile in self.create],
+            'delete': [{'id': uofile.id, 'size': uofile.local_size}
+                       for uofile in self.delete],
+            'skip': [uofile.id for uofile in self.skip],
+            'untracked': self.untracked,
+            'create_size': self.create_size,
+            'delete_size': self.delete_size,
+        }
+
+    def to_json(self, indent: Optional[int] = 2) -> str:
+        """Converts the plan into JSON."""
+        return json.dumps(self.to_dict(), indent=indent)
+
+
+def build_plan(files: dict[str, UOFile], hashes: Hashes,
+               version: str = "") -> Plan:
+    """Decides the action for every file that is tracked."""
+    plan = Plan(version)
+    for _, uofile in files.items():
+        remote_size = hashes.sizes.get(uofile.id, 0)
+        plan.add(uofile, get_action(hashes, uofile, remote_size), remote_size)
+    return plan
+
+
+def resume_plan(files: dict[str, UOFile], hashes: Hashes, journal: Journal,
+                version: str = "") -> Plan:
+    """Rebuilds the remaining work of an interrupted patch from its
+    journal. Files committed with the same stat data they have now are
+    restored into the local hashes and HashCache instead of being checked
+    again, everything else in the journal's plan is still to be done.
+    """
+    if not hashes.cache.loaded:
+        hashes.cache.load()
+
+    plan = Plan(version)
+    for file_id in journal.create:
+        uofile = files.get(file_id, None)
+        if not uofile:
+            continue
+
+        committed = journal.committed.get(file_id, None)
+        if committed and uofile.stat_key() == tuple(committed[:3]):
+            hashes.local_hashes[file_id] = committed[3]
+            hashes.cache.store(file_id, uofile.local_resource, committed[3])
+            continue
+        plan.add(uofile, FileAction.CREATE, hashes.sizes.get(file_id, 0))
+
+    for file_id in journal.delete:
+        uofile = files.get(file_id, None)
+        if uofile and file_id not in journal.removed:
+            plan.add(uofile, FileAction.DELETE,
+                     hashes.sizes.get(file_id, 0))
+    return plan
@@ -0,0 +1,134 @@
+import time
+import threading
+from datetime import datetime
+from typing import Optional
+
+# Suffixes allowed when passing a rate, such as '512K' or '2M'.
+UNITS: dict[str, int] = {'': 1, 'B': 1, 'K': 1024, 'M': 1024 ** 2,
+                         'G': 1024 ** 3}
+
+
+def parse_rate(value: str) -> int:
+    """Converts a rate such as '512K' or '2M' into bytes per second,
+    0 means the rate is unlimited.
+    """
+    raw = value.strip().upper().removesuffix('/S').removesuffix('B')
+    if not raw:
+        return 0
+
+    unit = raw[-1] if raw[-1] in UNITS else ''
+    number = raw[:-1] if unit else raw
+    try:
+        return max(0, int(float(number) * UNITS[unit]))
+    except ValueError:
+        raise ValueError(f"Could not parse the rate: {value}")
+
+
+def parse_minutes(value: str) -> int:
+    """Converts a time of day 'HH:MM' into minutes past midnight."""
+    hours, _, minutes = value.strip().partition(':')
+    return (int(hours) * 60 + int(minutes or 0)) % (24 * 60)
+
+
+class RateSchedule:
+    """Rates that apply during periods of the day, such as:
+        08:00-23:00=512K; 23:00-08:00=0
+    Periods may wrap past midnight, outside of all periods the default
+    rate is used.
+    """
+
+    def __init__(self, raw: str = "") -> None:
+        self.periods: list[tuple[int, int, int]] = []
+        for entry in raw.split(';'):
+            if not entry.strip():
+                continue
+            span, _, rate = entry.partition('=')
+            start, _, end = span.partition('-')
+            self.periods.append((parse_minutes(start), parse_minutes(end),
+                                 parse_rate(rate)))
+
+    def rate(self, default: int, now: Optional[datetime] = None) -> int:
+        """Gets the rate for the current time of day."""
+        now = now if now else datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.periods:
+            if start <= end and start <= minute < end:
+                return rate
+            if start > end and (minute >= start or minute < end):
+                return rate
+        return default
+
+
+class TokenBucket:
+    """Limits the bandwidth shared by every transfer in the process.
+    Tokens (bytes) refill at the rate and each read takes tokens from the
+    bucket, waiting when it runs dry. Reads are limited to a fraction of a
+    second of transfer so throughput stays smooth instead of bursting.
+    """
+    SHARED: Optional['TokenBucket'] = None
+    SMOOTHING: float = 0.1
+    MIN_CHUNK: int = 16 * 1024
+
+    def __init__(self, max_rate: int,
+                 schedule: Optional[RateSchedule] = None) -> None:
+        self.max_rate = max_rate
+        self.schedule = schedule if schedule else RateSchedule()
+        self._tokens: float = 0.0
+        self._last: float = time.monotonic()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def shared() -> Optional['TokenBucket']:
+        """Gets the limiter shared by every transfer, None if unlimited."""
+        bucket = TokenBucket.SHARED
+        if bucket and bucket.rate > 0:
+            return bucket
+        return None
+
+    @staticmethod
+    def configure(max_rate: int, schedule: str = "") -> None:
+        """Sets up the shared limiter, removing it if nothing is limited."""
+        rate_schedule = RateSchedule(schedule)
+        if max_rate <= 0 and not rate_schedule.periods:
+            TokenBucket.SHARED = None
+            return
+        TokenBucket.SHARED = TokenBucket(max_rate, rate_schedule)
+
+    @property
+    def rate(self) -> int:
+        """Current rate in bytes per second, 0 is unlimited."""
+        return self.schedule.rate(self.max_rate)
+
+    def chunk_size(self, chunk_size: int) -> int:
+        """Size a read should be so it stays within the smoothing window."""
+        rate = self.rate
+        if rate <= 0:
+            return chunk_size
+        return max(1, min(chunk_size,
+                          max(TokenBucket.MIN_CHUNK,
+                              int(rate * TokenBucket.SMOOTHING))))
+
+    def consume(self, amount: int) -> None:
+        """Takes the amount of tokens, waiting until they are available."""
+        wait = self.reserve(amount)
+        if wait > 0:
+            time.sleep(wait)
+
+    def reserve(self, amount: int) -> float:
+        """Takes the amount of tokens, returning the seconds the caller
+        needs to wait before they are available.
+        """
+        rate = self.rate
+        if rate <= 0 or amount <= 0:
+            return 0.0
+
+        burst = max(TokenBucket.MIN_CHUNK, rate * TokenBucket.SMOOTHING)
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(burst,
+                               self._tokens + (now - self._last) * rate)
+            self._last = now
+
+            # Go into debt, later callers wait behind this one.
+            self._tokens -= amount
+            return -self._tokens / rate if self._tokens < 0 else 0.0
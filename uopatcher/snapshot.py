@@ -0,0 +1,98 @@
+import os
+import json
+import time
+import pathlib
+from typing import Optional
+
+from log import Log
+from uofile import UOFile
+
+# Remote state of a file: the action, the remote hashes and the size.
+Entry = tuple[int, Optional[tuple[str, ...]], int]
+
+
+class Snapshot:
+    """The remote state of every tracked file from the Manifest and Hashes
+    that were last fully applied. Diffing it against the newly downloaded
+    files gives the entries that were added or changed, only those need to
+    be checked and downloaded. It also records when every tracked file was
+    last checked, so a full check can be made now and then regardless.
+    """
+    FILENAME: str = "Snapshot"
+    VERSION: int = 1
+
+    def __init__(self, local_root: str) -> None:
+        self.file_path = pathlib.Path(local_root, Snapshot.FILENAME)
+        self.version: Optional[str] = None
+        self.entries: dict[str, Entry] = {}
+        self.verified: float = 0.0
+        self.loaded: bool = False
+
+    @staticmethod
+    def capture(files: dict[str, UOFile], sizes: dict[str, int]
+                ) -> dict[str, Entry]:
+        """Gets the remote state of the tracked files."""
+        return {file_id: (int(uofile.action), uofile.remote_hashes,
+                          sizes.get(file_id, -1))
+                for file_id, uofile in files.items()}
+
+    def diff(self, current: dict[str, Entry]
+             ) -> tuple[set[str], set[str], set[str]]:
+        """Compares the current state to the snapshot, getting the ids
+        that were added, removed and changed.
+        """
+        added = {file_id for file_id in current
+                 if file_id not in self.entries}
+        removed = {file_id for file_id in self.entries
+                   if file_id not in current}
+        changed = {file_id for file_id, entry in current.items()
+                   if file_id not in added
+                   and self.entries[file_id] != entry}
+        return added, removed, changed
+
+    def due(self, interval: float) -> bool:
+        """Checks if a full check is due, the interval is in hours."""
+        return (not self.loaded or interval <= 0
+                or time.time() - self.verified >= interval * 3600)
+
+    def load(self) -> bool:
+        """Loads the snapshot from the local file."""
+        if not self.file_path.is_file():
+            return False
+
+        try:
+            with open(self.file_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') != Snapshot.VERSION:
+                return False
+            self.version = data['manifest']
+            self.verified = float(data['verified'])
+            self.entries = {file_id: (action,
+                                      tuple(hashes) if hashes else None,
+                                      size)
+                            for file_id, (action, hashes, size)
+                            in data['files'].items()}
+            self.loaded = True
+        except BaseException as exc:
+            Log.warn(f"Could not load '{Snapshot.FILENAME}', "
+                     f"checking every file: {exc}")
+            self.entries = {}
+            return False
+        return True
+
+    def save(self, version: str, entries: dict[str, Entry],
+             verified: bool) -> None:
+        """Replaces the snapshot with the state that was just applied,
+        recording the time if every file was checked.
+        """
+        self.version, self.entries = version, entries
+        if verified:
+            self.verified = time.time()
+        data = {'version': Snapshot.VERSION, 'manifest': version,
+                'verified': self.verified, 'files': entries}
+        self.file_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.file_path.with_name(f"{Snapshot.FILENAME}.tmp")
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(temp_path, self.file_path)
+        self.loaded = True
@@ -1,13 +1,21 @@
 import os
 import sys
 import pathlib
+import zlib
+import time
 import hashlib
-import urllib.request
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from enum import IntEnum, auto
-from typing import Optional
+from typing import Callable, Optional, NamedTuple
 from datetime import datetime
 
 from log import Log
+from ratelimit import TokenBucket
+from localindex import LocalIndex, stat_key
+from mirrors import MirrorSet
+from delta import BLOCKS_SUFFIX, BlockList, DeltaPlan, block_digests
+from connpool import ConnectionPool, PooledResponse, HTTPStatusError
 
 
 def progress_bar(resource: str, size: int, max_size: int,
@@ -19,52 +27,206 @@ def progress_bar(resource: str, size: int, max_size: int,
     percentage: float = size / max_size * 100
     size_mb = size / 1024 / 1024
 
-    # Calculate the mb per second.
+    # Calculate the megabytes per second.
     elapsed = datetime.now() - start_time
-    mbps = size_mb / elapsed.total_seconds()
+    mb_per_sec = size_mb / max(elapsed.total_seconds(), 1e-6)
 
     Log.info(f"Downloading: '{resource}' "
              f"[{percentage:0.2f}%] "
-             f"{mbps:0.2f} mbps", end='\r')
+             f"{mb_per_sec:0.2f} MB/s", end='\r')
+
+
+class DownloadStats(NamedTuple):
+    """Statistics for a download.
+        size [bytes] of the local file,
+        elapsed [seconds] spent downloading,
+        complete if the file passed its checks and was put into place,
+        downloaded [bytes] transferred during this download,
+        md5 of the local file if it was checked,
+        modified if the remote differed from the local file,
+        validators (ETag / Last-Modified) sent with the remote file,
+        transferred [bytes] over the network, less if it was compressed.
+    """
+    size: int
+    elapsed: float
+    complete: bool
+    downloaded: int
+    md5: Optional[str] = None
+    modified: bool = True
+    validators: Optional[dict[str, str]] = None
+    transferred: int = 0
+
+
+def get_validators(response: PooledResponse) -> dict[str, str]:
+    """Extracts the validators used for conditional requests."""
+    validators: dict[str, str] = {}
+    for header in ("etag", "last-modified"):
+        value = response.getheader(header, None)
+        if value:
+            validators[header] = value
+    return validators
+
+
+def read_limited(response: PooledResponse, chunk_size: int) -> bytes:
+    """Reads a chunk from the response, honoring the bandwidth limit that
+    is shared by every transfer.
+    """
+    bucket = TokenBucket.shared()
+    if not bucket:
+        return response.read(chunk_size)
+
+    chunk = response.read(bucket.chunk_size(chunk_size))
+    bucket.consume(len(chunk))
+    return chunk
+
+
+def partial_resource(local_resource: str) -> str:
+    """Location of the partial download for a local resource."""
+    return f"{local_resource}.part"
+
+
+def open_remote(pool: ConnectionPool, remote_resource: str,
+                offset: int = 0,
+                extra_headers: Optional[dict[str, str]] = None,
+                ) -> tuple[PooledResponse, int]:
+    """Opens the remote resource, requesting the content starting at the
+    offset if it is above zero. Returns the response and the offset the
+    response actually starts at.
+    """
+    headers: dict[str, str] = dict(extra_headers or {})
+    if offset > 0:
+        headers["Range"] = f"bytes={offset}-"
+
+    try:
+        response = pool.request(remote_resource, headers)
+    except HTTPStatusError as exc:
+        if offset > 0 and exc.code == 416:
+            # Partial download is not usable, obtain the entire file.
+            return open_remote(pool, remote_resource,
+                               extra_headers=extra_headers)
+        raise
+
+    if response.status == 304:
+        # Local copy is current, nothing will be sent.
+        return response, offset
+
+    if offset > 0 and response.status == 206:
+        # Make sure the server is resuming from the requested position.
+        content_range = response.getheader("content-range", "")
+        if content_range.startswith(f"bytes {offset}-"):
+            return response, offset
+        response.close()
+        return open_remote(pool, remote_resource,
+                           extra_headers=extra_headers)
+
+    # Server ignored the range, a full copy is being sent.
+    return response, 0
 
 
 def download_file(remote_resource: str,
                   local_resource: str,
                   chunk_size: int = 1024 * 1024,
                   show_progress: bool = False,
-                  ) -> tuple[int, float, bool]:
+                  expected_size: int = -1,
+                  expected_hashes: Optional[tuple[str, ...]] = None,
+                  pool: Optional[ConnectionPool] = None,
+                  headers: Optional[dict[str, str]] = None,
+                  accept_gzip: bool = False,
+                  gzipped: bool = False,
+                  verify: Optional[Callable[[str], bool]] = None,
+                  ) -> DownloadStats:
     """Downloads a file from a remote host into a local repository.
-    Returns a tuple containing (size [bytes], time [seconds])
+    The file is written to a '.part' file first, resuming an existing one
+    if the server supports ranges and the result can be checked against
+    the expected hashes. The md5 is updated as the chunks arrive
+    and the file is only moved into place after the size and hash checks
+    pass, an incomplete '.part' is kept to resume.
+    Connections are reused from the pool, the shared one by default.
+    Additional headers, such as conditional ones, can be sent. If the
+    remote reports it was not modified, the local file is left untouched.
+    If accepted, gzip encoded responses (or a gzipped remote resource) are
+    decompressed while streaming, sizes and hashes are of the decompressed
+    content. If passed, verify is called with the '.part' file and must
+    accept it before it replaces the local file.
     """
     start: datetime = datetime.now()
+    pool = pool if pool else ConnectionPool.shared()
+    part_resource = partial_resource(local_resource)
+
+    # Resume from the previous partial download if one exists. Without
+    # hashes a '.part' of another version could not be told apart.
+    offset: int = 0
+    if expected_hashes and os.path.isfile(part_resource):
+        offset = os.stat(part_resource).st_size
+        if 0 < expected_size < offset:
+            offset = 0
+
+    # Compressed content can only be requested from the start.
+    request_headers = dict(headers or {})
+    if accept_gzip and offset == 0:
+        request_headers["Accept-Encoding"] = "gzip"
 
     # Get the stream we will be pulling from.
-    request = urllib.request.urlopen(remote_resource)
+    request, offset = open_remote(pool, remote_resource, offset,
+                                  request_headers)
+    validators = get_validators(request)
 
     as_path = pathlib.Path(remote_resource)
     name = as_path.name
 
+    if request.status == 304:
+        request.read()
+        request.close()
+        elapsed = (datetime.now() - start).total_seconds()
+        size = os.stat(local_resource).st_size
+        return DownloadStats(size, elapsed, True, 0, modified=False,
+                             validators=validators)
+
     # Calculate size of the downloaded content.
     max_size: int = 0
     content_length = request.getheader("content-length", None)
     if content_length:
         try:
-            max_size = int(content_length)
+            max_size = offset + int(content_length)
         except BaseException:
             max_size = 0
 
+    # Decompress the content if it is being sent compressed.
+    decoder = None
+    encoding = request.getheader("content-encoding", "").lower()
+    if offset == 0 and (gzipped or encoding in ("gzip", "x-gzip")):
+        decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    wire_size: int = max_size
+    if decoder:
+        max_size = max(0, expected_size)
+
     # Ensure the local directories exist.
     pathlib.Path(local_resource).parent.mkdir(parents=True, exist_ok=True)
 
+    # The resumed bytes are part of the file, include them in the hash.
+    hash_md5 = hashlib.md5()
+    if offset > 0:
+        md5_update(hash_md5, part_resource, limit=offset)
+
     # Open the local file, download the remote, saving locally.
     has_data: bool = True
-    pulled_size: int = 0
-    with open(local_resource, 'wb') as f:
+    pulled_size: int = offset
+    transferred: int = 0
+    with request, open(part_resource, 'r+b' if offset > 0 else 'wb') as f:
+        f.seek(offset)
+        f.truncate()
         while has_data:
-            chunk = request.read(chunk_size)
+            chunk = read_limited(request, chunk_size)
             if not chunk or len(chunk) == 0:
                 has_data = False
-                continue
+                if decoder:
+                    chunk = decoder.flush()
+                if not chunk:
+                    continue
+            else:
+                transferred += len(chunk)
+                if decoder:
+                    chunk = decoder.decompress(chunk)
 
             # If VERBOSE is enabled in config, print the progress bar.
             if show_progress:
@@ -72,9 +234,344 @@ def download_file(remote_resource: str,
 
             pulled_size += len(chunk)
             f.write(chunk)
+            hash_md5.update(chunk)
+
+    elapsed = (datetime.now() - start).total_seconds()
+    downloaded = pulled_size - offset
+
+    # Keep the partial download if it was cut short, it can be resumed.
+    if ((wire_size > 0 and offset + transferred != wire_size)
+            or (decoder and not decoder.eof)
+            or (expected_size >= 0 and pulled_size != expected_size)):
+        if 0 < expected_size < pulled_size:
+            os.remove(part_resource)
+        return DownloadStats(pulled_size, elapsed, False, downloaded,
+                             validators=validators, transferred=transferred)
+
+    # Verify the contents before replacing the local file.
+    md5 = hash_md5.hexdigest().lower()
+    if expected_hashes and md5 not in expected_hashes:
+        Log.warn(f"Hash mismatch: '{name}'")
+        os.remove(part_resource)
+        return DownloadStats(pulled_size, elapsed, False, downloaded, md5,
+                             validators=validators, transferred=transferred)
+    if verify and not verify(part_resource):
+        Log.warn(f"Unreadable download: '{name}'")
+        os.remove(part_resource)
+        return DownloadStats(pulled_size, elapsed, False, downloaded, md5,
+                             validators=validators, transferred=transferred)
+
+    os.replace(part_resource, local_resource)
+    return DownloadStats(pulled_size, elapsed, True, downloaded, md5,
+                         validators=validators, transferred=transferred)
+
+
+class RangeNotSupported(ConnectionError):
+    """Raised when the remote host ignores a requested byte range."""
+
+
+def fetch_range(pool: ConnectionPool, remote_resource: str,
+                part_resource: str, start: int, end: int,
+                written: list[int], index: int,
+                chunk_size: int = 1024 * 1024,
+                on_chunk=None) -> None:
+    """Downloads the inclusive byte range [start, end] of the remote
+    resource into the same position of the part file. The amount of bytes
+    written is tracked in written[index] so progress survives failures.
+    """
+    offset = start + written[index]
+    if offset > end:
+        return
 
-    elapsed = datetime.now() - start
-    return pulled_size, elapsed.total_seconds(), pulled_size == max_size
+    response = pool.request(remote_resource,
+                            {"Range": f"bytes={offset}-{end}"})
+    with response:
+        content_range = response.getheader("content-range", "")
+        if (response.status != 206
+                or not content_range.startswith(f"bytes {offset}-")):
+            raise RangeNotSupported(f"Range ignored for {remote_resource}")
+
+        with open(part_resource, 'r+b') as f:
+            f.seek(offset)
+            while offset <= end:
+                chunk = read_limited(response,
+                                     min(chunk_size, end - offset + 1))
+                if not chunk:
+                    break
+                f.write(chunk)
+                offset += len(chunk)
+                written[index] += len(chunk)
+                if on_chunk:
+                    on_chunk(len(chunk))
+
+    if offset <= end:
+        raise ConnectionError(f"Range {start}-{end} was cut short.")
+
+
+def download_segmented(remote_resource: str,
+                       local_resource: str,
+                       size: int,
+                       segments: int,
+                       chunk_size: int = 1024 * 1024,
+                       show_progress: bool = False,
+                       expected_hashes: Optional[tuple[str, ...]] = None,
+                       pool: Optional[ConnectionPool] = None,
+                       sources: Optional[list[str]] = None,
+                       on_range: Optional[Callable[[str, int, float, bool],
+                                                   None]] = None,
+                       ) -> DownloadStats:
+    """Downloads a large file as several byte ranges at the same time,
+    writing each into its position of a preallocated '.part' file. Any
+    existing partial download is kept and only the remainder is split. If
+    the server ignores ranges, the single stream download is used instead.
+    The ranges can be spread across several sources of the same file, a
+    failed range is retried from the next source. on_range is called with
+    the source, bytes, seconds and success of every range.
+    """
+    start: datetime = datetime.now()
+    pool = pool if pool else ConnectionPool.shared()
+    part_resource = partial_resource(local_resource)
+    name = pathlib.Path(remote_resource).name
+
+    # Continue after the partial download if one exists.
+    offset: int = 0
+    if os.path.isfile(part_resource):
+        offset = os.stat(part_resource).st_size
+        if offset > size:
+            offset = 0
+
+    # Split the remaining bytes into the segments, preallocating the file.
+    remaining = size - offset
+    segment_size = max(1, -(-remaining // segments))
+    ranges = [(first, min(first + segment_size, size) - 1)
+              for first in range(offset, size, segment_size)]
+    pathlib.Path(local_resource).parent.mkdir(parents=True, exist_ok=True)
+    with open(part_resource, 'r+b' if offset > 0 else 'wb') as f:
+        f.truncate(size)
+
+    lock = threading.Lock()
+    progress: list[int] = [offset]
+
+    def on_chunk(amount: int) -> None:
+        with lock:
+            progress[0] += amount
+            if show_progress:
+                progress_bar(name, progress[0], size, start)
+
+    sources = sources if sources else [remote_resource]
+
+    def fetch_from(source: str, index: int) -> None:
+        first, last = ranges[index]
+        before, started = written[index], time.perf_counter()
+        try:
+            fetch_range(pool, source, part_resource, first, last,
+                        written, index, chunk_size, on_chunk)
+        except Exception:
+            if on_range:
+                on_range(source, written[index] - before,
+                         time.perf_counter() - started, False)
+            raise
+        if on_range:
+            on_range(source, written[index] - before,
+                     time.perf_counter() - started, True)
+
+    def fetch(index: int) -> None:
+        try:
+            fetch_from(sources[index % len(sources)], index)
+        except RangeNotSupported:
+            raise
+        except Exception:
+            # Try the rest of the range once more, from the next source.
+            fetch_from(sources[(index + 1) % len(sources)], index)
+
+    written: list[int] = [0] * len(ranges)
+    failure: Optional[BaseException] = None
+    try:
+        with ThreadPoolExecutor(max_workers=len(ranges) or 1) as executor:
+            for future in [executor.submit(fetch, index)
+                           for index in range(len(ranges))]:
+                exc = future.exception()
+                if exc and not failure:
+                    failure = exc
+    finally:
+        # Only keep the contiguous prefix so the part can be resumed.
+        complete = offset
+        for (first, last), amount in zip(ranges, written):
+            complete += amount
+            if amount < last - first + 1:
+                break
+        if complete < size:
+            with open(part_resource, 'r+b') as f:
+                f.truncate(complete)
+
+    if isinstance(failure, RangeNotSupported):
+        Log.debug(f"Ranges not supported, single stream: '{name}'")
+        return download_file(remote_resource, local_resource, chunk_size,
+                             show_progress, size, expected_hashes, pool)
+
+    elapsed = (datetime.now() - start).total_seconds()
+    downloaded = sum(written)
+    if complete < size:
+        return DownloadStats(complete, elapsed, False, downloaded,
+                             transferred=downloaded)
+
+    # Ranges arrive out of order, the hash can only be checked at the end.
+    md5 = md5sum(part_resource)
+    if expected_hashes and md5 not in expected_hashes:
+        Log.warn(f"Hash mismatch: '{name}'")
+        os.remove(part_resource)
+        return DownloadStats(size, elapsed, False, downloaded, md5,
+                             transferred=downloaded)
+
+    os.replace(part_resource, local_resource)
+    return DownloadStats(size, elapsed, True, downloaded, md5,
+                         transferred=downloaded)
+
+
+def fetch_blocks(pool: ConnectionPool,
+                 remote_resource: str) -> Optional[BlockList]:
+    """Obtains the block checksums the remote publishes for a file, None
+    if there are none or they cannot be read.
+    """
+    try:
+        response = pool.request(f"{remote_resource}{BLOCKS_SUFFIX}")
+    except HTTPStatusError as exc:
+        if exc.code != 404:
+            raise
+        return None
+
+    with response:
+        data = response.read()
+    return BlockList.parse(data.decode('utf-8', errors='replace'))
+
+
+def download_delta(remote_resource: str,
+                   local_resource: str,
+                   expected_size: int,
+                   expected_hashes: Optional[tuple[str, ...]],
+                   max_ratio: float,
+                   chunk_size: int = 1024 * 1024,
+                   show_progress: bool = False,
+                   pool: Optional[ConnectionPool] = None,
+                   ) -> Optional[DownloadStats]:
+    """Updates a local file by only fetching the blocks that differ from
+    the remote, comparing the local blocks with the '.blocks' sidecar of
+    the remote file. The new file is assembled in order into the '.part'
+    file from the local copy and the fetched ranges, then verified against
+    the expected hashes. Returns None if there are no block checksums, the
+    delta is larger than max_ratio of the file, ranges are not supported,
+    or the result does not match, the file should then be downloaded in
+    full. If a transfer is cut short, the '.part' holds the start of the
+    new file and is resumed by the next download.
+    """
+    start: datetime = datetime.now()
+    pool = pool if pool else ConnectionPool.shared()
+    part_resource = partial_resource(local_resource)
+    name = pathlib.Path(remote_resource).name
+
+    blocks = fetch_blocks(pool, remote_resource)
+    if not blocks or blocks.size != expected_size:
+        return None
+
+    plan = DeltaPlan(blocks, block_digests(local_resource,
+                                           blocks.block_size))
+    fetch_size = plan.fetch_size
+    if fetch_size > blocks.size * max_ratio:
+        Log.debug(f"Delta of {fetch_size} bytes too large: '{name}'")
+        return None
+
+    hash_md5 = hashlib.md5()
+    pulled_size: int = 0
+    downloaded: int = 0
+    ranges_ignored: bool = False
+    with open(local_resource, 'rb') as local, \
+            open(part_resource, 'wb') as f:
+        for source, first, last in plan.runs():
+            if source is not None:
+                # Unchanged blocks are copied from the local file.
+                local.seek(source)
+                while pulled_size <= last:
+                    chunk = local.read(min(chunk_size,
+                                           last - pulled_size + 1))
+                    if not chunk:
+                        raise OSError(f"Local copy changed: '{name}'")
+                    f.write(chunk)
+                    hash_md5.update(chunk)
+                    pulled_size += len(chunk)
+                continue
+
+            response = pool.request(remote_resource,
+                                    {"Range": f"bytes={first}-{last}"})
+            with response:
+                content_range = response.getheader("content-range", "")
+                if (response.status != 206
+                        or not content_range.startswith(f"bytes {first}-")):
+                    ranges_ignored = True
+                    break
+                while pulled_size <= last:
+                    chunk = read_limited(response,
+                                         min(chunk_size,
+                                             last - pulled_size + 1))
+                    if not chunk:
+                        raise ConnectionError(
+                            f"Range {first}-{last} was cut short.")
+                    f.write(chunk)
+                    hash_md5.update(chunk)
+                    pulled_size += len(chunk)
+                    downloaded += len(chunk)
+
+            # If VERBOSE is enabled in config, print the progress bar.
+            if show_progress:
+                progress_bar(name, pulled_size, blocks.size, start)
+
+    if ranges_ignored:
+        Log.debug(f"Ranges not supported, no delta: '{name}'")
+        os.remove(part_resource)
+        return None
+
+    elapsed = (datetime.now() - start).total_seconds()
+    md5 = hash_md5.hexdigest().lower()
+    if expected_hashes and md5 not in expected_hashes:
+        Log.warn(f"Delta mismatch: '{name}', downloading it in full.")
+        os.remove(part_resource)
+        return None
+
+    os.replace(part_resource, local_resource)
+    Log.debug(f"Delta of '{name}': fetched {downloaded} of "
+              f"{blocks.size} bytes.")
+    return DownloadStats(blocks.size, elapsed, True, downloaded, md5,
+                         transferred=downloaded)
+
+
+def md5_update(hash_md5, local_resource: str,
+               buffer_size: int = 1024 * 1024, limit: int = -1) -> None:
+    """Updates the md5 with the contents of a local file, only reading
+    up to limit bytes if it is not negative.
+    """
+    with open(local_resource, 'rb') as f:
+        remaining = limit
+        while remaining != 0:
+            size = buffer_size if remaining < 0 else min(buffer_size,
+                                                         remaining)
+            chunk = f.read(size)
+            if not chunk:
+                break
+            hash_md5.update(chunk)
+            if remaining > 0:
+                remaining -= len(chunk)
+
+
+def md5sum(local_resource: str,
+           buffer_size: int = 1024 * 1024) -> Optional[str]:
+    """Generates the md5sum for a local file, reading it in chunks of
+    buffer_size bytes. Returns None if the file does not exist.
+    """
+    hash_md5 = hashlib.md5()
+    try:
+        md5_update(hash_md5, local_resource, buffer_size)
+    except FileNotFoundError:
+        return None
+    return hash_md5.hexdigest().lower()
 
 
 class FileAction(IntEnum):
@@ -84,40 +581,127 @@ class FileAction(IntEnum):
     DELETE = auto()
 
 
+def parse_uofile(raw_filename: str) -> 'UOFile':
+    """Creates the same UOFile as UOFile(raw_filename), splitting simple
+    relative paths directly instead of through pathlib. Anything pathlib
+    would normalize further uses the regular constructor.
+    """
+    cleaned = raw_filename.strip().lstrip('\\').replace('\\', '/')
+    if (not cleaned or cleaned[0] == '/' or cleaned[-1] in '/.'
+            or '//' in cleaned or './' in cleaned or ':' in cleaned):
+        return UOFile(raw_filename)
+
+    parent, _, name = cleaned.rpartition('/')
+    if os.sep != '/':
+        parent = parent.replace('/', os.sep)
+    return UOFile.from_parts(parent or '.', name)
+
+
+def parse_int(value: str, default: int = -1) -> int:
+    """Converts the value the same as int(), returning the default if it
+    cannot be converted. Plain digits skip the exception handling.
+    """
+    if value.isdecimal():
+        return int(value)
+    try:
+        return int(value)
+    except ValueError:
+        return default
+
+
+def local_prefix(local_root: str) -> str:
+    """Normalized local root that a file id is appended to."""
+    prefix = _PREFIXES.get(local_root, None)
+    if prefix is None:
+        prefix = str(pathlib.Path(local_root))
+        if prefix == '.':
+            prefix = ''
+        elif not prefix.endswith(os.sep):
+            prefix += os.sep
+        _PREFIXES[local_root] = prefix
+    return prefix
+
+
+_PREFIXES: dict[str, str] = {}
+
+
 class UOFile:
     """Represents a file for Ultima Online that may need to be
     updated, removed, or untouched.
+    The id is computed once, the local resource is the normalized local root
+    set when the file is created, shared by every file, followed by the id.
+    The size of the local file is cached after
+    the first stat until the file is refreshed, the stat is read from the
+    local index instead when one has been scanned.
     """
+    __slots__ = ('parent', 'name', 'action', 'remote_hashes',
+                 '_id', '_root', '_size')
 
     REMOTE_ROOT: str = ""
     LOCAL_ROOT: str = ""
+    INDEX: Optional[LocalIndex] = None
+    SEGMENTS: int = 1
+    COMPRESSION: bool = True
+    SEGMENT_THRESHOLD: int = 64 * 1024 * 1024
+    DELTA_THRESHOLD: int = 32 * 1024 * 1024
+    DELTA_MAX_RATIO: float = 0.5
 
     def __init__(self, raw_filename: str) -> None:
         cleaned = raw_filename.strip().lstrip('\\').replace('\\', '/')
         as_path = pathlib.Path(cleaned)
-        self.raw_name = raw_filename
-        self.parent = str(as_path.parent)
-        self.name = as_path.name
+        self._setup(str(as_path.parent), as_path.name)
+
+    @staticmethod
+    def from_parts(parent: str, name: str) -> 'UOFile':
+        """Creates a file from an already normalized parent directory and
+        name, which may still have the action prefixed.
+        """
+        uofile = UOFile.__new__(UOFile)
+        uofile._setup(parent, name)
+        return uofile
+
+    def _setup(self, parent: str, name: str) -> None:
+        """Extracts the action and computes the id."""
+        self.parent = sys.intern(parent)
+        self.name = name
         self.remote_hashes: Optional[tuple[str, str]] = None
+        self._size: Optional[int] = None
 
         # Try to extract the action.
         self.action = FileAction.NONE
-        if len(self.name) > 0:
-            if self.name[0] not in ('-', '+'):
-                return
-            if self.name[0] == "-":
-                self.action = FileAction.DELETE
-            elif self.name[0] == "+":
-                self.action = FileAction.CREATE
+        if self.name[:1] == "-":
+            self.action = FileAction.DELETE
+        elif self.name[:1] == "+":
+            self.action = FileAction.CREATE
 
         # Update the name removing the action.
         if self.action != FileAction.NONE:
             self.name = self.name[1:]
 
+        # Same as the string of the relative path, without building it
+        # unless it is anchored to a root or drive.
+        if self.parent == '.' or not self.name:
+            self._id = self.name or self.parent
+        elif ':' in self.parent or self.parent[-1] in (os.sep, os.altsep):
+            self._id = str(pathlib.Path(self.parent, self.name))
+        else:
+            self._id = f"{self.parent}{os.sep}{self.name}"
+
+        # Ids anchored to a root or drive are joined when they are used.
+        self._root: Optional[str] = local_prefix(UOFile.LOCAL_ROOT)
+        if ':' in self._id or self._id[0] in (os.sep, os.altsep):
+            self._root = None
+
+    def accepts(self, part_resource: str) -> bool:
+        """Checks a finished download before it replaces the local file,
+        the remote hashes already cover regular files.
+        """
+        return True
+
     @property
     def id(self) -> str:
         """Gets the ID of the file which is typically the relative path."""
-        return str(self.path)
+        return self._id
 
     @property
     def path(self) -> pathlib.Path:
@@ -126,52 +710,208 @@ class UOFile:
 
     @property
     def local_size(self) -> int:
-        """Gets the size of the file in bytes."""
-        if self.local_exists:
-            return os.stat(self.local_resource).st_size
-        return -1
+        """Gets the size of the file in bytes, -1 if it does not exist."""
+        if self._size is None:
+            key = self.stat_key()
+            self._size = key[0] if key else -1
+        return self._size
+
+    def stat_key(self) -> Optional[tuple[int, int, int]]:
+        """Gets the (size, mtime_ns, inode) of the local file, None if it
+        does not exist.
+        """
+        index = UOFile.INDEX
+        if index and index.scanned and index.covers(self._id):
+            return index.get(self._id)
+        return stat_key(self.local_resource)
 
     @property
     def remote_resource(self) -> str:
         """The remote resource where the file can be obtained."""
-        return f"{UOFile.REMOTE_ROOT}/{self.path}"
+        return f"{UOFile.REMOTE_ROOT}/{self._id}"
 
     @property
     def local_resource(self) -> str:
         """The local resource where the file can be found/saved."""
-        return str(pathlib.Path(UOFile.LOCAL_ROOT, self.parent, self.name))
+        if self._root is None:
+            return str(pathlib.Path(UOFile.LOCAL_ROOT, self._id))
+        return self._root + self._id
 
     @property
     def local_exists(self) -> bool:
         """Checks if a local copy of the file exists."""
-        return pathlib.Path(self.local_resource).is_file()
+        return self.local_size >= 0
 
-    def get_md5sum(self) -> Optional[str]:
+    def refresh(self, size: Optional[int] = None) -> None:
+        """Sets the size of the local file if it is known, otherwise it is
+        obtained again on the next access. Called when the file changes,
+        which also updates its entry in the local index.
+        """
+        self._size = size
+        index = UOFile.INDEX
+        if size is None and index and index.covers(self._id):
+            key = index.update(self._id, self.local_resource)
+            self._size = key[0] if key else -1
+
+    def get_md5sum(self, buffer_size: int = 1024 * 1024) -> Optional[str]:
         """Generates the md5sum for a local file if it exists."""
         if not self.local_exists:
             return None
-
-        # Generate the md5 hash.
-        hash_md5 = hashlib.md5()
-        with open(self.local_resource, 'rb') as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest().lower()
+        return md5sum(self.local_resource, buffer_size)
 
     def download(self,
                  show_progress: bool = False,
-                 ) -> Optional[tuple[int, float, bool]]:
-        """Downloads a file from the remote source.
-        If successful, returns a tuple of the:
-            size [bytes], time[seconds]
+                 expected_size: int = -1,
+                 headers: Optional[dict[str, str]] = None,
+                 compressed_size: int = 0,
+                 ) -> Optional[DownloadStats]:
+        """Downloads a file from the remote source, verifying it against
+        the expected size and remote hashes if they are known. Large files
+        with an outdated local copy only fetch the blocks that changed when
+        the remote publishes their checksums. Files with a compressed size
+        use the pre-compressed '.gz' sibling when it exists, files at or
+        above the segment threshold are downloaded in several ranges. If
+        there are mirrors, they are tried in order until one succeeds.
+        If successful, returns the statistics for the download.
         """
         try:
-            return download_file(self.remote_resource,
-                                 self.local_resource,
-                                 show_progress=show_progress)
+            mirrors = MirrorSet.shared()
+            if mirrors:
+                return self._download_mirrors(mirrors, show_progress,
+                                              expected_size, headers,
+                                              compressed_size)
+            return self._download_from(UOFile.REMOTE_ROOT, show_progress,
+                                       expected_size, headers,
+                                       compressed_size)
         except KeyboardInterrupt:
             Log.warn("Interrupt detected, exiting.")
             sys.exit(1)
         except BaseException as exc:
             Log.error(f"Could not download {self.name}: {exc}")
+        finally:
+            # The local file may have been replaced.
+            self.refresh()
+        return None
+
+    def _download_mirrors(self, mirrors: MirrorSet, show_progress: bool,
+                          expected_size: int,
+                          headers: Optional[dict[str, str]],
+                          compressed_size: int) -> Optional[DownloadStats]:
+        """Downloads the file from the best mirror, failing over to the
+        next one on errors or incomplete transfers. A partial download is
+        resumed from the next mirror. Large files are spread across the
+        healthy mirrors.
+        """
+        stats: Optional[DownloadStats] = None
+        for mirror in mirrors.ranked():
+            sources = {m.resource(self._id): m for m in mirrors.spread(mirror)}
+            ranges: list[str] = []
+
+            def on_range(source: str, amount: int, seconds: float,
+                         success: bool) -> None:
+                ranges.append(source)
+                mirrors.record(sources[source], amount, seconds, success)
+
+            start = time.perf_counter()
+            try:
+                stats = self._download_from(mirror.url, show_progress,
+                                            expected_size, headers,
+                                            compressed_size,
+                                            list(sources), on_range)
+            except Exception as exc:
+                Log.warn(f"Mirror '{mirror.url}' failed for "
+                         f"'{self.name}': {exc}")
+                mirrors.record(mirror, 0, 0.0, False)
+                continue
+
+            # Segmented downloads already recorded each of their ranges.
+            if not ranges:
+                mirrors.record(mirror, stats.transferred,
+                               time.perf_counter() - start, stats.complete)
+            if stats.complete:
+                return stats
+            Log.warn(f"Incomplete from '{mirror.url}': '{self.name}', "
+                     "trying the next mirror.")
+        return stats
+
+    def _download_from(self, remote_root: str, show_progress: bool,
+                       expected_size: int,
+                       headers: Optional[dict[str, str]],
+                       compressed_size: int,
+                       sources: Optional[list[str]] = None,
+                       on_range: Optional[Callable] = None,
+                       ) -> DownloadStats:
+        """Downloads the file from a single remote root, the segments of
+        large files may be spread across the other sources passed.
+        """
+        remote_resource = f"{remote_root}/{self._id}"
+        stats = self._download_delta(remote_resource, show_progress,
+                                     expected_size)
+        if stats:
+            return stats
+        stats = self._download_compressed(remote_resource, show_progress,
+                                          expected_size, compressed_size)
+        if stats:
+            return stats
+        if (UOFile.SEGMENTS > 1
+                and expected_size >= UOFile.SEGMENT_THRESHOLD):
+            return download_segmented(remote_resource,
+                                      self.local_resource,
+                                      expected_size,
+                                      UOFile.SEGMENTS,
+                                      show_progress=show_progress,
+                                      expected_hashes=self.remote_hashes,
+                                      sources=sources,
+                                      on_range=on_range)
+        return download_file(remote_resource,
+                             self.local_resource,
+                             show_progress=show_progress,
+                             expected_size=expected_size,
+                             expected_hashes=self.remote_hashes,
+                             headers=headers,
+                             accept_gzip=UOFile.COMPRESSION,
+                             verify=self.accepts)
+
+    def can_delta(self, expected_size: int) -> bool:
+        """Checks if only the changed blocks of the file can be fetched,
+        which needs a large enough file, a local copy to build it from and
+        no partial download to resume.
+        """
+        return (0 < UOFile.DELTA_THRESHOLD <= expected_size
+                and self.local_size > 0 and bool(self.remote_hashes)
+                and not os.path.isfile(partial_resource(self.local_resource)))
+
+    def _download_delta(self, remote_resource: str, show_progress: bool,
+                        expected_size: int) -> Optional[DownloadStats]:
+        """Updates the local copy with the changed blocks of the remote.
+        Returns None if the file needs to be downloaded in full.
+        """
+        if not self.can_delta(expected_size):
+            return None
+        return download_delta(remote_resource, self.local_resource,
+                              expected_size, self.remote_hashes,
+                              UOFile.DELTA_MAX_RATIO,
+                              show_progress=show_progress)
+
+    def _download_compressed(self, remote_resource: str,
+                             show_progress: bool, expected_size: int,
+                             compressed_size: int) -> Optional[DownloadStats]:
+        """Downloads the pre-compressed '.gz' sibling of the file. Returns
+        None if there is no sibling so the file is downloaded normally.
+        """
+        if (not UOFile.COMPRESSION or compressed_size <= 0
+                or os.path.isfile(partial_resource(self.local_resource))):
+            return None
+
+        try:
+            return download_file(f"{remote_resource}.gz",
+                                 self.local_resource,
+                                 show_progress=show_progress,
+                                 expected_size=expected_size,
+                                 expected_hashes=self.remote_hashes,
+                                 gzipped=True)
+        except HTTPStatusError as exc:
+            if exc.code != 404:
+                raise
+        Log.debug(f"Compressed copy missing: '{self.name}'")
         return None
@@ -1,10 +1,15 @@
+import shutil
+from typing import Optional
+
 from log import Log
-from uofile import UOFile
+from uofile import UOFile, DownloadStats, local_prefix
+from validators import Validators
 
 
 class UpdateFile(UOFile):
     """Represents a file that is required for the updates."""
     FILES: dict[str, UOFile] = {}
+    BLOCK_SIZE: int = 1024 * 1024
 
     def __init__(self,
                  filename: str,
@@ -13,22 +18,24 @@ class UpdateFile(UOFile):
         UOFile.REMOTE_ROOT = remote_root
         UOFile.LOCAL_ROOT = local_root
         super().__init__(filename)
+        self.loaded: bool = False
+        self.modified: bool = True
 
     @staticmethod
     def add_uofile(uofile: UOFile) -> None:
         """Adds a UOFile to be tracked."""
-        original = UpdateFile.FILES.get(str(uofile.path), None)
+        original = UpdateFile.FILES.get(uofile.id, None)
 
         # Assign the higher priority action.
         if original and original.action > uofile.action:
             uofile.action = original.action
 
-        UpdateFile.FILES[str(uofile.path)] = uofile
+        UpdateFile.FILES[uofile.id] = uofile
 
     @staticmethod
     def add_hashes(uofile: UOFile, hashes: tuple[str, str]) -> None:
         """Adds the remote hashes expect for a specific file."""
-        local_file = UpdateFile.FILES.get(str(uofile.path), None)
+        local_file = UpdateFile.FILES.get(uofile.id, None)
 
         # Add the new UOFile to be tracked.
         if not local_file:
@@ -40,34 +47,106 @@ class UpdateFile(UOFile):
         local_file.remote_hashes = hashes
 
     def load(self) -> bool:
-        """Loads the local version of the file."""
+        """Loads the local version of the file. It is read in blocks that
+        are split into lines and processed together, so memory use does
+        not grow with the size of the file.
+        """
         if not self.local_exists:
             return False
 
+        line_number: int = 1
+        remainder: str = ""
         with open(self.local_resource, 'r', encoding='utf-8-sig') as f:
-            for n, line in enumerate(f):
-                self._process(line.strip(), n + 1)
+            while True:
+                block = f.read(UpdateFile.BLOCK_SIZE)
+                if not block:
+                    break
+
+                # The last line may continue into the next block.
+                lines = (remainder + block).split('\n')
+                remainder = lines.pop()
+                self._process_lines(lines, line_number)
+                line_number += len(lines)
+        if remainder:
+            self._process_lines([remainder], line_number)
 
         # Trigger the post-processor if it has been set.
         try:
             self._post_process()
         except NotImplementedError:
             pass
+        self.loaded = True
+        return True
+
+    def relocate(self, directory: str) -> None:
+        """Keeps the file in another directory, starting from a copy of
+        the local one so an unchanged file is still not downloaded again.
+        """
+        exists, previous = self.local_exists, self.local_resource
+        self._root = local_prefix(directory)
+        if exists:
+            shutil.copyfile(previous, self.local_resource)
+        self.refresh()
+
+    def accepts(self, part_resource: str) -> bool:
+        """Checks that a downloaded copy can be read before it replaces
+        the local one, a broken copy would stop every later run.
+        """
+        try:
+            with open(part_resource, 'r', encoding='utf-8-sig') as f:
+                return self._accepts_line(f.readline())
+        except (OSError, UnicodeDecodeError):
+            return False
+
+    def _accepts_line(self, line: str) -> bool:
+        """Checks the first line of a downloaded copy."""
         return True
 
-    def update(self) -> bool:
-        """Updates the file from the remote source."""
+    def clear(self) -> None:
+        """Forgets what was loaded so the file can be loaded again. The
+        tracked files are shared by every update file and are cleared
+        separately.
+        """
+        self.loaded = False
+
+    def update(self, validators: Optional[Validators] = None) -> bool:
+        """Updates the file from the remote source. If validators are
+        passed, the file is only downloaded if the remote has changed.
+        """
         try:
-            if self.download():
-                return self.load()
+            headers = validators.headers(self) if validators else None
+            return self.apply(self.download(headers=headers), validators)
         except BaseException as exc:
             Log.error(f"Could not update {self.name}: {exc}")
         return False
 
+    def apply(self, stats: Optional[DownloadStats],
+              validators: Optional[Validators] = None) -> bool:
+        """Loads the file once it has been downloaded, recording the
+        validators that were sent with it.
+        """
+        if not stats or not stats.complete:
+            return False
+
+        self.modified = stats.modified
+        if validators:
+            validators.store(self, stats)
+        if not self.modified and self.loaded:
+            # Already loaded the same local copy.
+            return True
+        return self.load()
+
     def _process(self, line_data: str, line_number: int):
         """Used to process a specific line from the file."""
         raise NotImplementedError("Update file needs to override processor.")
 
+    def _process_lines(self, lines: list[str], line_number: int):
+        """Processes a block of lines, the first being line_number. Files
+        can override this to process the lines in bulk.
+        """
+        for n, line in enumerate(lines, line_number):
+            self._process(line.strip(), n)
+
     def _post_process(self):
         """Called after the loading of the file has completed."""
         raise NotImplementedError("Post-processor is not set.")
@@ -0,0 +1,88 @@
+import os
+import json
+import pathlib
+
+from log import Log
+from uofile import UOFile, DownloadStats
+
+
+class Validators:
+    """Sidecar file holding the validators (ETag, Last-Modified, size) of
+    the update files so they are only downloaded again when they change.
+    It also records which versions of the files were last fully applied.
+    """
+    FILENAME: str = "Validators"
+
+    def __init__(self, local_root: str) -> None:
+        self.file_path = pathlib.Path(local_root, Validators.FILENAME)
+        self.files: dict[str, dict] = {}
+        self.applied: dict[str, dict] = {}
+
+    def load(self) -> bool:
+        """Loads the validators from the local file."""
+        if not self.file_path.is_file():
+            return False
+
+        try:
+            with open(self.file_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.files = data.get('files', {})
+            self.applied = data.get('applied', {})
+        except BaseException as exc:
+            Log.warn(f"Could not load '{Validators.FILENAME}': {exc}")
+            self.files, self.applied = {}, {}
+            return False
+        return True
+
+    def save(self) -> None:
+        """Saves the validators to the local file."""
+        self.file_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.file_path.with_name(f"{Validators.FILENAME}.tmp")
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'files': self.files, 'applied': self.applied}, f,
+                      indent=2)
+        os.replace(temp_path, self.file_path)
+
+    def headers(self, uofile: UOFile) -> dict[str, str]:
+        """Creates the conditional request headers for a file. Nothing is
+        sent if the local copy no longer matches what was downloaded.
+        """
+        stored = self.files.get(uofile.id, None)
+        if not stored or stored.get('size', -1) != uofile.local_size:
+            return {}
+
+        headers: dict[str, str] = {}
+        if 'etag' in stored:
+            headers['If-None-Match'] = stored['etag']
+        if 'last-modified' in stored:
+            headers['If-Modified-Since'] = stored['last-modified']
+        return headers
+
+    def store(self, uofile: UOFile, stats: DownloadStats) -> None:
+        """Saves the validators received while downloading a file."""
+        if not stats.modified:
+            return
+
+        stored: dict = dict(stats.validators or {})
+        stored['size'] = uofile.local_size
+        self.files[uofile.id] = stored
+        self.save()
+
+    def is_applied(self, version: str) -> bool:
+        """Checks if the current update files and version were already
+        applied to the local files.
+        """
+        return (bool(self.applied)
+                and self.applied.get('version') == version
+                and self.applied.get('files') == self.files)
+
+    def mark_applied(self, version: str) -> None:
+        """Records the current update files and version as applied."""
+        self.applied = {'version': version, 'files': dict(self.files)}
+        self.save()
+
+    def clear_applied(self) -> None:
+        """Removes the applied marker, forcing the next run to diff."""
+        if self.applied:
+            self.applied = {}
+            self.save()
@@ -0,0 +1,170 @@
+import time
+import random
+from typing import Callable, Optional
+
+from log import Log
+from hashes import Hashes
+from manifest import Manifest
+from metrics import Metrics
+from planner import Plan, build_plan
+from uofile import UOFile
+from updatefile import UpdateFile
+from validators import Validators
+from localindex import LocalIndex
+from snapshot import Snapshot, Entry
+
+
+class Watcher:
+    """Keeps the local root patched by polling the remote Manifest. The
+    tracked files, local hashes and HashCache are held in memory between
+    polls, so a poll where nothing changed is a single conditional request
+    for the Manifest. When it changes, only the entries that were added or
+    modified, along with those that failed before, are checked and
+    downloaded.
+    """
+    JITTER: float = 0.1
+    MAX_BACKOFF: int = 16
+
+    def __init__(self, uri: str, local_root: str,
+                 update: Callable[[UpdateFile, Validators], bool],
+                 pull: Callable[[Plan, Hashes, Metrics], tuple[int, int]],
+                 hash_workers: int = 4, hash_processes: bool = False,
+                 report: Optional[Callable[[Metrics], None]] = None,
+                 ) -> None:
+        self.uri = uri
+        self.update = update
+        self.pull = pull
+        self.report = report
+        self.hash_workers = hash_workers
+        self.hash_processes = hash_processes
+        self.manifest = Manifest(uri, local_root)
+        self.hashes = Hashes(uri, local_root)
+        self.validators = Validators(local_root)
+        self.validators.load()
+        self.index = LocalIndex(local_root)
+        self.snapshot = Snapshot(local_root)
+        self.snapshot.load()
+        self.failures: int = 0
+        self.pending: set[str] = set()
+        # State of every tracked file when the update files were last read.
+        self.known: dict[str, Entry] = {}
+        self._hashes_due: bool = True
+
+    def run(self, interval: float, max_interval: float) -> None:
+        """Polls until interrupted. Failed polls are retried with an
+        exponential backoff up to the max interval.
+        """
+        while True:
+            try:
+                self.poll()
+                self.failures = 0
+            except Exception as exc:
+                self.failures += 1
+                Log.error(f"Could not check for updates: {exc}")
+
+            delay = self.delay(interval, max_interval)
+            Log.debug(f"Next check in {delay:0.0f} sec.")
+            time.sleep(delay)
+
+    def delay(self, interval: float, max_interval: float) -> float:
+        """Seconds until the next poll, jittered so that many patchers
+        polling the same host spread out.
+        """
+        backoff = 2 ** min(self.failures, Watcher.MAX_BACKOFF)
+        delay = min(max(interval, max_interval), interval * backoff)
+        return delay * random.uniform(1 - Watcher.JITTER, 1 + Watcher.JITTER)
+
+    def poll(self) -> int:
+        """Checks the remote for changes and applies them. Returns the
+        amount of files that were checked.
+        """
+        metrics = Metrics(self.uri)
+        first = not self.manifest.loaded
+        with metrics.phase('manifest_update'):
+            if first:
+                self.manifest.load()
+            if not self.update(self.manifest, self.validators):
+                raise ConnectionError("Could not download remote Manifest.")
+        if self.manifest.modified:
+            self._hashes_due = True
+
+        changed: set[str] = set(self.pending)
+        if self._hashes_due:
+            with metrics.phase('hashes_update'):
+                if not self.update(self.hashes, self.validators):
+                    raise ConnectionError("Could not download remote Hashes.")
+            if not first:
+                # Reloading merges into the tracked files, start over.
+                self._reload()
+            self._hashes_due = False
+
+            current = self._snapshot()
+            if not (first and not self.manifest.modified
+                    and not self.hashes.modified and self.validators
+                    .is_applied(str(self.manifest.version))):
+                changed.update(file_id for file_id, state in current.items()
+                               if self.known.get(file_id, None) != state)
+            self.known = current
+
+        version = str(self.manifest.version)
+        metrics.version = version
+        if not changed:
+            if not self.validators.is_applied(version):
+                self.validators.mark_applied(version)
+            return 0
+        return self._apply(changed, version, metrics)
+
+    def _apply(self, changed: set[str], version: str,
+               metrics: Metrics) -> int:
+        """Checks the changed files and pulls those that need it."""
+        Log.notify(f"Manifest Version: '{version}', checking "
+                   f"{len(changed)} changed files.")
+        with metrics.phase('scan_local'):
+            self.index.scan()
+        UOFile.INDEX = self.index
+
+        with metrics.phase('build_localhash'):
+            self.hashes.build_localhash(workers=self.hash_workers,
+                                        use_processes=self.hash_processes,
+                                        file_ids=changed)
+
+        with metrics.phase('plan'):
+            files = {file_id: uofile
+                     for file_id, uofile in UpdateFile.FILES.items()
+                     if file_id in changed}
+            plan = build_plan(files, self.hashes, version)
+
+        # Until the changes are applied, a restart needs to check them.
+        self.validators.clear_applied()
+        with metrics.phase('pull_updates'):
+            self.pull(plan, self.hashes, metrics)
+        self.hashes.cache.save()
+
+        self.pending = {uofile.id for uofile in plan.create
+                        if not self._is_current(uofile)}
+        if not self.pending:
+            self.validators.mark_applied(version)
+            self.snapshot.save(version, self.known, verified=False)
+        if self.report:
+            self.report(metrics)
+        Log.notify(f"Applied '{version}': {len(plan.create)} downloaded, "
+                   f"{len(plan.delete)} removed, {len(self.pending)} failed.")
+        return len(files)
+
+    def _is_current(self, uofile: UOFile) -> bool:
+        """Checks if the local copy of a file matches the remote."""
+        md5 = self.hashes.local_hashes.get(uofile.id, None)
+        return md5 is not None and (not uofile.remote_hashes
+                                    or md5 in uofile.remote_hashes)
+
+    def _reload(self) -> None:
+        """Loads the tracked files again from the local update files."""
+        UpdateFile.FILES.clear()
+        self.manifest.clear()
+        self.hashes.clear()
+        self.manifest.load()
+        self.hashes.load()
+
+    def _snapshot(self) -> dict[str, Entry]:
+        """Gets the remote state of every tracked file."""
+        return Snapshot.capture(UpdateFile.FILES, self.hashes.sizes)